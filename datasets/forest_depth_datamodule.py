@@ -1,18 +1,28 @@
 
 import os
+import io
 import os.path
 from pathlib import Path
 import math
 import torch
 from pytorch_lightning import LightningDataModule
-from pycocotools.coco import COCO
 from PIL import Image
 import albumentations as A
 from albumentations.pytorch import ToTensorV2
 import numpy as np
 import random
-from utils.get_forest_files import get_forest_files
+from utils.manifest import Manifest, forest_key, alias_modalities
+from utils.shards import ShardDataset, read_bytes, sparse_points, dense_points
+from utils.instance_ids import rasterize_instance_ids, decode_instance_ids, instances_from_ids
+from utils.depth_png import native_depth, scale_depth, scale_batch
+from utils.sparse_depth import load_points, transform_points
+from utils.points_cache import PointsCache, points_cache_key, sample_points
 from utils.show_ann import visualize_masks, visualize_bboxes
+from utils.rgb_to_class import rgb_to_class, class_ids_folder
+from utils.modalities import ALL_MODALITIES, get_modalities
+from utils.presence import point_counts
+from utils.coco_store import CocoStore
+from utils.collate import Collate, Refill, check_ring
 from datasets.forest_cats import mapping
 from torchvision.utils import save_image
 from torch.utils.data import random_split, DataLoader
@@ -24,10 +34,25 @@ from tqdm import tqdm
 
 torch.manual_seed(0)
 
+# png value to depth, applied after the transforms
+DEPTH_SCALE = 1 / 255
+
+
 class ForestDataset(torch.utils.data.Dataset):
-    def __init__(self, cfg, transforms, split="train"):
+    def __init__(self, cfg, transforms, split="train", points_cache=None, index=True, modalities=ALL_MODALITIES):
         
         self.cfg = cfg
+        # Outputs of the samples, see utils/modalities.py
+        self.modalities = modalities
+        # PointsCache of the sampled points, deterministic transforms only
+        self.points_cache = points_cache
+        # png value to depth, applied after the transforms
+        self.depth_scale = DEPTH_SCALE
+        # Sparse depth files as point lists (npz)
+        self.sparse_npz = cfg.FOREST_DATASET.DEPTH.SPARSE_FORMAT == "npz"
+        # see as_points and utils/sparse_depth.py
+        self.point_transform = cfg.FOREST_DATASET.DEPTH.POINT_TRANSFORM
+        self.as_points = as_points(cfg.FOREST_DATASET)
         # Read config
         root = cfg.FOREST_DATASET.DATASET_PATH.ROOT
         self.split = split
@@ -48,261 +73,345 @@ class ForestDataset(torch.utils.data.Dataset):
             self.depth_proj_root = os.path.join(root, cfg.FOREST_DATASET.DATASET_PATH.DEPTH_VAL)
             self.semantic_root = os.path.join(root, cfg.FOREST_DATASET.DATASET_PATH.SEMANTIC_VAL)
         
-        self.coco = COCO(ann_path)
+        if cfg.FOREST_DATASET.SEMANTIC_CLASS_IDS:
+            # uint8 class id PNGs of utils/convert_semantic.py
+            self.semantic_root = class_ids_folder(self.semantic_root)
+
+        # Depth modalities of one folder, see utils/manifest.py alias_modalities
+        self.aliases = alias_modalities({
+            "depth_gt": self.depth_gt_root,
+            "depth_proj": self.depth_proj_root
+        })
+        if "depth_gt" in modalities and "sparse_depth" in modalities and self.aliases["depth_proj"] == "depth_gt":
+            print("depth_gt and depth_proj read from the same files: {}".format(self.depth_gt_root))
 
-        self.semantic_imgs = get_forest_files(self.semantic_root, "png")
-        self.depth_full_imgs = get_forest_files(self.depth_full_root, "png")
-        self.depth_gt_imgs = get_forest_files(self.depth_gt_root, "png")
-        self.depth_proj_imgs = get_forest_files(self.depth_proj_root, "png")
+        self.transforms = transforms
+        if not index:
+            # Records of packed shards only (utils/shards.py)
+            self.ids = np.zeros(0, dtype=np.int64)
+            return
+
+        # Memory mapped COCO annotations, shared by the workers (utils/coco_store.py)
+        self.coco = CocoStore(ann_path)
+
+        # Paths of every modality by sample key, see utils/manifest.py
+        roots = {
+            "semantic": self.semantic_root,
+            "depth_full": self.depth_full_root
+        }
+        points_roots = {
+            "depth_gt": self.depth_gt_root,
+            "depth_proj": self.depth_proj_root
+        }
+        if self.sparse_npz:
+            points_manifest = Manifest(points_roots, "npz", forest_key)
+        else:
+            roots.update(points_roots)
+        manifest = Manifest(roots, "png", forest_key)
+        if not self.sparse_npz:
+            points_manifest = manifest
 
         # Filter ids by scenes
-        im_ids = list(sorted(self.coco.imgs.keys()))
-        rgb_images = self.coco.loadImgs(ids=im_ids)
-
-        self.ids = list(map(lambda im_obj: im_obj["id"], rgb_images))
+        self.ids = np.array(self.coco.image_ids, dtype=np.int64)
 
-        catIds = self.coco.getCatIds()
-        categories = self.coco.loadCats(catIds)
-        self.categories = list(map(lambda x: x['name'], categories))
-        self.bg_categories_ids = self.coco.getCatIds(supNms="background")
-        bg_categories = self.coco.loadCats(self.bg_categories_ids)
-        self.bg_categories = list(map(lambda x: x['name'], bg_categories))
+        self.categories = [self.coco.cat_names[cat_id] for cat_id in self.coco.cat_ids()]
+        self.bg_categories_ids = self.coco.cat_ids("background")
+        self.bg_categories = [self.coco.cat_names[cat_id] for cat_id in self.bg_categories_ids]
 
-        self.obj_categories_ids = self.coco.getCatIds(supNms="object")
-        obj_categories = self.coco.loadCats(self.obj_categories_ids)
-        self.obj_categories = list(map(lambda x: x['name'], obj_categories))
+        self.obj_categories_ids = self.coco.cat_ids("object")
+        self.obj_categories = [self.coco.cat_names[cat_id] for cat_id in self.obj_categories_ids]
 
         print("Thing classes: ", self.obj_categories)
         print("Stuff classes: ", self.bg_categories)
 
         # self.depth_imgs = get_forest_files(self.depth_root, exclude, "png")
 
-        self.transforms = transforms
-
         if cfg.FOREST_DATASET.MAX_SAMPLES != None:
             self.ids = self.ids[:cfg.FOREST_DATASET.MAX_SAMPLES]
 
-
-
-    def find_k_nearest(self, lidar_fov):
-        k_number = self.cfg.FOREST_DATASET.DEPTH.K
-        b_lidar_fov = torch.unsqueeze(lidar_fov, dim=0)
-
-        distances = torch.cdist(b_lidar_fov, b_lidar_fov, p=2)
-        _, indices = torch.topk(distances, k_number + 1, dim=2, largest=False)
-        indices = indices[:, :, 1:]  # B x N x 3
-
-        return indices.squeeze_(0).long()
-
-    def mask_to_class(self,mask):
-        target = torch.from_numpy(mask)
-        h,w = target.shape[0],target.shape[1]
-        masks = torch.empty(h, w, dtype=torch.long)
-        target = target.permute(2, 0, 1).contiguous()
-        for k in mapping:
-            idx = (target==torch.tensor(k, dtype=torch.uint8).unsqueeze(1).unsqueeze(2))
-            validx = (idx.sum(0) == 3) 
-            masks[validx] = torch.tensor(mapping[k], dtype=torch.long)
-        I8 = (((masks.cpu().numpy()))).astype(np.uint8)
-        im = Image.fromarray(I8)
-        return im
-
-    def get_coco_ann(self, index):
+        # Paths by modality (utils/string_table.py), shared by aliases
+        file_names = [self.coco.file_name(img_id) for img_id in self.ids]
+        keys = [forest_key(file_name) for file_name in file_names]
+        basenames = [file_name.split(".")[-2] for file_name in file_names]
+        self.paths = {}
+        if "semantic" in self.modalities:
+            self.paths["semantic"] = manifest.table(keys, "semantic", basenames)
+        for modality, name in [("depth_gt", "depth_gt"), ("sparse_depth", "depth_proj")]:
+            alias = self.aliases[name]
+            if modality in self.modalities and alias not in self.paths:
+                self.paths[alias] = points_manifest.table(keys, alias, basenames)
+
+
+
+    def get_points(self, depth_proj, image_id):
+        # see utils/points_cache.py sample_points
+        return sample_points(self.cfg, self.cfg.FOREST_DATASET, depth_proj, image_id, self.modalities, self.points_cache)
+
+    def mask_to_class(self, mask):
+        # H x W uint8 class ids, see utils/rgb_to_class.py
+        return rgb_to_class(mask, mapping)
+
+    def points_presence(self):
+        # Samples with MAX_DEPTH_POINTS sparse depth points after the resize and center crop, see utils/presence.py
+        dataset_cfg = self.cfg.FOREST_DATASET
+        alias = self.aliases["depth_proj"]
+        root = {"depth_gt": self.depth_gt_root, "depth_proj": self.depth_proj_root}[alias]
+        mode = self.point_transform if self.as_points else None
+        # saved next to the folder, decoded once
+        counts = point_counts([self.path(index, alias) for index in range(len(self.ids))], root, self.read_depth,
+                              (dataset_cfg.RESIZE.HEIGHT, dataset_cfg.RESIZE.WIDTH),
+                              (dataset_cfg.CENTER_CROP.HEIGHT, dataset_cfg.CENTER_CROP.WIDTH), mode)
+        return counts >= dataset_cfg.DEPTH.MAX_DEPTH_POINTS
+
+    def path(self, index, name):
+        path = self.paths[name][index]
+        if not path:
+            raise KeyError("No {} file for image {}".format(name, self.ids[index]))
+        return path
+
+    def read_depth(self, path):
+        # (coordinates, values, shape) of a sparse depth file for the point
+        # transforms (as_points), the dense png as is for the raster ones
+        if self.sparse_npz:
+            return load_points(path)
+        depth = np.asarray(Image.open(path))
+        return sparse_points(depth) if self.as_points else depth
+
+    def get_record(self, index):
+        """
+        Sample index as read from the dataset files, the record of a shard
+        (utils/shards.py). get_sample(get_record(index)) is the sample.
+        """
 
         # Own coco file
         coco = self.coco
         # Image ID
-        img_id = self.ids[index]
+        img_id = int(self.ids[index])
         
-        obj_ann_ids = coco.getAnnIds(
-            imgIds=img_id, catIds=self.obj_categories_ids)
-            
-        coco_annotation = coco.loadAnns(obj_ann_ids)
+        # Annotation rows of the image in the store
+        obj_ann_rows = coco.ann_rows(img_id, self.obj_categories_ids)
 
         # path for input image
-        img_filename = coco.loadImgs(img_id)[0]['file_name']
-
-        basename = img_filename.split(".")[-2]
-
-        semantic_img_filename = [s for s in self.semantic_imgs if basename in s][0]        
-        
-        # depth_full_img_filename = [s for s in self.depth_full_imgs if basename in s][0]
-
-        depth_gt_img_filename = [s for s in self.depth_gt_imgs if basename in s][0]
-        
-        depth_proj_img_filename = [s for s in self.depth_proj_imgs if basename in s][0]
-        # print(semantic_img_filename)
-        semantic_mask = Image.open(semantic_img_filename)
-        semantic_mask = self.mask_to_class(np.array(semantic_mask))
-        semantic_mask = np.asarray(semantic_mask, dtype=np.long)    
-
-        # depth_full = np.asarray(Image.open(depth_full_img_filename))/255
-        # depth_gt = np.asarray(Image.open(depth_gt_img_filename))
-        # print("here2!!", np.unique(depth_gt))
-        depth_gt = np.asarray(Image.open(depth_gt_img_filename))/255
-        # # print("gt",np.unique(depth_gt), np.count_nonzero(depth_gt))
+        img_filename = coco.file_name(img_id)
 
-        
-        depth_proj = np.asarray(Image.open(depth_proj_img_filename))/255
-        # # print("proj",np.unique(depth_proj), np.count_nonzero(depth_proj))
-        
-        
-        num_objs = len(coco_annotation)
-        # Bounding boxes for objects
-        # In coco format, bbox = [xmin, ymin, width, height]
-        # In pytorch, the input should be [xmin, ymin, xmax, ymax]
-        boxes = []
-        labels = []
-        areas = []
-        iscrowd = []
-        masks = []
-        category_ids = []
-        for i in range(num_objs):
-
-            mask = coco.annToMask(coco_annotation[i])
-            masks.append(mask)
-
-            xmin = coco_annotation[i]['bbox'][0]
-            ymin = coco_annotation[i]['bbox'][1]
-            xmax = xmin + coco_annotation[i]['bbox'][2]
-            ymax = ymin + coco_annotation[i]['bbox'][3]
-            boxes.append([xmin, ymin, xmax, ymax])
-
-            category_id = coco_annotation[i]['category_id']
-            label = coco.cats[category_id]['name']
-            # print(label)
-            #TODO: check whether or not to add background 0 label
-            # print(self.obj_categories)
-            # labels must be 0 indexed!
-            labels.append(self.obj_categories.index(label))
-            # print(labels)
-            area = coco_annotation[i]['area']
-            areas.append(area)
-
-            iscrowd.append(coco_annotation[i]['iscrowd'])
-
-            category_ids.append(category_id)
-
-        # Tensorise img_id
-        img_id = torch.tensor([img_id])
+        record = {
+            "image_id": img_id,
+            "file_name": img_filename,
+            "rgb": read_bytes(os.path.join(self.imgs_root, img_filename))
+        }
 
-        category_ids = torch.as_tensor(category_ids, dtype=torch.int64)
+        # Only the files of the modalities, no dense depth in this dataset
+        if "semantic" in self.modalities:
+            semantic_mask = np.asarray(Image.open(self.path(index, "semantic")))
+            if not self.cfg.FOREST_DATASET.SEMANTIC_CLASS_IDS:
+                semantic_mask = self.mask_to_class(semantic_mask)
+            record["semantic"] = semantic_mask
+
+        # Aliased depth modalities share one decode
+        depths = {}
+
+        def read_depth(modality):
+            alias = self.aliases[modality]
+            if alias not in depths:
+                depths[alias] = self.read_depth(self.path(index, alias))
+            return depths[alias]
+
+        if "depth_gt" in self.modalities:
+            record["depth_gt"] = read_depth("depth_gt")
+
+        if "sparse_depth" in self.modalities:
+            record["depth_proj"] = read_depth("depth_proj")
+
+        if "instance" in self.modalities:
+            annotations = []
+            for row in obj_ann_rows:
+                category_id = int(coco.category_id[row])
+                label = coco.cat_names[category_id]
+                annotations.append({
+                    "bbox": coco.bbox[row].tolist(),
+                    # labels must be 0 indexed!
+                    "label": self.obj_categories.index(label),
+                    "area": float(coco.area[row]),
+                    "iscrowd": int(coco.iscrowd[row]),
+                    "category_id": category_id
+                })
+            shape = coco.image_size(img_id)
+            record["instance_ids"] = rasterize_instance_ids([coco.rle(row) for row in obj_ann_rows], shape)
+            record["annotations"] = annotations
+
+        return record
+
+    def get_coco_ann(self, record):
 
-        # Num of instance objects
-        num_objs = torch.as_tensor(num_objs, dtype=torch.int64)
         # Annotation is in dictionary format
         ann = {}
-        ann["boxes"] = boxes
-        ann["labels"] = labels
-        ann["image_id"] = img_id
-        ann["area"] = areas
-        ann["iscrowd"] = iscrowd
-        ann["category_ids"] = category_ids
-        ann["num_instances"] = num_objs
-        ann['masks'] = masks
-
-        ann["semantic_mask"] = semantic_mask
-        # ann["depth_full"] = depth_full
-        ann["depth_gt"] = depth_gt
-        ann["depth_proj"] = depth_proj
-        
-        return img_filename, ann
+        # Tensorise img_id
+        ann["image_id"] = torch.tensor([record["image_id"]])
+
+        if "instance" in self.modalities:
+            num_objs = len(record["annotations"])
+
+            # Bounding boxes for objects
+            # In coco format, bbox = [xmin, ymin, width, height]
+            # In pytorch, the input should be [xmin, ymin, xmax, ymax]
+            boxes = []
+            labels = []
+            areas = []
+            iscrowd = []
+            category_ids = []
+            for annotation in record["annotations"]:
+
+                xmin = annotation['bbox'][0]
+                ymin = annotation['bbox'][1]
+                xmax = xmin + annotation['bbox'][2]
+                ymax = ymin + annotation['bbox'][3]
+                boxes.append([xmin, ymin, xmax, ymax])
+
+                labels.append(annotation['label'])
+                areas.append(annotation['area'])
+                iscrowd.append(annotation['iscrowd'])
+                category_ids.append(annotation['category_id'])
+
+            ann["boxes"] = boxes
+            ann["labels"] = labels
+            ann["area"] = areas
+            ann["iscrowd"] = iscrowd
+            ann["category_ids"] = torch.as_tensor(category_ids, dtype=torch.int64)
+            # Num of instance objects
+            ann["num_instances"] = torch.as_tensor(num_objs, dtype=torch.int64)
+
+            instance_ids = record["instance_ids"]
+            if isinstance(instance_ids, bytes):
+                # PNG encoded in the packed shards
+                instance_ids = decode_instance_ids(instance_ids)
+            ann["instance_ids"] = instance_ids
+
+        if "semantic" in self.modalities:
+            ann["semantic_mask"] = np.asarray(record["semantic"], dtype=np.long)
+        # Kept as points (as_points), transformed by get_sample
+        def densify(depth):
+            if self.as_points:
+                return depth
+            # points in the shards (utils/pack_shards.py)
+            return native_depth(dense_points(depth) if isinstance(depth, tuple) else depth)
+
+        if "depth_gt" in self.modalities:
+            ann["depth_gt"] = densify(record["depth_gt"])
+        if "sparse_depth" in self.modalities:
+            if "depth_gt" in ann and record["depth_proj"] is record["depth_gt"]:
+                # same file (also in the shards, pickle keeps the shared object)
+                ann["depth_proj"] = ann["depth_gt"]
+            else:
+                ann["depth_proj"] = densify(record["depth_proj"])
+
+        return record["file_name"], ann
 
     def __getitem__(self, index):
 
-        img_filename, ann = self.get_coco_ann(index)
+        return self.get_sample(self.get_record(index))
+
+    def get_sample(self, record):
+
+        img_filename, ann = self.get_coco_ann(record)
 
         basename = img_filename.split(".")[-2]
 
-        if self.split == "train":
-            img_filename = os.path.join(self.cfg.FOREST_DATASET.DATASET_PATH.ROOT, self.cfg.FOREST_DATASET.DATASET_PATH.RGB_TRAIN, img_filename)
-        elif self.split == "val": 
-            img_filename = os.path.join(self.cfg.FOREST_DATASET.DATASET_PATH.ROOT, self.cfg.FOREST_DATASET.DATASET_PATH.RGB_VAL, img_filename)
-        source_img = np.asarray(Image.open(img_filename))
+        source_img = np.asarray(Image.open(io.BytesIO(record["rgb"])))
         image_id = ann["image_id"]
+
+        # Masks of the modalities, one per shared array
+        names = [name for name in ["instance_ids", "depth_gt", "depth_proj", "semantic_mask"] if name in ann]
+        points = [name for name in ["depth_gt", "depth_proj"] if name in ann] if self.as_points else []
+        names = [name for name in names if name not in points]
+        masks, slots = [], {}
+        for name in names:
+            slots[name] = next((slots[other] for other in slots if ann[other] is ann[name]), len(masks))
+            if slots[name] == len(masks):
+                masks.append(ann[name])
         
         if self.transforms is not None:
             
             transformed = self.transforms(
                 image=source_img,
-                masks=[*ann["masks"], ann['depth_gt'], ann['depth_proj'], ann['semantic_mask']],
-                # masks=[*ann["masks"], ann["depth_full"], ann['depth_gt'], ann['depth_proj'], ann['semantic_mask']],
-                bboxes=ann["boxes"],
-                labels=ann["labels"]
+                masks=masks,
             )
             
         
             source_img = transformed["image"]
-            # depth_full = transformed["masks"][-4]
-            # depth_full = torch.where(depth_full >= self.cfg.FOREST_DATASET.DEPTH.MAX_DEPTH, torch.tensor([
-            #     0], dtype=torch.float64), depth_full)
-            depth_gt = transformed["masks"][-3]
-            depth_proj = transformed["masks"][-2]
-            
-            semantic_mask = np.asarray(transformed['masks'][-1].cpu().numpy(), dtype=np.long)
+            maps = {name: transformed["masks"][slots[name]] for name in names}
+            for name in points:
+                # the geometric transforms applied to the coordinates, replayed
+                shared = next((other for other in maps if other in points and ann[other] is ann[name]), None)
+                if shared is not None:
+                    maps[name] = maps[shared]
+                else:
+                    maps[name] = torch.from_numpy(native_depth(dense_points(transform_points(ann[name], transformed["replay"], self.point_transform))))
+
+        sample = {
+            "image": source_img,
+            "image_id": image_id,
+            "basename": basename
+        }
 
-            num_boxes = len(transformed['bboxes'])
-            instance = Instances(semantic_mask.shape)
+        if "semantic_mask" in maps:
+            sample["semantic"] = np.asarray(maps["semantic_mask"].cpu().numpy(), dtype=np.long)
+
+        if "instance_ids" in maps:
+            # Instances still in the transformed id map
+            instance_masks, boxes, classes = instances_from_ids(maps["instance_ids"].cpu().numpy(), ann["labels"])
+            num_boxes = len(classes)
+            instance = Instances(tuple(source_img.shape[-2:]))
             
             if num_boxes:
-                instance_masks =[mask.cpu().numpy() for mask in transformed['masks'][:num_boxes]]
-                instance.gt_masks = BitMasks(np.asarray(instance_masks))
-                instance.gt_classes = torch.as_tensor(transformed['labels'])
-                instance.gt_boxes = Boxes(transformed['bboxes'])
+                instance.gt_masks = BitMasks(instance_masks)
+                instance.gt_classes = torch.as_tensor(classes)
+                instance.gt_boxes = Boxes(boxes)
             else:
                 instance.gt_masks = BitMasks(torch.Tensor([]).view(0,1,1))
                 instance.gt_classes = torch.as_tensor([])
                 instance.gt_boxes = Boxes([])
+            sample["instance"] = instance
+            sample["n_instances"] = num_boxes
 
-        
-        imPts = torch.nonzero(depth_proj)
-        inds = torch.randperm(imPts.shape[0])
-        
-        few_points_flag = False
-        if len(inds) < self.cfg.FOREST_DATASET.DEPTH.MAX_DEPTH_POINTS:
-            few_points_flag = True
-        imPts = imPts[inds][:self.cfg.FOREST_DATASET.DEPTH.MAX_DEPTH_POINTS]
-
-        # if imPts.shape[0] < self.max_points:
-        #     self.max_points = imPts.shape[0]
-        #     print(self.max_points)
-            # sys.stdout.write("\rmax_points {}".format(self.max_points))
-
-        virtual_lidar = torch.zeros((imPts.shape[0], 3))
-        virtual_lidar[:, 0:2] = imPts
-        virtual_lidar[:, 2] = depth_proj[imPts[:, 0], imPts[:, 1]]
-        # print("HERE!!", torch.unique(virtual_lidar[:, 2]))
-        mask = torch.zeros(depth_proj.shape[-2:], dtype=torch.bool)
-        mask[imPts[:, 0], imPts[:, 1]] = True
-
-        k_nn_indices = self.find_k_nearest(virtual_lidar)
-
-        # # Remove points from depth_proj to the total number of points = MAX_DEPTH_POINTS
-        depth_proj_ = torch.zeros_like(depth_proj)
-        depth_proj_[imPts[:, 0], imPts[:, 1]] = depth_proj[imPts[:, 0], imPts[:, 1]]
-        
+        # Native depth maps, scaled on the device (on_after_batch_transfer)
+        if "depth_gt" in maps:
+            sample["sparse_depth_gt"] = maps["depth_gt"].unsqueeze(0)
 
-        return {
-            "image": source_img, 
-            "semantic": semantic_mask,
-            'instance': instance, 
-            "image_id": image_id,
-            "basename": basename,
-            "n_instances": num_boxes,
-            "mask": mask,
-            "virtual_lidar": virtual_lidar,
-            "sparse_depth": depth_proj_.unsqueeze_(0).float(), 
-            "sparse_depth_gt": depth_gt.unsqueeze_(0).float(), 
-            # "depth_full": depth_full.unsqueeze_(0).float(), 
-            "k_nn_indices": k_nn_indices,
-            "few_points_flag": few_points_flag
-        }
+        if "depth_proj" in maps:
+            # the virtual lidar (and its knn) in scaled depth
+            imPts, virtual_lidar, k_nn_indices = self.get_points(scale_depth(maps["depth_proj"], self.depth_scale), image_id)
+
+            # Ragged batches take any number of points
+            sample["few_points_flag"] = not self.cfg.MODEL_CUSTOM.DEPTH_HEAD.RAGGED and imPts.shape[0] < self.cfg.FOREST_DATASET.DEPTH.MAX_DEPTH_POINTS
+
+            mask = torch.zeros(maps["depth_proj"].shape[-2:], dtype=torch.bool)
+            mask[imPts[:, 0], imPts[:, 1]] = True
+
+            sample["mask"] = mask
+            sample["virtual_lidar"] = virtual_lidar
+            # all the points, the ones of mask (MAX_DEPTH_POINTS) are kept by scale_batch
+            sample["sparse_depth"] = maps["depth_proj"].unsqueeze(0)
+            sample["k_nn_indices"] = k_nn_indices
+
+        return sample
         
 
     def __len__(self):
         return len(self.ids)
     
 
+def as_points(dataset_cfg):
+    # Sparse depth transformed as points, not as dense maps
+    return dataset_cfg.DEPTH.SPARSE_FORMAT == "npz" or dataset_cfg.DEPTH.POINT_TRANSFORM == "project"
+
+
+def compose(cfg, custom_transforms):
+    # The sparse depth points replay the transforms
+    if as_points(cfg.FOREST_DATASET):
+        return A.ReplayCompose(custom_transforms)
+    return A.Compose(custom_transforms)
+
+
 def get_train_transforms(cfg):
 
     custom_transforms = []
@@ -318,7 +427,8 @@ def get_train_transforms(cfg):
     custom_transforms.append(A.Normalize(mean=cfg.FOREST_DATASET.NORMALIZE.MEAN, std=cfg.FOREST_DATASET.NORMALIZE.STD))
     custom_transforms.append(ToTensorV2())
 
-    return A.Compose(custom_transforms, bbox_params=A.BboxParams(format='pascal_voc', label_fields=['labels']))
+    # boxes are derived from the transformed instance id map
+    return compose(cfg, custom_transforms)
 
 def get_val_transforms(cfg):
 
@@ -333,12 +443,14 @@ def get_val_transforms(cfg):
     custom_transforms.append(A.Normalize(mean=cfg.FOREST_DATASET.NORMALIZE.MEAN, std=cfg.FOREST_DATASET.NORMALIZE.STD))
     custom_transforms.append(ToTensorV2())
 
-    return A.Compose(custom_transforms, bbox_params=A.BboxParams(format='pascal_voc', label_fields=['labels']))
+    # boxes are derived from the transformed instance id map
+    return compose(cfg, custom_transforms)
 
 
 
 
 def test_dataset(cfg, dataset, item, split="train"):
+    # Needs every modality
     sample = dataset.__getitem__(item)
     basename = sample["basename"]
     source_img = sample["image"]
@@ -347,8 +459,9 @@ def test_dataset(cfg, dataset, item, split="train"):
 
     mask = sample["mask"]
 
-    sparse_depth = sample["sparse_depth"]
-    sparse_depth_gt = sample["sparse_depth_gt"]
+    # native depth, as scale_batch without the scale (normalized)
+    sparse_depth = sample["sparse_depth"].float() * mask
+    sparse_depth_gt = sample["sparse_depth_gt"].float()
 
     save_image(source_img, os.path.join("forest_dataset_test/{}".format(split), "source_img_{}.png".format(basename)))
     save_image(sparse_depth, os.path.join("forest_dataset_test/{}".format(split), "sparse_depth_{}.png".format(basename)), normalize=True)
@@ -369,6 +482,11 @@ def test_dataset(cfg, dataset, item, split="train"):
     
 
 
+def has_points(sample):
+    # Samples replaced by collate_fn (Refill), only with the sparse_depth modality
+    return not sample.get("few_points_flag", False)
+
+
 class ForestDataModule(LightningDataModule):
     """LightningDataModule used for training EffDet
      This supports COCO dataset input
@@ -376,10 +494,13 @@ class ForestDataModule(LightningDataModule):
         cgf: config
     """
 
-    def __init__(self, cfg):
+    def __init__(self, cfg, modalities=None):
         super().__init__()
         self.cfg = cfg
+        # Outputs of the datasets, from the model (e.g. Depth.MODALITIES) or cfg.MODALITIES
+        self.modalities = get_modalities(cfg, modalities)
         self.batch_size = cfg.BATCH_SIZE
+        check_ring(cfg.COLLATE_RING, cfg.NUM_WORKERS)
 
         # for split in ["train", "val"]:
         #     # Test dataset on one sample
@@ -389,9 +510,39 @@ class ForestDataModule(LightningDataModule):
         #         test_dataset(cfg, train_set, i, split=split)
         #     print("Dataset test finished")
 
+    def points_cache(self):
+        # Eval/predict only, the train transforms are random
+        if not self.cfg.FOREST_DATASET.DEPTH.POINTS_CACHE:
+            return None
+        key = points_cache_key(self.cfg, self.cfg.FOREST_DATASET, "forest_depth", self.modalities)
+        return PointsCache(self.cfg.FOREST_DATASET.DEPTH.POINTS_CACHE, key)
+
+    def use_shards(self):
+        return bool(self.cfg.FOREST_DATASET.SHARDS.ROOT)
+
+    def present_dataset(self, dataset):
+        # Only the samples with enough points (utils/presence.py), collate_fn does not fetch others
+        if self.use_shards() or "sparse_depth" not in self.modalities or self.cfg.MODEL_CUSTOM.DEPTH_HEAD.RAGGED:
+            return dataset
+        indices = np.flatnonzero(dataset.points_presence())
+        print("Samples with enough points: {}/{}".format(len(indices), len(dataset)))
+        return torch.utils.data.Subset(dataset, indices)
+
+    def shard_dataset(self, dataset, name, shuffle=False):
+        # Stream the samples from the shards of utils/pack_shards.py
+        if not self.use_shards():
+            return dataset
+        shards_cfg = self.cfg.FOREST_DATASET.SHARDS
+        # presence index of present_dataset, packed with the records
+        keep = None if "sparse_depth" not in self.modalities or self.cfg.MODEL_CUSTOM.DEPTH_HEAD.RAGGED else "points"
+        return ShardDataset(dataset, shards_cfg.ROOT, name, shuffle=shuffle,
+                            buffer_size=shards_cfg.SHUFFLE_BUFFER, keep=keep)
+
     def train_dataset(self) -> ForestDataset:
 
-        return ForestDataset(self.cfg, get_train_transforms(self.cfg), split="train")
+        dataset = ForestDataset(self.cfg, get_train_transforms(self.cfg), split="train", index=not self.use_shards(), modalities=self.modalities)
+        dataset = self.present_dataset(dataset)
+        return self.shard_dataset(dataset, "train", shuffle=self.cfg.FOREST_DATASET.SHUFFLE)
 
     def train_dataloader(self) -> DataLoader:
         train_dataset = self.train_dataset()
@@ -399,11 +550,14 @@ class ForestDataModule(LightningDataModule):
         train_loader = torch.utils.data.DataLoader(
             train_dataset,
             batch_size=self.batch_size,
-            shuffle=self.cfg.FOREST_DATASET.SHUFFLE,
+            # the shards are shuffled by ShardDataset
+            shuffle=self.cfg.FOREST_DATASET.SHUFFLE and not self.use_shards(),
             pin_memory=True,
             drop_last=True,
-            num_workers=4,
-            collate_fn=self.collate_fn_wrapper(train_dataset),
+            num_workers=self.cfg.NUM_WORKERS,
+            # ShardDataset counts the epochs to reshuffle the shards
+            persistent_workers=self.use_shards(),
+            collate_fn=self.collate_fn_wrapper(train_dataset, ring=self.cfg.COLLATE_RING),
         )
 
         return train_loader
@@ -411,7 +565,9 @@ class ForestDataModule(LightningDataModule):
     
     def val_dataset(self) -> ForestDataset:
 
-        return ForestDataset(self.cfg, get_val_transforms(self.cfg), split="val")
+        dataset = ForestDataset(self.cfg, get_val_transforms(self.cfg), split="val", points_cache=self.points_cache(), index=not self.use_shards(), modalities=self.modalities)
+        dataset = self.present_dataset(dataset)
+        return self.shard_dataset(dataset, "val")
 
     def val_dataloader(self) -> DataLoader:
         val_dataset = self.val_dataset()
@@ -422,8 +578,8 @@ class ForestDataModule(LightningDataModule):
             shuffle=False,
             pin_memory=True,
             drop_last=False,
-            num_workers=4,
-            collate_fn=self.collate_fn_wrapper(val_dataset),
+            num_workers=self.cfg.NUM_WORKERS,
+            collate_fn=self.collate_fn_wrapper(val_dataset, ring=self.cfg.COLLATE_RING),
         )
 
         return val_loader
@@ -431,7 +587,9 @@ class ForestDataModule(LightningDataModule):
 
     def predict_dataset(self) -> ForestDataset:
 
-        return ForestDataset(self.cfg, get_val_transforms(self.cfg), split="val")
+        dataset = ForestDataset(self.cfg, get_val_transforms(self.cfg), split="val", points_cache=self.points_cache(), index=not self.use_shards(), modalities=self.modalities)
+        dataset = self.present_dataset(dataset)
+        return self.shard_dataset(dataset, "val")
 
     def predict_dataloader(self) -> DataLoader:
         predict_dataset = self.predict_dataset()
@@ -442,35 +600,21 @@ class ForestDataModule(LightningDataModule):
             shuffle=False,
             pin_memory=True,
             drop_last=True,
-            num_workers=4,
-            collate_fn=self.collate_fn_wrapper(predict_dataset),
+            num_workers=self.cfg.NUM_WORKERS,
+            collate_fn=self.collate_fn_wrapper(predict_dataset, ring=self.cfg.COLLATE_RING),
         )
 
         return predict_loader
 
+    def on_after_batch_transfer(self, batch, dataloader_idx):
+        return scale_batch(batch, DEPTH_SCALE)
+
     @staticmethod
-    def collate_fn_wrapper(dataset):
+    def collate_fn_wrapper(dataset, ring=0):
+        # Samples written in place into the batch tensors (utils/collate.py)
+        stack_batch = Collate(ring=ring, pin=True)
+        # Misses of the presence index replaced, see utils/collate.py Refill
+        refill = Refill(dataset, has_points)
         def collate_fn(batch):
-            len_batch = len(batch) # original batch length
-            # batch = list(filter (lambda x:x["n_instances"] > 0, batch)) # filter out all the Nones
-            batch = list(filter (lambda x: x["few_points_flag"] == False, batch))
-            while len_batch > len(batch): # source all the required samples from the original dataset at random
-                diff = len_batch - len(batch)
-                for i in range(diff):
-                    new_sample = dataset[np.random.randint(0, len(dataset))]
-                    batch.append(new_sample)
-                batch = list(filter (lambda x: x["few_points_flag"] == False, batch))
-            return {
-                'image': torch.stack([i['image'] for i in batch]),
-                'semantic': torch.as_tensor(np.asarray([i['semantic'] for i in batch])),
-                'instance': [i['instance'] for i in batch],
-                'image_id': [i['image_id'] for i in batch],
-                'basename': [i['basename'] for i in batch],
-                'mask': torch.stack([i['mask'] for i in batch]),
-                'virtual_lidar': torch.stack([i['virtual_lidar'] for i in batch]),
-                'sparse_depth': torch.stack([i['sparse_depth'] for i in batch]),
-                # 'depth_full': torch.stack([i['depth_full'] for i in batch]),
-                'k_nn_indices': torch.stack([i['k_nn_indices'] for i in batch]),
-                'sparse_depth_gt': torch.stack([i['sparse_depth_gt'] for i in batch])
-            }
-        return collate_fn
\ No newline at end of file
+            return stack_batch(refill(batch))
+        return collate_fn
@@ -9,8 +9,9 @@ import albumentations as A
 from albumentations.pytorch import ToTensorV2
 import numpy as np
 import random
-from utils.get_vkitti_files import get_vkitti_files
+from utils.manifest import Manifest, vkitti_key, vkitti_filter
 from utils.show_ann import visualize_masks, visualize_bboxes, visualize_titles
+from utils.rgb_to_class import rgb_to_class
 from datasets.vkitti_cats import rgb_2_class, mapping
 import matplotlib.pyplot as plt
 from torchvision.utils import save_image
@@ -35,7 +36,8 @@ class vkittiDataset(torch.utils.data.Dataset):
         self.semantic_root = os.path.join(root, cfg.VKITTI_DATASET.DATASET_PATH.SEMANTIC)
         self.coco = COCO(os.path.join(root, cfg.VKITTI_DATASET.DATASET_PATH.COCO_ANNOTATION))
 
-        self.semantic_imgs = get_vkitti_files(self.semantic_root, exclude, "png")
+        # Paths of the semantic masks by sample key, see utils/manifest.py
+        self.manifest = Manifest({"semantic": self.semantic_root}, "png", vkitti_key, vkitti_filter(exclude))
 
         # get ids and shuffle
         self.ids = list(sorted(self.coco.imgs.keys()))
@@ -168,18 +170,9 @@ class vkittiDataset(torch.utils.data.Dataset):
 
     #     return imPts[inds, :][:N_num], depth[inds][:N_num]
 
-    def mask_to_class(self,mask):
-        target = torch.from_numpy(mask)
-        h,w = target.shape[0],target.shape[1]
-        masks = torch.empty(h, w, dtype=torch.long)
-        target = target.permute(2, 0, 1).contiguous()
-        for k in mapping:
-            idx = (target==torch.tensor(k, dtype=torch.uint8).unsqueeze(1).unsqueeze(2))
-            validx = (idx.sum(0) == 3) 
-            masks[validx] = torch.tensor(mapping[k], dtype=torch.long)
-        I8 = (((masks.cpu().numpy()))).astype(np.uint8)
-        im = Image.fromarray(I8)
-        return im
+    def mask_to_class(self, mask):
+        # H x W uint8 class ids, see utils/rgb_to_class.py
+        return rgb_to_class(mask, mapping)
 
     def get_coco_ann(self, index):
 
@@ -196,13 +189,8 @@ class vkittiDataset(torch.utils.data.Dataset):
         # path for input image
         img_filename = coco.loadImgs(img_id)[0]['file_name']
 
-        scene = img_filename.split("/")[-6]
-        weather = img_filename.split("/")[-5]
-        basename = img_filename.split(".")[-2].split("_")[-1]
-
         # TODO: semantic rgb to z-index
-        semantic_img_filename = [s for s in self.semantic_imgs if (
-            scene in s and basename in s and weather in s)][0]
+        semantic_img_filename = self.manifest.get(vkitti_key(img_filename), "semantic")
         
         semantic_mask = Image.open(semantic_img_filename)
         semantic_mask = self.mask_to_class(np.array(semantic_mask))
@@ -1,18 +1,30 @@
 
 import os
+import io
 import os.path
 from pathlib import Path
 import math
 import torch
+from torch.nn.utils.rnn import pad_sequence
 from pytorch_lightning import LightningDataModule
-from pycocotools.coco import COCO
 from PIL import Image
 import albumentations as A
 from albumentations.pytorch import ToTensorV2
 import numpy as np
 import random
-from utils.get_vkitti_files import get_vkitti_files
+from utils.manifest import Manifest, vkitti_key, vkitti_filter, vkitti_prune
+from utils.shards import ShardDataset, read_bytes, sparse_points, dense_points
+from utils.instance_ids import rasterize_instance_ids, decode_instance_ids, instances_from_ids, instances_from_ids_tensor
+from utils.depth_png import native_depth, scale_depth, scale_batch
+from utils.sparse_depth import load_points, transform_points
+from utils.points_cache import PointsCache, points_cache_key, sample_points, sample_batch_points
 from utils.show_ann import visualize_masks, visualize_bboxes
+from utils.rgb_to_class import rgb_to_class, class_ids_folder
+from utils.modalities import ALL_MODALITIES, get_modalities
+from utils.presence import instance_presence
+from utils.coco_store import CocoStore
+from utils.collate import Collate, Refill, check_ring
+from utils.batch_augment import batch_augment
 from datasets.vkitti_cats import mapping
 from torchvision.utils import save_image
 from torch.utils.data import random_split, DataLoader
@@ -24,10 +36,25 @@ from tqdm import tqdm
 
 torch.manual_seed(0)
 
+# png value to depth, applied after the transforms
+DEPTH_SCALE = 1 / 255
+
+
 class VkittiDataset(torch.utils.data.Dataset):
-    def __init__(self, cfg, transforms, scenes, aug=None):
+    def __init__(self, cfg, transforms, scenes, aug=None, points_cache=None, index=True, modalities=ALL_MODALITIES):
         
         self.cfg = cfg
+        # Outputs of the samples, see utils/modalities.py
+        self.modalities = modalities
+        # PointsCache of the sampled points, deterministic transforms only
+        self.points_cache = points_cache
+        # png value to depth, applied after the transforms
+        self.depth_scale = DEPTH_SCALE
+        # Sparse depth files as point lists (npz)
+        self.sparse_npz = cfg.VKITTI_DATASET.DEPTH.SPARSE_FORMAT == "npz"
+        # see as_points and utils/sparse_depth.py
+        self.point_transform = cfg.VKITTI_DATASET.DEPTH.POINT_TRANSFORM
+        self.as_points = as_points(cfg.VKITTI_DATASET)
 
         
         # Read config
@@ -40,264 +67,334 @@ class VkittiDataset(torch.utils.data.Dataset):
         self.depth_proj_root = os.path.join(root, cfg.VKITTI_DATASET.DATASET_PATH.DEPTH_PROJ)
 
         self.semantic_root = os.path.join(root, cfg.VKITTI_DATASET.DATASET_PATH.SEMANTIC)
-        self.coco = COCO(os.path.join(root, cfg.VKITTI_DATASET.DATASET_PATH.COCO_ANNOTATION))
 
-        self.semantic_imgs = get_vkitti_files(self.semantic_root, exclude, "png", scenes, aug=aug)
-        self.depth_full_imgs = get_vkitti_files(self.depth_full_root, exclude, "png", scenes, aug=aug)
-        self.depth_gt_imgs = get_vkitti_files(self.depth_gt_root, exclude, "png", scenes, aug=aug)
-        self.depth_proj_imgs = get_vkitti_files(self.depth_proj_root, exclude, "png", scenes, aug=aug)
+        if cfg.VKITTI_DATASET.SEMANTIC_CLASS_IDS:
+            # uint8 class id PNGs of utils/convert_semantic.py
+            self.semantic_root = class_ids_folder(self.semantic_root)
+
+        self.transforms = transforms
+        if not index:
+            # Records of packed shards only (utils/shards.py)
+            self.ids = np.zeros(0, dtype=np.int64)
+            return
+
+        # Memory mapped COCO annotations, shared by the workers (utils/coco_store.py)
+        self.coco = CocoStore(os.path.join(root, cfg.VKITTI_DATASET.DATASET_PATH.COCO_ANNOTATION))
+
+        # Paths of every modality by sample key, see utils/manifest.py
+        roots = {
+            "semantic": self.semantic_root,
+            "depth_full": self.depth_full_root
+        }
+        points_roots = {
+            "depth_gt": self.depth_gt_root,
+            "depth_proj": self.depth_proj_root
+        }
+        path_filter = vkitti_filter(exclude, scenes, aug=aug)
+        prune = vkitti_prune(exclude, scenes, aug=aug)
+        if self.sparse_npz:
+            points_manifest = Manifest(points_roots, "npz", vkitti_key, path_filter, prune=prune)
+        else:
+            roots.update(points_roots)
+        manifest = Manifest(roots, "png", vkitti_key, path_filter, prune=prune)
+        if not self.sparse_npz:
+            points_manifest = manifest
 
         # Filter ids by scenes
-        im_ids = list(sorted(self.coco.imgs.keys()))
-        rgb_images = self.coco.loadImgs(ids=im_ids)
-        rgb_images = list(filter(lambda im_obj: im_obj["file_name"].split("/")[-6] in scenes, rgb_images))
+        rgb_images = [(int(img_id), self.coco.file_name(img_id)) for img_id in self.coco.image_ids]
+        rgb_images = list(filter(lambda im_obj: im_obj[1].split("/")[-6] in scenes, rgb_images))
         if aug != None:
-            rgb_images = list(filter(lambda im_obj: im_obj["file_name"].split("/")[-5] == aug, rgb_images))
+            rgb_images = list(filter(lambda im_obj: im_obj[1].split("/")[-5] == aug, rgb_images))
 
-        self.ids = list(map(lambda im_obj: im_obj["id"], rgb_images))
+        self.ids = np.array([im_obj[0] for im_obj in rgb_images], dtype=np.int64)
 
-        catIds = self.coco.getCatIds()
-        categories = self.coco.loadCats(catIds)
-        self.categories = list(map(lambda x: x['name'], categories))
-        self.bg_categories_ids = self.coco.getCatIds(supNms="background")
-        bg_categories = self.coco.loadCats(self.bg_categories_ids)
-        self.bg_categories = list(map(lambda x: x['name'], bg_categories))
+        self.categories = [self.coco.cat_names[cat_id] for cat_id in self.coco.cat_ids()]
+        self.bg_categories_ids = self.coco.cat_ids("background")
+        self.bg_categories = [self.coco.cat_names[cat_id] for cat_id in self.bg_categories_ids]
 
-        self.obj_categories_ids = self.coco.getCatIds(supNms="object")
-        obj_categories = self.coco.loadCats(self.obj_categories_ids)
-        self.obj_categories = list(map(lambda x: x['name'], obj_categories))
+        self.obj_categories_ids = self.coco.cat_ids("object")
+        self.obj_categories = [self.coco.cat_names[cat_id] for cat_id in self.obj_categories_ids]
 
         print("Thing classes: ", self.obj_categories)
         print("Stuff classes: ", self.bg_categories)
 
         # self.depth_imgs = get_vkitti_files(self.depth_root, exclude, "png")
 
-        self.transforms = transforms
-
         if cfg.VKITTI_DATASET.MAX_SAMPLES != None:
             self.ids = self.ids[:cfg.VKITTI_DATASET.MAX_SAMPLES]
 
-
-
-    def find_k_nearest(self, lidar_fov):
-        k_number = self.cfg.VKITTI_DATASET.DEPTH.K
-        b_lidar_fov = torch.unsqueeze(lidar_fov, dim=0)
-
-        distances = torch.cdist(b_lidar_fov, b_lidar_fov, p=2)
-        _, indices = torch.topk(distances, k_number + 1, dim=2, largest=False)
-        indices = indices[:, :, 1:]  # B x N x 3
-
-        return indices.squeeze_(0).long()
-
-    def mask_to_class(self,mask):
-        target = torch.from_numpy(mask)
-        h,w = target.shape[0],target.shape[1]
-        masks = torch.empty(h, w, dtype=torch.long)
-        target = target.permute(2, 0, 1).contiguous()
-        for k in mapping:
-            idx = (target==torch.tensor(k, dtype=torch.uint8).unsqueeze(1).unsqueeze(2))
-            validx = (idx.sum(0) == 3) 
-            masks[validx] = torch.tensor(mapping[k], dtype=torch.long)
-        I8 = (((masks.cpu().numpy()))).astype(np.uint8)
-        im = Image.fromarray(I8)
-        return im
-
-    def get_coco_ann(self, index):
+        # Paths by modality (utils/string_table.py)
+        keys = [vkitti_key(self.coco.file_name(img_id)) for img_id in self.ids]
+        self.paths = {}
+        for modality, name, modality_manifest in [("semantic", "semantic", manifest), ("depth_full", "depth_full", manifest),
+                                                  ("depth_gt", "depth_gt", points_manifest), ("sparse_depth", "depth_proj", points_manifest)]:
+            if modality in self.modalities:
+                self.paths[name] = modality_manifest.table(keys, name)
+
+
+    def get_points(self, depth_proj, image_id):
+        # see utils/points_cache.py sample_points
+        return sample_points(self.cfg, self.cfg.VKITTI_DATASET, depth_proj, image_id, self.modalities, self.points_cache)
+
+    def mask_to_class(self, mask):
+        # H x W uint8 class ids, see utils/rgb_to_class.py
+        return rgb_to_class(mask, mapping)
+
+    def instance_presence(self):
+        # Samples with an instance after the resize and center crop, see utils/presence.py
+        dataset_cfg = self.cfg.VKITTI_DATASET
+        return instance_presence(self.coco, self.ids, self.obj_categories_ids,
+                                 (dataset_cfg.RESIZE.HEIGHT, dataset_cfg.RESIZE.WIDTH),
+                                 (dataset_cfg.CENTER_CROP.HEIGHT, dataset_cfg.CENTER_CROP.WIDTH))
+
+    def path(self, index, name):
+        path = self.paths[name][index]
+        if not path:
+            raise KeyError("No {} file for image {}".format(name, self.ids[index]))
+        return path
+
+    def read_depth(self, path):
+        # (coordinates, values, shape) of a sparse depth file for the point
+        # transforms (as_points), the dense png as is for the raster ones
+        if self.sparse_npz:
+            return load_points(path)
+        depth = np.asarray(Image.open(path))
+        return sparse_points(depth) if self.as_points else depth
+
+    def get_record(self, index):
+        """
+        Sample index as read from the dataset files, the record of a shard
+        (utils/shards.py). get_sample(get_record(index)) is the sample.
+        """
 
         # Own coco file
         coco = self.coco
         # Image ID
-        img_id = self.ids[index]
+        img_id = int(self.ids[index])
         
-        obj_ann_ids = coco.getAnnIds(
-            imgIds=img_id, catIds=self.obj_categories_ids)
-            
-        coco_annotation = coco.loadAnns(obj_ann_ids)
+        # Annotation rows of the image in the store
+        obj_ann_rows = coco.ann_rows(img_id, self.obj_categories_ids)
 
         # path for input image
-        img_filename = coco.loadImgs(img_id)[0]['file_name']
-
-        scene = img_filename.split("/")[-6]
-        weather = img_filename.split("/")[-5]
-        basename = img_filename.split(".")[-2].split("_")[-1]
+        img_filename = coco.file_name(img_id)
 
-        semantic_img_filename = [s for s in self.semantic_imgs if (
-            scene in s and basename in s and weather in s)][0]        
-        
-        depth_full_img_filename = [s for s in self.depth_full_imgs if (
-            scene in s and basename in s and weather in s)][0]
-
-        depth_gt_img_filename = [s for s in self.depth_gt_imgs if (
-            scene in s and basename in s and weather in s)][0]
-        
-        depth_proj_img_filename = [s for s in self.depth_proj_imgs if (
-            scene in s and basename in s and weather in s)][0]
-        
-        semantic_mask = Image.open(semantic_img_filename)
-        semantic_mask = self.mask_to_class(np.array(semantic_mask))
-        semantic_mask = np.asarray(semantic_mask, dtype=np.long)
-        
-
-        depth_full = np.asarray(Image.open(depth_full_img_filename))/255
-
-        depth_gt = np.asarray(Image.open(depth_gt_img_filename))
-        print("here2!!", np.unique(depth_gt))
-        depth_gt = np.asarray(Image.open(depth_gt_img_filename))/255
-        # print("gt",np.unique(depth_gt), np.count_nonzero(depth_gt))
-
-        
-        depth_proj = np.asarray(Image.open(depth_proj_img_filename))/255
-        # print("proj",np.unique(depth_proj), np.count_nonzero(depth_proj))
-        
-        
-        num_objs = len(coco_annotation)
-
-        # Bounding boxes for objects
-        # In coco format, bbox = [xmin, ymin, width, height]
-        # In pytorch, the input should be [xmin, ymin, xmax, ymax]
-        boxes = []
-        labels = []
-        areas = []
-        iscrowd = []
-        masks = []
-        category_ids = []
-        for i in range(num_objs):
-
-            mask = coco.annToMask(coco_annotation[i])
-            masks.append(mask)
-
-            xmin = coco_annotation[i]['bbox'][0]
-            ymin = coco_annotation[i]['bbox'][1]
-            xmax = xmin + coco_annotation[i]['bbox'][2]
-            ymax = ymin + coco_annotation[i]['bbox'][3]
-            boxes.append([xmin, ymin, xmax, ymax])
-
-            category_id = coco_annotation[i]['category_id']
-            label = coco.cats[category_id]['name']
-            # print(label)
-            #TODO: check whether or not to add background 0 label
-            # print(self.obj_categories)
-            # labels must be 0 indexed!
-            labels.append(self.obj_categories.index(label))
-            # print(labels)
-            area = coco_annotation[i]['area']
-            areas.append(area)
-
-            iscrowd.append(coco_annotation[i]['iscrowd'])
-
-            category_ids.append(category_id)
-
-        # Tensorise img_id
-        img_id = torch.tensor([img_id])
+        record = {
+            "image_id": img_id,
+            "file_name": img_filename,
+            "rgb": read_bytes(os.path.join(self.cfg.VKITTI_DATASET.DATASET_PATH.ROOT, img_filename))
+        }
 
-        category_ids = torch.as_tensor(category_ids, dtype=torch.int64)
+        # Only the files of the modalities
+        if "semantic" in self.modalities:
+            semantic_mask = np.asarray(Image.open(self.path(index, "semantic")))
+            if not self.cfg.VKITTI_DATASET.SEMANTIC_CLASS_IDS:
+                semantic_mask = self.mask_to_class(semantic_mask)
+            record["semantic"] = semantic_mask
+
+        if "depth_full" in self.modalities:
+            record["depth_full"] = read_bytes(self.path(index, "depth_full"))
+
+        if "depth_gt" in self.modalities:
+            record["depth_gt"] = self.read_depth(self.path(index, "depth_gt"))
+
+        if "sparse_depth" in self.modalities:
+            record["depth_proj"] = self.read_depth(self.path(index, "depth_proj"))
+
+        if "instance" in self.modalities:
+            annotations = []
+            for row in obj_ann_rows:
+                category_id = int(coco.category_id[row])
+                label = coco.cat_names[category_id]
+                annotations.append({
+                    "bbox": coco.bbox[row].tolist(),
+                    # labels must be 0 indexed!
+                    "label": self.obj_categories.index(label),
+                    "area": float(coco.area[row]),
+                    "iscrowd": int(coco.iscrowd[row]),
+                    "category_id": category_id
+                })
+            shape = coco.image_size(img_id)
+            record["instance_ids"] = rasterize_instance_ids([coco.rle(row) for row in obj_ann_rows], shape)
+            record["annotations"] = annotations
+
+        return record
+
+    def get_coco_ann(self, record):
 
-        # Num of instance objects
-        num_objs = torch.as_tensor(num_objs, dtype=torch.int64)
         # Annotation is in dictionary format
         ann = {}
-        ann["boxes"] = boxes
-        ann["labels"] = labels
-        ann["image_id"] = img_id
-        ann["area"] = areas
-        ann["iscrowd"] = iscrowd
-        ann["category_ids"] = category_ids
-        ann["num_instances"] = num_objs
-        ann['masks'] = masks
-
-        ann["semantic_mask"] = semantic_mask
-        ann["depth_full"] = depth_full
-        ann["depth_gt"] = depth_gt
-        ann["depth_proj"] = depth_proj
-        
-        return img_filename, ann
+        # Tensorise img_id
+        ann["image_id"] = torch.tensor([record["image_id"]])
+
+        if "instance" in self.modalities:
+            num_objs = len(record["annotations"])
+
+            # Bounding boxes for objects
+            # In coco format, bbox = [xmin, ymin, width, height]
+            # In pytorch, the input should be [xmin, ymin, xmax, ymax]
+            boxes = []
+            labels = []
+            areas = []
+            iscrowd = []
+            category_ids = []
+            for annotation in record["annotations"]:
+
+                xmin = annotation['bbox'][0]
+                ymin = annotation['bbox'][1]
+                xmax = xmin + annotation['bbox'][2]
+                ymax = ymin + annotation['bbox'][3]
+                boxes.append([xmin, ymin, xmax, ymax])
+
+                labels.append(annotation['label'])
+                areas.append(annotation['area'])
+                iscrowd.append(annotation['iscrowd'])
+                category_ids.append(annotation['category_id'])
+
+            ann["boxes"] = boxes
+            ann["labels"] = labels
+            ann["area"] = areas
+            ann["iscrowd"] = iscrowd
+            ann["category_ids"] = torch.as_tensor(category_ids, dtype=torch.int64)
+            # Num of instance objects
+            ann["num_instances"] = torch.as_tensor(num_objs, dtype=torch.int64)
+
+            instance_ids = record["instance_ids"]
+            if isinstance(instance_ids, bytes):
+                # PNG encoded in the packed shards
+                instance_ids = decode_instance_ids(instance_ids)
+            ann["instance_ids"] = instance_ids
+
+        if "semantic" in self.modalities:
+            ann["semantic_mask"] = np.asarray(record["semantic"], dtype=np.long)
+        if "depth_full" in self.modalities:
+            ann["depth_full"] = native_depth(Image.open(io.BytesIO(record["depth_full"])))
+        # Kept as points (as_points), transformed by get_sample
+        def densify(depth):
+            if self.as_points:
+                return depth
+            # points in the shards (utils/pack_shards.py)
+            return native_depth(dense_points(depth) if isinstance(depth, tuple) else depth)
+
+        if "depth_gt" in self.modalities:
+            ann["depth_gt"] = densify(record["depth_gt"])
+        if "sparse_depth" in self.modalities:
+            ann["depth_proj"] = densify(record["depth_proj"])
+
+        return record["file_name"], ann
 
     def __getitem__(self, index):
 
-        img_filename, ann = self.get_coco_ann(index)
+        return self.get_sample(self.get_record(index))
+
+    def get_sample(self, record):
+
+        img_filename, ann = self.get_coco_ann(record)
 
         basename = img_filename.split(".")[-2].split("_")[-1]
 
-        img_filename = os.path.join(self.cfg.VKITTI_DATASET.DATASET_PATH.ROOT, img_filename)
-        source_img = np.asarray(Image.open(img_filename))
+        source_img = np.asarray(Image.open(io.BytesIO(record["rgb"])))
         image_id = ann["image_id"]
+
+        # Masks of the requested modalities, transformed with the image
+        names = [name for name in ["instance_ids", "depth_full", "depth_gt", "depth_proj", "semantic_mask"] if name in ann]
+        points = [name for name in ["depth_gt", "depth_proj"] if name in ann] if self.as_points else []
+        names = [name for name in names if name not in points]
+
+        if self.transforms is None:
+            # Decoded only, the datamodule augments the batch (utils/batch_augment.py)
+            sample = {
+                "image": torch.from_numpy(np.ascontiguousarray(source_img.transpose(2, 0, 1))),
+                "image_id": image_id,
+                "basename": basename
+            }
+            for name in names:
+                sample[name] = torch.from_numpy(np.ascontiguousarray(ann[name]))
+            for name in points:
+                coordinates, values, _ = ann[name]
+                sample[name] = (torch.from_numpy(coordinates.astype(np.int64)), torch.from_numpy(native_depth(values)))
+            if "instance_ids" in ann:
+                sample["labels"] = ann["labels"]
+            return sample
         
         if self.transforms is not None:
             
             transformed = self.transforms(
                 image=source_img,
-                masks=[*ann["masks"], ann["depth_full"], ann['depth_gt'], ann['depth_proj'], ann['semantic_mask']],
-                bboxes=ann["boxes"],
-                labels=ann["labels"]
+                masks=[ann[name] for name in names],
             )
             
         
             source_img = transformed["image"]
-            depth_full = transformed["masks"][-4]
-            depth_full = torch.where(depth_full >= self.cfg.VKITTI_DATASET.DEPTH.MAX_DEPTH, torch.tensor([
-                0], dtype=torch.float64), depth_full)
-            depth_gt = transformed["masks"][-3]
-            depth_proj = transformed["masks"][-2]
-            
-            semantic_mask = np.asarray(transformed['masks'][-1].cpu().numpy(), dtype=np.long)
+            maps = dict(zip(names, transformed["masks"]))
+            for name in points:
+                # the geometric transforms applied to the coordinates, replayed
+                maps[name] = torch.from_numpy(native_depth(dense_points(transform_points(ann[name], transformed["replay"], self.point_transform))))
 
-            num_boxes = len(transformed['bboxes'])
-            instance = Instances(semantic_mask.shape)
+        sample = {
+            "image": source_img,
+            "image_id": image_id,
+            "basename": basename
+        }
+
+        if "semantic_mask" in maps:
+            sample["semantic"] = np.asarray(maps["semantic_mask"].cpu().numpy(), dtype=np.long)
+
+        if "instance_ids" in maps:
+            # Instances still in the transformed id map
+            instance_masks, boxes, classes = instances_from_ids(maps["instance_ids"].cpu().numpy(), ann["labels"])
+            num_boxes = len(classes)
+            instance = Instances(tuple(source_img.shape[-2:]))
             
             if num_boxes:
-                instance_masks =[mask.cpu().numpy() for mask in transformed['masks'][:num_boxes]]
-                instance.gt_masks = BitMasks(np.asarray(instance_masks))
-                instance.gt_classes = torch.as_tensor(transformed['labels'])
-                instance.gt_boxes = Boxes(transformed['bboxes'])
+                instance.gt_masks = BitMasks(instance_masks)
+                instance.gt_classes = torch.as_tensor(classes)
+                instance.gt_boxes = Boxes(boxes)
             else:
                 instance.gt_masks = BitMasks(torch.Tensor([]).view(0,1,1))
                 instance.gt_classes = torch.as_tensor([])
                 instance.gt_boxes = Boxes([])
+            sample["instance"] = instance
+            sample["n_instances"] = num_boxes
 
-        
-        imPts = torch.nonzero(depth_proj)
-        inds = torch.randperm(imPts.shape[0])
-        imPts = imPts[inds][:self.cfg.VKITTI_DATASET.DEPTH.MAX_DEPTH_POINTS]
+        # Native depth maps, scaled on the device (on_after_batch_transfer)
+        if "depth_full" in maps:
+            sample["depth_full"] = maps["depth_full"].unsqueeze(0)
 
-        # if imPts.shape[0] < self.max_points:
-        #     self.max_points = imPts.shape[0]
-        #     print(self.max_points)
-            # sys.stdout.write("\rmax_points {}".format(self.max_points))
+        if "depth_gt" in maps:
+            sample["sparse_depth_gt"] = maps["depth_gt"].unsqueeze(0)
 
-        virtual_lidar = torch.zeros((imPts.shape[0], 3))
-        virtual_lidar[:, 0:2] = imPts
-        virtual_lidar[:, 2] = depth_proj[imPts[:, 0], imPts[:, 1]]
+        if "depth_proj" in maps:
+            # the virtual lidar (and its knn) in scaled depth
+            imPts, virtual_lidar, k_nn_indices = self.get_points(scale_depth(maps["depth_proj"], self.depth_scale), image_id)
 
-        mask = torch.zeros(depth_proj.shape[-2:], dtype=torch.bool)
-        mask[imPts[:, 0], imPts[:, 1]] = True
+            mask = torch.zeros(maps["depth_proj"].shape[-2:], dtype=torch.bool)
+            mask[imPts[:, 0], imPts[:, 1]] = True
 
-        k_nn_indices = self.find_k_nearest(virtual_lidar)
+            sample["virtual_lidar"] = virtual_lidar
+            sample["mask"] = mask
+            # all the points, the ones of mask (MAX_DEPTH_POINTS) are kept by scale_batch
+            sample["sparse_depth"] = maps["depth_proj"].unsqueeze(0)
+            sample["k_nn_indices"] = k_nn_indices
 
-        # Remove points from depth_proj to the total number of points = MAX_DEPTH_POINTS
-        depth_proj_ = torch.zeros_like(depth_proj)
-        depth_proj_[imPts[:, 0], imPts[:, 1]] = depth_proj[imPts[:, 0], imPts[:, 1]]
-        
-
-        return {
-            "image": source_img, 
-            "semantic": semantic_mask,
-            'instance': instance, 
-            "image_id": image_id,
-            "basename": basename,
-            "n_instances": num_boxes,
-            "virtual_lidar": virtual_lidar,
-            "mask": mask,
-            "sparse_depth": depth_proj_.unsqueeze_(0).float(), 
-            "sparse_depth_gt": depth_gt.unsqueeze_(0).float(), 
-            "depth_full": depth_full.unsqueeze_(0).float(), 
-            "k_nn_indices": k_nn_indices
-        }
+        return sample
         
 
     def __len__(self):
         return len(self.ids)
     
 
+def as_points(dataset_cfg):
+    # Sparse depth transformed as points, not as dense maps
+    return dataset_cfg.DEPTH.SPARSE_FORMAT == "npz" or dataset_cfg.DEPTH.POINT_TRANSFORM == "project"
+
+
+def compose(cfg, custom_transforms):
+    # The sparse depth points replay the transforms
+    if as_points(cfg.VKITTI_DATASET):
+        return A.ReplayCompose(custom_transforms)
+    return A.Compose(custom_transforms)
+
+
 def get_train_transforms(cfg):
 
     custom_transforms = []
@@ -313,7 +410,8 @@ def get_train_transforms(cfg):
     custom_transforms.append(A.Normalize(mean=cfg.VKITTI_DATASET.NORMALIZE.MEAN, std=cfg.VKITTI_DATASET.NORMALIZE.STD))
     custom_transforms.append(ToTensorV2())
 
-    return A.Compose(custom_transforms, bbox_params=A.BboxParams(format='pascal_voc', label_fields=['labels']))
+    # boxes are derived from the transformed instance id map
+    return compose(cfg, custom_transforms)
 
 def get_val_transforms(cfg):
 
@@ -328,11 +426,24 @@ def get_val_transforms(cfg):
     custom_transforms.append(A.Normalize(mean=cfg.VKITTI_DATASET.NORMALIZE.MEAN, std=cfg.VKITTI_DATASET.NORMALIZE.STD))
     custom_transforms.append(ToTensorV2())
 
-    return A.Compose(custom_transforms, bbox_params=A.BboxParams(format='pascal_voc', label_fields=['labels']))
+    # boxes are derived from the transformed instance id map
+    return compose(cfg, custom_transforms)
 
 
 
 
+def has_instances(sample):
+    # Samples replaced by collate_fn (Refill), only with the instance modality
+    return sample.get("n_instances", 1) > 0
+
+
+def decoded_has_instances(augment):
+    # has_instances of the decoded samples, before the batch augment
+    def present(sample):
+        return "instance_ids" not in sample or augment.keeps_instances(sample["instance_ids"])
+    return present
+
+
 class VkittiDataModule(LightningDataModule):
     """LightningDataModule used for training EffDet
      This supports COCO dataset input
@@ -340,18 +451,61 @@ class VkittiDataModule(LightningDataModule):
         cgf: config
     """
 
-    def __init__(self, cfg):
+    def __init__(self, cfg, modalities=None):
         super().__init__()
         self.cfg = cfg
+        # Outputs of the datasets, from the model (e.g. Depth.MODALITIES) or cfg.MODALITIES
+        self.modalities = get_modalities(cfg, modalities)
         self.batch_size = cfg.BATCH_SIZE
+        check_ring(cfg.COLLATE_RING, cfg.NUM_WORKERS)
+        # Workers only decode, the batches are augmented in on_after_batch_transfer
+        self.batch_augment = cfg.VKITTI_DATASET.BATCH_AUGMENT
+        if self.batch_augment:
+            self.train_augment = batch_augment(cfg.VKITTI_DATASET, train=True)
+            self.val_augment = batch_augment(cfg.VKITTI_DATASET, train=False)
+            self.eval_points_cache = self.points_cache()
         
         # dataset_test = VkittiDataset(self.cfg, get_train_transforms(self.cfg), self.cfg.VKITTI_DATASET.EVAL_SCENES)
         # for i in range(len(dataset_test)):
         #     dataset_test.__getitem__(i)
 
+    def points_cache(self):
+        # Eval/predict only, the train transforms are random
+        if not self.cfg.VKITTI_DATASET.DEPTH.POINTS_CACHE:
+            return None
+        key = points_cache_key(self.cfg, self.cfg.VKITTI_DATASET, "vkitti_depth", self.modalities)
+        return PointsCache(self.cfg.VKITTI_DATASET.DEPTH.POINTS_CACHE, key)
+
+    def dataset_transforms(self, get_transforms):
+        # None with BATCH_AUGMENT, the datasets only decode
+        return None if self.batch_augment else get_transforms(self.cfg)
+
+    def use_shards(self):
+        return bool(self.cfg.VKITTI_DATASET.SHARDS.ROOT)
+
+    def present_dataset(self, dataset):
+        # Only the samples with instances (utils/presence.py), collate_fn does not fetch others
+        if self.use_shards() or "instance" not in self.modalities:
+            return dataset
+        indices = np.flatnonzero(dataset.instance_presence())
+        print("Samples with instances: {}/{}".format(len(indices), len(dataset)))
+        return torch.utils.data.Subset(dataset, indices)
+
+    def shard_dataset(self, dataset, name, shuffle=False):
+        # Stream the samples from the shards of utils/pack_shards.py
+        if not self.use_shards():
+            return dataset
+        shards_cfg = self.cfg.VKITTI_DATASET.SHARDS
+        # presence index of present_dataset, packed with the records
+        keep = "instances" if "instance" in self.modalities else None
+        return ShardDataset(dataset, shards_cfg.ROOT, name, shuffle=shuffle,
+                            buffer_size=shards_cfg.SHUFFLE_BUFFER, keep=keep)
+
     def train_dataset(self) -> VkittiDataset:
 
-        return VkittiDataset(self.cfg, get_train_transforms(self.cfg), self.cfg.VKITTI_DATASET.TRAINING_SCENES)
+        dataset = VkittiDataset(self.cfg, self.dataset_transforms(get_train_transforms), self.cfg.VKITTI_DATASET.TRAINING_SCENES, index=not self.use_shards(), modalities=self.modalities)
+        dataset = self.present_dataset(dataset)
+        return self.shard_dataset(dataset, "train", shuffle=self.cfg.VKITTI_DATASET.SHUFFLE)
 
     def train_dataloader(self) -> DataLoader:
         train_dataset = self.train_dataset()
@@ -359,11 +513,14 @@ class VkittiDataModule(LightningDataModule):
         train_loader = torch.utils.data.DataLoader(
             train_dataset,
             batch_size=self.batch_size,
-            shuffle=self.cfg.VKITTI_DATASET.SHUFFLE,
+            # the shards are shuffled by ShardDataset
+            shuffle=self.cfg.VKITTI_DATASET.SHUFFLE and not self.use_shards(),
             pin_memory=True,
             drop_last=True,
-            num_workers=4,
-            collate_fn=self.collate_fn_wrapper(train_dataset),
+            num_workers=self.cfg.NUM_WORKERS,
+            # ShardDataset counts the epochs to reshuffle the shards
+            persistent_workers=self.use_shards(),
+            collate_fn=self.collate_fn_wrapper(train_dataset, ring=self.cfg.COLLATE_RING, decoded=self.batch_augment, present=self.sample_presence()),
         )
 
         return train_loader
@@ -371,7 +528,9 @@ class VkittiDataModule(LightningDataModule):
     
     def val_dataset(self) -> VkittiDataset:
 
-        return VkittiDataset(self.cfg, get_val_transforms(self.cfg), self.cfg.VKITTI_DATASET.EVAL_SCENES)
+        dataset = VkittiDataset(self.cfg, self.dataset_transforms(get_val_transforms), self.cfg.VKITTI_DATASET.EVAL_SCENES, points_cache=self.points_cache(), index=not self.use_shards(), modalities=self.modalities)
+        dataset = self.present_dataset(dataset)
+        return self.shard_dataset(dataset, "val")
 
     def val_dataloader(self) -> DataLoader:
         val_dataset = self.val_dataset()
@@ -382,8 +541,8 @@ class VkittiDataModule(LightningDataModule):
             shuffle=False,
             pin_memory=True,
             drop_last=False,
-            num_workers=4,
-            collate_fn=self.collate_fn_wrapper(val_dataset),
+            num_workers=self.cfg.NUM_WORKERS,
+            collate_fn=self.collate_fn_wrapper(val_dataset, ring=self.cfg.COLLATE_RING, decoded=self.batch_augment, present=self.sample_presence()),
         )
 
         return val_loader
@@ -391,7 +550,9 @@ class VkittiDataModule(LightningDataModule):
 
     def predict_dataset(self) -> VkittiDataset:
 
-        return VkittiDataset(self.cfg, get_val_transforms(self.cfg), self.cfg.VKITTI_DATASET.TEST_SCENES, aug="clone")
+        dataset = VkittiDataset(self.cfg, self.dataset_transforms(get_val_transforms), self.cfg.VKITTI_DATASET.TEST_SCENES, aug="clone", points_cache=self.points_cache(), index=not self.use_shards(), modalities=self.modalities)
+        dataset = self.present_dataset(dataset)
+        return self.shard_dataset(dataset, "predict")
 
     def predict_dataloader(self) -> DataLoader:
         predict_dataset = self.predict_dataset()
@@ -402,34 +563,135 @@ class VkittiDataModule(LightningDataModule):
             shuffle=False,
             pin_memory=True,
             drop_last=True,
-            num_workers=4,
-            collate_fn=self.collate_fn_wrapper(predict_dataset),
+            num_workers=self.cfg.NUM_WORKERS,
+            collate_fn=self.collate_fn_wrapper(predict_dataset, ring=self.cfg.COLLATE_RING, decoded=self.batch_augment, present=self.sample_presence()),
         )
 
         return predict_loader
 
+    def sample_presence(self):
+        # has_instances of collate_fn, on the decoded samples with BATCH_AUGMENT
+        if self.batch_augment:
+            return decoded_has_instances(self.val_augment)
+        return has_instances
+
     @staticmethod
-    def collate_fn_wrapper(dataset):
+    def collate_fn_wrapper(dataset, ring=0, decoded=False, present=has_instances):
+        # Samples written in place into the batch tensors (utils/collate.py)
+        stack_batch = Collate(ring=ring, pin=True)
+        # Misses of the presence index replaced, see utils/collate.py Refill
+        refill = Refill(dataset, present)
         def collate_fn(batch):
-            len_batch = len(batch) # original batch length
-            batch = list(filter (lambda x:x["n_instances"] > 0, batch)) # filter out all the Nones
-            while len_batch > len(batch): # source all the required samples from the original dataset at random
-                diff = len_batch - len(batch)
-                for i in range(diff):
-                    new_sample = dataset[np.random.randint(0, len(dataset))]
-                    batch.append(new_sample)
-                batch = list(filter (lambda x:x["n_instances"] > 0, batch))
-            return {
-                'image': torch.stack([i['image'] for i in batch]),
-                'semantic': torch.as_tensor(np.asarray([i['semantic'] for i in batch])),
-                'instance': [i['instance'] for i in batch],
-                'image_id': [i['image_id'] for i in batch],
-                'basename': [i['basename'] for i in batch],
-                'virtual_lidar': torch.stack([i['virtual_lidar'] for i in batch]),
-                'mask': torch.stack([i['mask'] for i in batch]),
-                'sparse_depth': torch.stack([i['sparse_depth'] for i in batch]),
-                'depth_full': torch.stack([i['depth_full'] for i in batch]),
-                'k_nn_indices': torch.stack([i['k_nn_indices'] for i in batch]),
-                'sparse_depth_gt': torch.stack([i['sparse_depth_gt'] for i in batch])
-            }
-        return collate_fn
\ No newline at end of file
+            if decoded:
+                # Augmented after the transfer, see on_after_batch_transfer
+                return stack_decoded(refill(batch), stack_batch)
+            return stack_batch(refill(batch))
+        return collate_fn
+
+    def on_after_batch_transfer(self, batch, dataloader_idx):
+        if not self.batch_augment:
+            return scale_batch(batch, DEPTH_SCALE, self.cfg.VKITTI_DATASET.DEPTH.MAX_DEPTH)
+        trainer = getattr(self, "trainer", None)
+        return self.augment_batch(batch, train=trainer is not None and trainer.training)
+
+    def augment_batch(self, batch, train):
+        """
+        Batch of decoded samples (stack_decoded) augmented on its device, the
+        stack_batch of the samples the dataset transforms would give. The
+        samples whose instances vanish were replaced by collate_fn.
+        """
+        augment = self.train_augment if train else self.val_augment
+        names = [name for name in DECODED_MAPS if name in batch]
+        maps = {name: batch[name] for name in names if not isinstance(batch[name], (tuple, list))}
+        points = {name: batch[name] for name in names if isinstance(batch[name], (tuple, list))}
+        # native depth scaled to float32 here, on the device
+        for name in DEPTH_MAPS:
+            if name in maps:
+                maps[name] = scale_depth(maps[name], DEPTH_SCALE)
+            if name in points:
+                batch_index, coordinates, values = points[name]
+                points[name] = (batch_index, coordinates, scale_depth(values, DEPTH_SCALE))
+        image, maps = augment(batch["image"], maps, points)
+
+        out = {
+            'image': image,
+            'image_id': batch['image_id'],
+            'basename': batch['basename']
+        }
+        if "semantic_mask" in maps:
+            out['semantic'] = maps["semantic_mask"].long()
+
+        if "instance_ids" in maps:
+            instances = []
+            for instance_ids, labels in zip(maps["instance_ids"], batch['labels']):
+                instance_masks, boxes, classes = instances_from_ids_tensor(instance_ids, labels)
+                instance = Instances(tuple(image.shape[-2:]))
+                instance.gt_masks = BitMasks(instance_masks)
+                instance.gt_classes = classes
+                instance.gt_boxes = Boxes(boxes)
+                instances.append(instance)
+            out['instance'] = instances
+
+        if "depth_full" in maps:
+            depth_full = maps["depth_full"]
+            depth_full = depth_full.masked_fill(depth_full >= self.cfg.VKITTI_DATASET.DEPTH.MAX_DEPTH, 0)
+            out['depth_full'] = depth_full.unsqueeze(1)
+
+        if "depth_gt" in maps:
+            out['sparse_depth_gt'] = maps["depth_gt"].unsqueeze(1)
+
+        if "depth_proj" in maps:
+            depth_proj = maps["depth_proj"]
+            points_cache = None if train else self.eval_points_cache
+            if points_cache is None:
+                mask, virtual_lidar, k_nn_indices = sample_batch_points(self.cfg, self.cfg.VKITTI_DATASET, depth_proj, self.modalities)
+            else:
+                # seeded and cached by image id, read back after the first epoch
+                sampled = [sample_points(self.cfg, self.cfg.VKITTI_DATASET, depth, image_id, self.modalities, points_cache)
+                           for depth, image_id in zip(depth_proj, batch['image_id'])]
+                mask = torch.zeros_like(depth_proj, dtype=torch.bool)
+                for i, (imPts, _, _) in enumerate(sampled):
+                    mask[i, imPts[:, 0], imPts[:, 1]] = True
+                virtual_lidar = pad_sequence([virtual_lidar for _, virtual_lidar, _ in sampled], batch_first=True)
+                k_nn_indices = pad_sequence([k_nn_indices for _, _, k_nn_indices in sampled], batch_first=True) if sampled[0][2] is not None else None
+
+            out['virtual_lidar'] = virtual_lidar
+            out['mask'] = mask
+            out['sparse_depth'] = (depth_proj * mask).unsqueeze(1)
+            out['k_nn_indices'] = k_nn_indices
+        return out
+
+
+# Maps of the decoded samples, dense (B x H x W) or point lists
+DECODED_MAPS = ["instance_ids", "depth_full", "depth_gt", "depth_proj", "semantic_mask"]
+# of them the native depth maps
+DEPTH_MAPS = ["depth_full", "depth_gt", "depth_proj"]
+
+
+def stack_decoded(batch, collate):
+    """
+    Decoded samples (dataset transforms None) of the same size: maps stacked
+    by collate (utils/collate.py), point lists (sparse depth) concatenated as
+    (batch_index, coordinates, values)
+    """
+    sample = batch[0]
+    collate.begin_batch()
+    out = {
+        'image': collate.stack('image', [i['image'] for i in batch]),
+        'image_id': [i['image_id'] for i in batch],
+        'basename': [i['basename'] for i in batch]
+    }
+    for name in DECODED_MAPS:
+        if name not in sample:
+            continue
+        if isinstance(sample[name], tuple):
+            out[name] = (
+                torch.cat([torch.full((len(i[name][0]),), b, dtype=torch.int64) for b, i in enumerate(batch)]),
+                torch.cat([i[name][0] for i in batch]),
+                torch.cat([i[name][1] for i in batch])
+            )
+        else:
+            out[name] = collate.stack(name, [i[name] for i in batch])
+    if 'labels' in sample:
+        out['labels'] = [i['labels'] for i in batch]
+    return out
@@ -9,8 +9,11 @@ import albumentations as A
 from albumentations.pytorch import ToTensorV2
 import numpy as np
 import random
-from utils.get_vkitti_files import get_vkitti_files
+from utils.manifest import Manifest, vkitti_key, vkitti_filter
+from utils.knn import k_nearest
 from utils.show_ann import visualize_masks, visualize_bboxes
+from utils.rgb_to_class import rgb_to_class
+from utils.collate import Collate
 from datasets.vkitti_cats import mapping
 import matplotlib.pyplot as plt
 from torchvision.utils import save_image
@@ -39,10 +42,13 @@ class vkittiDataset(torch.utils.data.Dataset):
         self.semantic_root = os.path.join(root, cfg.VKITTI_DATASET.DATASET_PATH.SEMANTIC)
         self.coco = COCO(os.path.join(root, cfg.VKITTI_DATASET.DATASET_PATH.COCO_ANNOTATION))
 
-        self.semantic_imgs = get_vkitti_files(self.semantic_root, exclude, "png")
-        self.depth_full_imgs = get_vkitti_files(self.depth_full_root, exclude, "png")
-        self.depth_gt_imgs = get_vkitti_files(self.depth_gt_root, exclude, "png")
-        self.depth_proj_imgs = get_vkitti_files(self.depth_proj_root, exclude, "png")
+        # Paths of every modality by sample key, see utils/manifest.py
+        self.manifest = Manifest({
+            "semantic": self.semantic_root,
+            "depth_full": self.depth_full_root,
+            "depth_gt": self.depth_gt_root,
+            "depth_proj": self.depth_proj_root
+        }, "png", vkitti_key, vkitti_filter(exclude))
 
         # get ids and shuffle
         self.ids = list(sorted(self.coco.imgs.keys()))
@@ -76,26 +82,13 @@ class vkittiDataset(torch.utils.data.Dataset):
 
     def find_k_nearest(self, lidar_fov):
         k_number = self.cfg.VKITTI_DATASET.DEPTH.K
-        b_lidar_fov = torch.unsqueeze(lidar_fov, dim=0)
-
-        distances = torch.cdist(b_lidar_fov, b_lidar_fov, p=2)
-        _, indices = torch.topk(distances, k_number + 1, dim=2, largest=False)
-        indices = indices[:, :, 1:]  # B x N x 3
-
-        return indices.squeeze_(0).long()
-
-    def mask_to_class(self,mask):
-        target = torch.from_numpy(mask)
-        h,w = target.shape[0],target.shape[1]
-        masks = torch.empty(h, w, dtype=torch.long)
-        target = target.permute(2, 0, 1).contiguous()
-        for k in mapping:
-            idx = (target==torch.tensor(k, dtype=torch.uint8).unsqueeze(1).unsqueeze(2))
-            validx = (idx.sum(0) == 3) 
-            masks[validx] = torch.tensor(mapping[k], dtype=torch.long)
-        I8 = (((masks.cpu().numpy()))).astype(np.uint8)
-        im = Image.fromarray(I8)
-        return im
+        indices = k_nearest(lidar_fov, k_number, self.cfg.VKITTI_DATASET.DEPTH.KNN_BACKEND)  # N x K
+
+        return indices.long()
+
+    def mask_to_class(self, mask):
+        # H x W uint8 class ids, see utils/rgb_to_class.py
+        return rgb_to_class(mask, mapping)
 
     def get_coco_ann(self, index):
 
@@ -112,21 +105,16 @@ class vkittiDataset(torch.utils.data.Dataset):
         # path for input image
         img_filename = coco.loadImgs(img_id)[0]['file_name']
 
-        scene = img_filename.split("/")[-6]
-        weather = img_filename.split("/")[-5]
-        basename = img_filename.split(".")[-2].split("_")[-1]
+        # (scene, weather, camera, frame)
+        key = vkitti_key(img_filename)
 
-        semantic_img_filename = [s for s in self.semantic_imgs if (
-            scene in s and basename in s and weather in s)][0]        
+        semantic_img_filename = self.manifest.get(key, "semantic")
         
-        depth_full_img_filename = [s for s in self.depth_full_imgs if (
-            scene in s and basename in s and weather in s)][0]
+        depth_full_img_filename = self.manifest.get(key, "depth_full")
 
-        depth_gt_img_filename = [s for s in self.depth_gt_imgs if (
-            scene in s and basename in s and weather in s)][0]
+        depth_gt_img_filename = self.manifest.get(key, "depth_gt")
         
-        depth_proj_img_filename = [s for s in self.depth_proj_imgs if (
-            scene in s and basename in s and weather in s)][0]
+        depth_proj_img_filename = self.manifest.get(key, "depth_proj")
         
         semantic_mask = Image.open(semantic_img_filename)
         semantic_mask = self.mask_to_class(np.array(semantic_mask))
@@ -246,7 +234,8 @@ class vkittiDataset(torch.utils.data.Dataset):
         
         imPts = torch.nonzero(depth_proj)
         inds = torch.randperm(imPts.shape[0])
-        imPts = imPts[inds][:self.cfg.VKITTI_DATASET.DEPTH.MAX_DEPTH_POINTS]
+        # Keep the sampled points in row-major order, the order of the points in mask
+        imPts = imPts[torch.sort(inds[:self.cfg.VKITTI_DATASET.DEPTH.MAX_DEPTH_POINTS]).values]
 
         # if imPts.shape[0] < self.max_points:
         #     self.max_points = imPts.shape[0]
@@ -260,7 +249,8 @@ class vkittiDataset(torch.utils.data.Dataset):
         mask = torch.zeros(depth_proj.shape[-2:], dtype=torch.bool)
         mask[imPts[:, 0], imPts[:, 1]] = True
 
-        k_nn_indices = self.find_k_nearest(virtual_lidar)
+        # Left to the depth head with KNN_IN_MODEL
+        k_nn_indices = None if self.cfg.MODEL_CUSTOM.DEPTH_HEAD.KNN_IN_MODEL else self.find_k_nearest(virtual_lidar)
 
         # Remove points from depth_proj to the total number of points = MAX_DEPTH_POINTS
         depth_proj_ = torch.zeros_like(depth_proj)
@@ -338,6 +328,8 @@ def get_datasets(cfg):
         return vkitti_dataset
 
 def collate_fn_wrapper(dataset):
+    # Samples written in place into the batch tensors (utils/collate.py)
+    stack_batch = Collate()
     def collate_fn(batch):
         len_batch = len(batch) # original batch length
         batch = list(filter (lambda x:x["n_instances"] > 0, batch)) # filter out all the Nones
@@ -347,19 +339,7 @@ def collate_fn_wrapper(dataset):
                 new_sample = dataset[np.random.randint(0, len(dataset))]
                 batch.append(new_sample)
             batch = list(filter (lambda x:x["n_instances"] > 0, batch))
-        return {
-            'image': torch.stack([i['image'] for i in batch]),
-            'semantic': torch.as_tensor(np.asarray([i['semantic'] for i in batch])),
-            'instance': [i['instance'] for i in batch],
-            'image_id': [i['image_id'] for i in batch],
-            'basename': [i['basename'] for i in batch],
-            'virtual_lidar': torch.stack([i['virtual_lidar'] for i in batch]),
-            'mask': torch.stack([i['mask'] for i in batch]),
-            'sparse_depth': torch.stack([i['sparse_depth'] for i in batch]),
-            'depth_full': torch.stack([i['depth_full'] for i in batch]),
-            'k_nn_indices': torch.stack([i['k_nn_indices'] for i in batch]),
-            'sparse_depth_gt': torch.stack([i['sparse_depth_gt'] for i in batch])
-        }
+        return stack_batch(batch)
     return collate_fn
 
 
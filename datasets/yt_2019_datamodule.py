@@ -18,6 +18,8 @@ from torch.utils.data import DataLoader
 from detectron2.structures import Instances, BitMasks, Boxes
 
 from utils.show_ann import visualize_masks, visualize_bboxes
+from utils.string_table import StringTable, RaggedTable
+from utils.collate import Collate, BATCH_KEYS, LIST
 import matplotlib.pyplot as plt
 import cv2
 from tqdm import tqdm
@@ -35,26 +37,28 @@ class YoutubeDataset(torch.utils.data.Dataset):
 
         self.transforms = transforms
         self.imgs_root = imgs_root
-        self.ytvos = YTVOS(annotation)
+        # The annotations are only read here, the frames are kept as array
+        # tables (utils/string_table.py)
+        ytvos = YTVOS(annotation)
 
 
-        self.vidIds = self.ytvos.getVidIds()
-        self.videos = self.ytvos.loadVids(ids=self.vidIds)
+        vidIds = ytvos.getVidIds()
+        videos = ytvos.loadVids(ids=vidIds)
 
         if valid_annotation != None:
-            self.ytvos_valid = YTVOS(valid_annotation)
-            self.vidIds_valid = self.ytvos_valid.getVidIds()
-            self.videos_valid = self.ytvos_valid.loadVids(ids=self.vidIds_valid)
+            ytvos_valid = YTVOS(valid_annotation)
+            vidIds_valid = ytvos_valid.getVidIds()
+            videos_valid = ytvos_valid.loadVids(ids=vidIds_valid)
 
-            self.videos = list(filter(lambda video: video not in self.videos_valid, self.videos))
+            videos = list(filter(lambda video: video not in videos_valid, videos))
 
 
-        self.frames = []
-        for video in self.videos:
+        frames = []
+        for video in videos:
             file_names = video["file_names"]
             video_id = video["id"]
-            annIds = self.ytvos.getAnnIds(vidIds=[video_id])
-            anns = self.ytvos.loadAnns(ids=annIds)
+            annIds = ytvos.getAnnIds(vidIds=[video_id])
+            anns = ytvos.loadAnns(ids=annIds)
 
             num_objs = len(anns)
             video_cats = [anns[i]["category_id"] for i in range(num_objs)]
@@ -85,7 +89,7 @@ class YoutubeDataset(torch.utils.data.Dataset):
                         video_iscrowd[j] for j in range(len(frame_anns))
                     ]
 
-                    self.frames.append({
+                    frames.append({
                         "file_name": file_name,
                         "anns": frame_anns,
                         "frame_cats": frame_cats,
@@ -97,27 +101,40 @@ class YoutubeDataset(torch.utils.data.Dataset):
 
         if shuffle_frames:
             print("Shuffling frames")
-            random.Random(4).shuffle(self.frames)
+            random.Random(4).shuffle(frames)
 
         if n_samples != None:
-            self.frames = self.frames[:n_samples]
+            frames = frames[:n_samples]
+
+        # Compressed RLE of every annotation, the masks of frame i are the
+        # rows self.rle_sizes.offsets[i]:self.rle_sizes.offsets[i + 1]
+        rles = [mask.frPyObjects(rle, rle['size'][0], rle['size'][1]) for frame in frames for rle in frame["anns"]]
+        self.rle_counts = StringTable([rle["counts"] for rle in rles])
+        self.rle_sizes = RaggedTable([[rle['size'] for rle in frame["anns"]] for frame in frames], np.int64, (2,))
+
+        self.file_names = StringTable([frame["file_name"] for frame in frames])
+        self.video_ids = np.array([frame["video_id"] for frame in frames], dtype=np.int64)
+        self.frame_cats = RaggedTable([frame["frame_cats"] for frame in frames], np.int64)
+        self.bboxes = RaggedTable([frame["bboxes"] for frame in frames], np.float64, (4,))
+        self.areas = RaggedTable([frame["areas"] for frame in frames], np.float64)
+        self.iscrowd = RaggedTable([frame["iscrowd"] for frame in frames], np.int64)
 
     def __getitem__(self, index):
 
-        frame = self.frames[index]
         boxes = [[box[0], box[1], box[0] + box[2], box[1] + box[3]]
-                 for box in frame["bboxes"]]
-        labels = frame["frame_cats"]
-        areas = frame["areas"]
-        iscrowd = frame["iscrowd"]
-        video_id = frame["video_id"]
+                 for box in self.bboxes[index].tolist()]
+        labels = self.frame_cats[index].tolist()
+        areas = self.areas[index].tolist()
+        iscrowd = self.iscrowd[index].tolist()
+        video_id = int(self.video_ids[index])
+        rows = range(self.rle_sizes.offsets[index], self.rle_sizes.offsets[index + 1])
         masks = [
-            mask.decode(mask.frPyObjects(rle, rle['size'][0], rle['size'][1]))
-            for rle in frame["anns"]
+            mask.decode({"size": size.tolist(), "counts": self.rle_counts[row].encode("utf-8")})
+            for size, row in zip(self.rle_sizes[index], rows)
         ]
 
         img_filename = os.path.join(os.path.dirname(
-            os.path.abspath(__file__)), "..", self.imgs_root, frame["file_name"])
+            os.path.abspath(__file__)), "..", self.imgs_root, self.file_names[index])
         
         basename = img_filename.split(".")[-2].split("/")[-2]
         source_img = np.asarray(Image.open(img_filename))
@@ -155,7 +172,7 @@ class YoutubeDataset(torch.utils.data.Dataset):
         }
     
     def __len__(self):
-        return len(self.frames)
+        return len(self.file_names)
 
 def get_train_transforms(cfg):
 
@@ -285,6 +302,8 @@ class YoutubeDataModule(LightningDataModule):
 
     @staticmethod
     def collate_fn_wrapper(dataset):
+        # Samples written in place into the batch tensors (utils/collate.py)
+        stack_batch = Collate(dict(BATCH_KEYS, video_id=LIST), pin=True)
         def collate_fn(batch):
             len_batch = len(batch) # original batch length
             batch = list(filter (lambda x:x["n_instances"] > 0, batch)) # filter out all the Nones
@@ -294,11 +313,5 @@ class YoutubeDataModule(LightningDataModule):
                     new_sample = dataset[np.random.randint(0, len(dataset))]
                     batch.append(new_sample)
                 batch = list(filter (lambda x:x["n_instances"] > 0, batch))
-            return {
-                'image': torch.stack([i['image'] for i in batch]),
-                'instance': [i['instance'] for i in batch],
-                'video_id': [i['video_id'] for i in batch],
-                'image_id': [i['image_id'] for i in batch],
-                'basename': [i['basename'] for i in batch]
-            }
+            return stack_batch(batch)
         return collate_fn
\ No newline at end of file
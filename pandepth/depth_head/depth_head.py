@@ -2,11 +2,74 @@ import torch
 from torch import nn
 import torch.nn.functional as F
 from pandepth.utils import DepthwiseSeparableConv as depth_wise_conv
-from pandepth.utils import ContinuousConvolution
+from pandepth.utils import ContinuousConvolution, neighbor_geometry, batched_knn, checkpoint_blocks
 from inplace_abn import InPlaceABN
 
 
 
+def mask_to_pixel_indices(mask, ragged=False):
+    """
+    Flat H*W position of the points of every sample, in the row-major order
+    of feats.permute(0, 2, 3, 1)[mask]. Computed once per batch.
+    mask: B x H x W
+    ragged: the samples may have a different number of points, they are
+    padded to the largest one
+    output:
+    pixel_indices: B x N
+    point_mask: B x N, False for the padding (None if not ragged)
+    """
+    B = mask.size(0)
+    if not ragged:
+        return mask.view(B, -1).nonzero()[:, 1].view(B, -1), None
+
+    batch_idx, pixel_idx = mask.view(B, -1).nonzero(as_tuple=True)
+    lengths = torch.bincount(batch_idx, minlength=B)
+    N = int(lengths.max()) if B > 0 else 0
+    starts = torch.cumsum(lengths, 0) - lengths
+    position = torch.arange(batch_idx.size(0), device=mask.device) - starts[batch_idx]
+
+    pixel_indices = torch.zeros((B, N), dtype=torch.long, device=mask.device)
+    pixel_indices[batch_idx, position] = pixel_idx
+    point_mask = torch.arange(N, device=mask.device)[None, :] < lengths[:, None]
+    return pixel_indices, point_mask
+
+
+def working_pixel_indices(pixel_indices, width, scale):
+    """
+    Flat positions of the points on the H/scale x W/scale working grid, from
+    their flat positions on the H x W grid. Several points may share a
+    working pixel.
+    pixel_indices: B x N
+    output: B x N
+    """
+    working_width = -(-width // scale)
+    return (pixel_indices // width // scale) * working_width + (pixel_indices % width) // scale
+
+
+def gather_points(feats, pixel_indices):
+    """
+    Dense to point layout.
+    feats: B x C x H x W
+    pixel_indices: B x N
+    output: B x N x C
+    """
+    C = feats.size(1)
+    index = pixel_indices.unsqueeze(1).expand(-1, C, -1)
+    return torch.gather(feats.flatten(2), 2, index).transpose(1, 2)
+
+
+def scatter_points(out, point_feats, pixel_indices):
+    """
+    Point to dense layout, point features are added in place to out.
+    out: B x C x H x W
+    point_feats: B x N x C
+    pixel_indices: B x N
+    """
+    C = out.size(1)
+    index = pixel_indices.unsqueeze(1).expand(-1, C, -1)
+    return out.flatten(2).scatter_add_(2, index, point_feats.transpose(1, 2)).view_as(out)
+
+
 class Two_D_Branch(nn.Module):
     def __init__(self, backbone_out_channels):
         super(Two_D_Branch, self).__init__()
@@ -38,26 +101,40 @@ class Two_D_Branch(nn.Module):
 
 
 class Three_D_Branch(nn.Module):
-    def __init__(self, n_feat, k_number, n_points=None):
+    def __init__(self, n_feat, k_number, n_points=None, ragged=False):
         super(Three_D_Branch, self).__init__()
 
         self.branch_3d_continuous = nn.Sequential(
-            ContinuousConvolution(n_feat, k_number, n_points),
-            ContinuousConvolution(n_feat, k_number, n_points)
+            ContinuousConvolution(n_feat, k_number, n_points, ragged=ragged),
+            ContinuousConvolution(n_feat, k_number, n_points, ragged=ragged)
         )
 
-    def forward(self, feats, mask, coors, indices):
+    def forward(self, feats, mask, coors, indices, geometry=None, pixel_indices=None):
         """
         mask: B x H x W
         feats: B x C x H x W
         coors: B x N x 3 (points coordinates)
         indices: B x N x K (knn indices, aka. mask_knn)
+        geometry: neighbor_geometry(coors, indices), shared by all the blocks
+        pixel_indices: mask_to_pixel_indices(mask), point layout mode. The
+        output is then left in point layout (B x N x C), with the padding
+        points of ragged batches zeroed
         """
 
         B, C, _, _ = feats.shape
+
+        if pixel_indices is not None:
+            feats_points = gather_points(feats, pixel_indices)  # B x N x C
+            br_3d, _, _, _ = self.branch_3d_continuous(
+                (feats_points, coors, indices, geometry))  # B x N x C
+            point_mask = geometry[2] if geometry is not None else None
+            if point_mask is not None:
+                br_3d = br_3d * point_mask.unsqueeze(-1).to(br_3d.dtype)
+            return br_3d
+
         feats_mask = feats.permute(0, 2, 3, 1)[mask].view(B, -1, C)
-        br_3d, _, _ = self.branch_3d_continuous(
-            (feats_mask, coors, indices))  # B x N x C
+        br_3d, _, _, _ = self.branch_3d_continuous(
+            (feats_mask, coors, indices, geometry))  # B x N x C
         br_3d = br_3d.view(-1, C)  # B*N x C
 
         out = torch.zeros_like(feats.permute(0, 2, 3, 1))  # B x H x W x C
@@ -68,13 +145,19 @@ class Three_D_Branch(nn.Module):
 
 
 class FuseBlock(nn.Module):
-    def __init__(self, nin, nout, k_number, n_points=None, extra_output_layer=False):
+    def __init__(self, nin, nout, k_number, n_points=None, extra_output_layer=False, ragged=False):
+        """
+        inputs and outputs are tuples of
+        (feats, mask, coors, k_nn_indices, geometry, pixel_indices)
+        pixel_indices is None unless the head runs in point layout mode
+        ragged: variable number of points per sample (requires point layout)
+        """
         super(FuseBlock, self).__init__()
 
         self.extra_output_layer = extra_output_layer
         self.branch_2d = Two_D_Branch(nin)
 
-        self.branch_3d = Three_D_Branch(nin, k_number, n_points)
+        self.branch_3d = Three_D_Branch(nin, k_number, n_points, ragged=ragged)
 
         self.output_layer = nn.Sequential(
             # depth_wise_conv(backbone_out_channels, kernel_size=3, stride=1, padding=1),
@@ -89,27 +172,62 @@ class FuseBlock(nn.Module):
         # feats: B x C x H x W
         # coors: B x N x 3 (points coordinates)
         # indices: B x N x K (knn indices, aka. mask_knn)
+        # geometry: neighbor_geometry(coors, indices)
+        # pixel_indices: B x N (mask_to_pixel_indices(mask), point layout mode)
 
-        feats, mask, coors, k_nn_indices = inputs[0]
-        y = self.branch_3d(feats, mask, coors, k_nn_indices) + \
-            self.branch_2d(feats)
+        feats, mask, coors, k_nn_indices, geometry, pixel_indices = inputs[0]
+        if pixel_indices is None:
+            y = self.branch_3d(feats, mask, coors, k_nn_indices, geometry) + \
+                self.branch_2d(feats)
+        else:
+            # 3D branch stays in point layout and is added to the 2D branch at the points only
+            y = scatter_points(self.branch_2d(feats),
+                self.branch_3d(feats, mask, coors, k_nn_indices, geometry, pixel_indices),
+                pixel_indices)
 
         y = F.relu(self.output_layer(y))
 
         if self.extra_output_layer:
             y = y + feats
-            return (y, mask, coors, k_nn_indices)
+            return (y, mask, coors, k_nn_indices, geometry, pixel_indices)
 
-        return (y, mask, coors, k_nn_indices)
+        return (y, mask, coors, k_nn_indices, geometry, pixel_indices)
 
 
 class DepthHead(nn.Module):
     def __init__(self, k_number,
                  num_classes=0, #including background
-                 n_points=None):
+                 n_points=None,
+                 point_layout=False,
+                 ragged=False,
+                 knn_chunk_size=1024,
+                 working_scale=1,
+                 checkpoint_segments=0):
 
         super(DepthHead, self).__init__()
 
+        # Keep the 3D branches in B x N x C point layout instead of scattering
+        # them into a dense zero filled B x H x W x C map in every block
+        self.point_layout = point_layout or ragged or working_scale > 1
+
+        # Variable number of points per sample, padded in the collate. The
+        # padding is tracked with a point mask derived from mask
+        self.ragged = ragged
+
+        # The FuseBlocks run at H/working_scale x W/working_scale, the fused
+        # features are upsampled before output_layer. Several points may then
+        # fall in one working pixel, which requires the point layout
+        self.working_scale = working_scale
+
+        # Training only: fuse_conv is split in checkpoint_segments segments whose
+        # activations are recomputed in backward instead of being stored (0: off)
+        self.checkpoint_segments = checkpoint_segments
+
+        # k_nn_indices may be left to the head (see forward), searched in
+        # chunks of knn_chunk_size query points
+        self.k_number = k_number
+        self.knn_chunk_size = knn_chunk_size
+
         # Depth completion ------------------
 
         # Depth head---------------------------------------------------------------
@@ -138,29 +256,29 @@ class DepthHead(nn.Module):
         )
 
         self.fuse_conv = nn.Sequential(
-            FuseBlock(48, 64, k_number, n_points=n_points),
+            FuseBlock(48, 64, k_number, n_points=n_points, ragged=ragged),
             FuseBlock(64, 64, k_number, n_points=n_points,
-                      extra_output_layer=True),
+                      extra_output_layer=True, ragged=ragged),
             FuseBlock(64, 64, k_number, n_points=n_points,
-                      extra_output_layer=True),
+                      extra_output_layer=True, ragged=ragged),
             FuseBlock(64, 64, k_number, n_points=n_points,
-                      extra_output_layer=True),
+                      extra_output_layer=True, ragged=ragged),
             FuseBlock(64, 64, k_number, n_points=n_points,
-                      extra_output_layer=True),
+                      extra_output_layer=True, ragged=ragged),
             FuseBlock(64, 64, k_number, n_points=n_points,
-                      extra_output_layer=True),
+                      extra_output_layer=True, ragged=ragged),
             FuseBlock(64, 64, k_number, n_points=n_points,
-                      extra_output_layer=True),
+                      extra_output_layer=True, ragged=ragged),
             FuseBlock(64, 64, k_number, n_points=n_points,
-                      extra_output_layer=True),
+                      extra_output_layer=True, ragged=ragged),
             FuseBlock(64, 64, k_number, n_points=n_points,
-                      extra_output_layer=True),
+                      extra_output_layer=True, ragged=ragged),
             FuseBlock(64, 64, k_number, n_points=n_points,
-                      extra_output_layer=True),
+                      extra_output_layer=True, ragged=ragged),
             FuseBlock(64, 64, k_number, n_points=n_points,
-                      extra_output_layer=True),
+                      extra_output_layer=True, ragged=ragged),
             FuseBlock(64, 64, k_number, n_points=n_points,
-                      extra_output_layer=True)
+                      extra_output_layer=True, ragged=ragged)
         )
 
         self.output_layer = nn.Sequential(
@@ -180,7 +298,7 @@ class DepthHead(nn.Module):
         sparse_depth: input sparse depth (B x 1 x H x W)
         coors: sparse 3D points (B x 3 x N)
         mask: mask_2d3d (B x H x W)
-        indices: mask_knn (B x N x K)
+        indices: mask_knn (B x N x K), None to search them here for the whole batch
         semantic_logits: (B x C x H x W)
         output:
         depth: completed depth
@@ -203,10 +321,36 @@ class DepthHead(nn.Module):
 
         y_rgbd_cat_y_sparse = torch.cat((y_rgbd, y_sparse), dim=1)
 
-        y_rgbd_cat_y_sparse = F.interpolate(y_rgbd_cat_y_sparse, (H, W))
+        scale = self.working_scale
+        y_rgbd_cat_y_sparse = F.interpolate(y_rgbd_cat_y_sparse, (-(-H // scale), -(-W // scale)))
+
+        # Flat scatter/gather index of the points, computed once for the 12 blocks
+        if self.point_layout:
+            pixel_indices, point_mask = mask_to_pixel_indices(mask, self.ragged)
+            if scale > 1:
+                pixel_indices = working_pixel_indices(pixel_indices, W, scale)
+        else:
+            pixel_indices, point_mask = None, None
+
+        if k_nn_indices is None:
+            k_nn_indices = batched_knn(coors, self.k_number, point_mask, self.knn_chunk_size)
 
-        fused, _, _, _ = self.fuse_conv(
-            (y_rgbd_cat_y_sparse, mask, coors, k_nn_indices))
+        # Point coordinates on the working grid
+        if scale > 1:
+            coors = coors / coors.new_tensor([scale, scale, 1])
+
+        # Relative neighbor offsets and gather index, computed once for the 24 continuous convolutions
+        geometry = neighbor_geometry(coors, k_nn_indices, point_mask)
+
+        if self.checkpoint_segments > 0 and self.training and torch.is_grad_enabled():
+            fused = self.checkpointed_fuse_conv(
+                y_rgbd_cat_y_sparse, mask, coors, k_nn_indices, geometry, pixel_indices)
+        else:
+            fused, _, _, _, _, _ = self.fuse_conv(
+                (y_rgbd_cat_y_sparse, mask, coors, k_nn_indices, geometry, pixel_indices))
+
+        if scale > 1:
+            fused = F.interpolate(fused, (H, W), mode="bilinear", align_corners=False)
 
         fused_out = self.output_layer(fused)
 
@@ -216,6 +360,11 @@ class DepthHead(nn.Module):
             return fused_out, {}
 
 
+    def checkpointed_fuse_conv(self, feats, mask, coors, k_nn_indices, geometry, pixel_indices):
+        # fuse_conv with activation checkpointing, see checkpoint_blocks
+        return checkpoint_blocks(list(self.fuse_conv), (feats, mask, coors, k_nn_indices, geometry, pixel_indices),
+                                 self.checkpoint_segments)
+
     def loss(self, inputs, targets):
         
         out = torch.squeeze(inputs, 1)
@@ -22,6 +22,9 @@ class EffificientPS(pl.LightningModule):
     EfficientPS model see http://panoptic.cs.uni-freiburg.de/
     Here pytorch lightningis used https://pytorch-lightning.readthedocs.io/en/latest/
     """
+    # Dataset outputs used by the model (utils/modalities.py)
+    MODALITIES = frozenset(["image", "semantic", "instance"])
+
 
     def __init__(self, cfg, categories):
         """
@@ -10,6 +10,9 @@ class Depth(pl.LightningModule):
     EfficientPS model see http://panoptic.cs.uni-freiburg.de/
     Here pytorch lightningis used https://pytorch-lightning.readthedocs.io/en/latest/
     """
+    # Dataset outputs used by the model (utils/modalities.py)
+    MODALITIES = frozenset(["image", "sparse_depth", "depth_gt", "knn"])
+
 
     def __init__(self, cfg):
         """
@@ -23,11 +26,21 @@ class Depth(pl.LightningModule):
         if cfg.DATASET_TYPE == "forest":
             self.depth_head = DepthHead(
                 cfg.FOREST_DATASET.DEPTH.K, 
-                n_points=cfg.FOREST_DATASET.DEPTH.MAX_DEPTH_POINTS)
+                n_points=cfg.FOREST_DATASET.DEPTH.MAX_DEPTH_POINTS,
+                point_layout=cfg.MODEL_CUSTOM.DEPTH_HEAD.POINT_LAYOUT,
+                ragged=cfg.MODEL_CUSTOM.DEPTH_HEAD.RAGGED,
+                knn_chunk_size=cfg.MODEL_CUSTOM.DEPTH_HEAD.KNN_CHUNK_SIZE,
+                working_scale=cfg.MODEL_CUSTOM.DEPTH_HEAD.WORKING_SCALE,
+                checkpoint_segments=cfg.MODEL_CUSTOM.DEPTH_HEAD.CHECKPOINT_SEGMENTS)
         elif cfg.DATASET_TYPE == "vkitti2":
             self.depth_head = DepthHead(
                 cfg.VKITTI_DATASET.DEPTH.K, 
-                n_points=cfg.VKITTI_DATASET.DEPTH.MAX_DEPTH_POINTS)
+                n_points=cfg.VKITTI_DATASET.DEPTH.MAX_DEPTH_POINTS,
+                point_layout=cfg.MODEL_CUSTOM.DEPTH_HEAD.POINT_LAYOUT,
+                ragged=cfg.MODEL_CUSTOM.DEPTH_HEAD.RAGGED,
+                knn_chunk_size=cfg.MODEL_CUSTOM.DEPTH_HEAD.KNN_CHUNK_SIZE,
+                working_scale=cfg.MODEL_CUSTOM.DEPTH_HEAD.WORKING_SCALE,
+                checkpoint_segments=cfg.MODEL_CUSTOM.DEPTH_HEAD.CHECKPOINT_SEGMENTS)
 
         self.valid_acc = MeanSquaredError(squared=False)
     
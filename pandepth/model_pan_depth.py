@@ -22,6 +22,9 @@ class Pan_Depth(pl.LightningModule):
     EfficientPS model see http://panoptic.cs.uni-freiburg.de/
     Here pytorch lightningis used https://pytorch-lightning.readthedocs.io/en/latest/
     """
+    # Dataset outputs used by the model (utils/modalities.py)
+    MODALITIES = frozenset(["image", "semantic", "instance", "sparse_depth", "depth_gt", "knn"])
+
 
     def __init__(self, cfg, categories, lr=None):
         """
@@ -45,7 +48,12 @@ class Pan_Depth(pl.LightningModule):
         self.depth_head = DepthHead(
             cfg.VKITTI_DATASET.DEPTH.K, 
             num_classes=cfg.NUM_CLASS,
-            n_points=cfg.VKITTI_DATASET.DEPTH.MAX_DEPTH_POINTS)
+            n_points=cfg.VKITTI_DATASET.DEPTH.MAX_DEPTH_POINTS,
+            point_layout=cfg.MODEL_CUSTOM.DEPTH_HEAD.POINT_LAYOUT,
+            ragged=cfg.MODEL_CUSTOM.DEPTH_HEAD.RAGGED,
+            knn_chunk_size=cfg.MODEL_CUSTOM.DEPTH_HEAD.KNN_CHUNK_SIZE,
+            working_scale=cfg.MODEL_CUSTOM.DEPTH_HEAD.WORKING_SCALE,
+            checkpoint_segments=cfg.MODEL_CUSTOM.DEPTH_HEAD.CHECKPOINT_SEGMENTS)
         
         self.refine_head = RefineHead(cfg.NUM_CLASS)
 
@@ -14,6 +14,9 @@ class Semantic_Depth(pl.LightningModule):
     EfficientPS model see http://panoptic.cs.uni-freiburg.de/
     Here pytorch lightningis used https://pytorch-lightning.readthedocs.io/en/latest/
     """
+    # Dataset outputs used by the model (utils/modalities.py)
+    MODALITIES = frozenset(["image", "semantic", "sparse_depth", "depth_gt", "knn"])
+
 
     def __init__(self, cfg):
         """
@@ -33,7 +36,12 @@ class Semantic_Depth(pl.LightningModule):
         self.depth_head = DepthHead(
             cfg.VKITTI_DATASET.DEPTH.K, 
             num_classes=cfg.NUM_CLASS,
-            n_points=cfg.VKITTI_DATASET.DEPTH.MAX_DEPTH_POINTS)
+            n_points=cfg.VKITTI_DATASET.DEPTH.MAX_DEPTH_POINTS,
+            point_layout=cfg.MODEL_CUSTOM.DEPTH_HEAD.POINT_LAYOUT,
+            ragged=cfg.MODEL_CUSTOM.DEPTH_HEAD.RAGGED,
+            knn_chunk_size=cfg.MODEL_CUSTOM.DEPTH_HEAD.KNN_CHUNK_SIZE,
+            working_scale=cfg.MODEL_CUSTOM.DEPTH_HEAD.WORKING_SCALE,
+            checkpoint_segments=cfg.MODEL_CUSTOM.DEPTH_HEAD.CHECKPOINT_SEGMENTS)
         
         self.refine_head = RefineHead(cfg.NUM_CLASS)
 
@@ -1,2 +1,3 @@
 from .depthwise_separable_conv import DepthwiseSeparableConv
-from .continous_conv import ContinuousConvolution
\ No newline at end of file
+from .continous_conv import ContinuousConvolution, neighbor_geometry, batched_knn
+from .checkpoint import checkpoint_blocks
\ No newline at end of file
@@ -0,0 +1,45 @@
+import contextlib
+import torch
+from torch.utils import checkpoint as torch_checkpoint
+from torch.utils.checkpoint import checkpoint
+
+
+def checkpoint_blocks(blocks, inputs, segments):
+    """
+    Runs blocks (taking and returning the tuple inputs) in segments whose
+    activations are recomputed in backward, only inputs[0] entering every
+    segment is kept. The other inputs must not require grad.
+
+    The recomputation runs the blocks in training mode again, the buffers of
+    the blocks (running_mean/running_var of InPlaceABN/BatchNorm) are restored
+    after it so they are updated once per step, as without checkpointing.
+    The recomputation must then run to the end of the segment (no early stop).
+    """
+    segment_size = -(-len(blocks) // segments)
+    rest = tuple(inputs[1:])
+
+    def run_segment(segment):
+        calls = []
+
+        def run(feats):
+            # first call: forward, next ones: recomputation in backward
+            saved = [buffer.clone() for block in segment for buffer in block.buffers()] if calls else None
+            calls.append(True)
+            outputs = (feats,) + rest
+            for block in segment:
+                outputs = block(outputs)
+            if saved is not None:
+                with torch.no_grad():
+                    buffers = [buffer for block in segment for buffer in block.buffers()]
+                    for buffer, value in zip(buffers, saved):
+                        buffer.copy_(value)
+            return outputs[0]
+        return run
+
+    # torch < 2.1 has no early stop
+    set_early_stop = getattr(torch_checkpoint, "set_checkpoint_early_stop", None)
+    feats = inputs[0]
+    with set_early_stop(False) if set_early_stop else contextlib.nullcontext():
+        for start in range(0, len(blocks), segment_size):
+            feats = checkpoint(run_segment(blocks[start:start + segment_size]), feats, use_reentrant=False)
+    return feats
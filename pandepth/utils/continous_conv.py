@@ -1,5 +1,175 @@
 import torch
 import torch.nn as nn
+from torch.autograd.function import once_differentiable
+
+
+def flatten_knn_indices(indices, n_points):
+    """
+    Turn per sample knn indices into row indices of the flattened
+    B*N point tensor, so the whole batch can be gathered at once.
+    inputs:
+    + indices: B x N x K (knn indices)
+    + n_points: N
+    outputs:
+    + flat_indices: B*N*K
+    """
+    B = indices.size(0)
+    batch_offsets = torch.arange(B, device=indices.device).view(B, 1, 1) * n_points
+    return (indices + batch_offsets).view(-1)
+
+
+def batched_gather(x, flat_indices, k_number):
+    """
+    Gather the neighbors of every point of every sample with one index_select.
+    inputs:
+    + x: B x N x C
+    + flat_indices: B*N*K (see flatten_knn_indices)
+    outputs:
+    + y: B x N x K x C
+    """
+    B, N, C = x.size()
+    return x.reshape(B * N, C).index_select(0, flat_indices).view(B, N, k_number, C)
+
+
+@torch.no_grad()
+def batched_knn(points, k_number, point_mask=None, chunk_size=1024):
+    """
+    K nearest neighbors of every point of the batch, in one batched search
+    over chunks of query points so only B x chunk_size x N distances are held
+    at once instead of B x N x N.
+    inputs:
+    + points: B x N x 3 (points coordinates)
+    + point_mask: B x N, False for the padding of ragged batches (optional)
+    outputs:
+    + indices: B x N x K, nearest first, the point itself excluded. With
+      fewer than K other valid points the missing neighbors are the point
+      itself, as utils/knn.py
+    """
+    B, N, _ = points.size()
+    indices = torch.arange(N, device=points.device).view(1, N, 1).repeat(B, 1, k_number)
+    k_found = min(k_number, N)
+
+    for start in range(0, N, chunk_size):
+        end = min(start + chunk_size, N)
+        distances = torch.cdist(points[:, start:end], points, compute_mode="donot_use_mm_for_euclid_dist")  # B x n x N
+        rows = torch.arange(end - start, device=points.device)
+        distances[:, rows, rows + start] = float("inf")
+        if point_mask is not None:
+            distances.masked_fill_(~point_mask[:, None, :], float("inf"))
+        k_dist, k_idx = torch.topk(distances, k_found, dim=2, largest=False)
+        own = (rows + start).view(1, -1, 1).expand_as(k_idx)
+        indices[:, start:end, :k_found] = torch.where(torch.isinf(k_dist), own, k_idx)
+
+    return indices
+
+
+def neighbor_geometry(points, indices, point_mask=None):
+    """
+    Neighbor geometry of the point cloud, it only depends on the points and
+    the knn indices so it can be computed once and shared by every
+    continuous convolution of a forward pass.
+    inputs:
+    + points: B x N x 3 (points coordinates)
+    + indices: B x N x K (knn indices)
+    + point_mask: B x N, False for the padding of ragged batches (optional)
+    outputs:
+    + offsets: B x N x K*3 (x_i - x_k, input of the MLP)
+    + flat_indices: B*N*K (see flatten_knn_indices)
+    + point_mask
+    """
+    B, N, _ = points.size()
+    K = indices.size(2)
+    flat_indices = flatten_knn_indices(indices, N)
+    offsets = points[:, :, None, :] - batched_gather(points, flat_indices, K)  # B x N x K x 3
+    return offsets.view(B, N, K * 3), flat_indices, point_mask
+
+
+class MaskedBatchNorm1d(nn.Module):
+    """
+    Batch normalization of B x N x F point features over the feature dim F.
+    Statistics are computed on the valid points of the batch only, so it
+    does not depend on the number of points like BatchNorm1d(N) does.
+    inputs:
+    + x: B x N x F
+    + point_mask: B x N, False for the padding of ragged batches (optional)
+    """
+
+    def __init__(self, n_feat, eps=1e-5):
+        super().__init__()
+        self.eps = eps
+        self.weight = nn.Parameter(torch.ones(n_feat))
+        self.bias = nn.Parameter(torch.zeros(n_feat))
+
+    def forward(self, x, point_mask=None):
+        if point_mask is None:
+            mean = x.mean(dim=(0, 1))
+            var = x.var(dim=(0, 1), unbiased=False)
+        else:
+            valid = point_mask.unsqueeze(-1).to(x.dtype)
+            count = valid.sum().clamp(min=1)
+            mean = (x * valid).sum(dim=(0, 1)) / count
+            var = (((x - mean) * valid) ** 2).sum(dim=(0, 1)) / count
+
+        return (x - mean) / torch.sqrt(var + self.eps) * self.weight + self.bias
+
+
+class NeighborWeightedSum(torch.autograd.Function):
+    """
+    Fused gather and reduce of the continuous convolution:
+    y[b, n] = Sum_k weights[b, n, k] * x[b, indices[b, n, k]]
+
+    The gathered B x N x K x C neighbor features are never materialized,
+    neighbors are gathered one k at a time in forward and backward, so only
+    the MLP weights and the (already alive) point features are saved.
+    inputs:
+    + weights: B x N x K x C (MLP output)
+    + x: B x N x C (points features)
+    + flat_indices: B*N*K (see flatten_knn_indices)
+
+    outputs:
+    + y: B x N x C
+    """
+
+    @staticmethod
+    def forward(ctx, weights, x, flat_indices):
+        B, N, K, C = weights.size()
+        weights_flat = weights.view(B * N, K, C)
+        x_flat = x.reshape(B * N, C)
+        indices = flat_indices.view(B * N, K)
+
+        out = x_flat.new_zeros((B * N, C))
+        for k in range(K):
+            out.addcmul_(weights_flat[:, k], x_flat.index_select(0, indices[:, k].contiguous()))
+
+        ctx.save_for_backward(weights, x, flat_indices)
+        return out.view(B, N, C)
+
+    @staticmethod
+    @once_differentiable
+    def backward(ctx, grad_out):
+        weights, x, flat_indices = ctx.saved_tensors
+        B, N, K, C = weights.size()
+        weights_flat = weights.view(B * N, K, C)
+        x_flat = x.reshape(B * N, C)
+        indices = flat_indices.view(B * N, K)
+        grad_out = grad_out.reshape(B * N, C)
+
+        grad_weights = grad_x = None
+        if ctx.needs_input_grad[0]:
+            grad_weights = torch.empty_like(weights_flat)
+            for k in range(K):
+                torch.mul(grad_out, x_flat.index_select(0, indices[:, k].contiguous()), out=grad_weights[:, k])
+            grad_weights = grad_weights.view(B, N, K, C)
+
+        if ctx.needs_input_grad[1]:
+            grad_x = torch.zeros_like(x_flat)
+            for k in range(K):
+                grad_x.index_add_(0, indices[:, k].contiguous(), grad_out * weights_flat[:, k])
+            grad_x = grad_x.view_as(x)
+
+        return grad_weights, grad_x, None
+
+
 class ContinuousConvolution(nn.Module):
     """
     http://openaccess.thecvf.com/content_cvpr_2018/papers/Wang_Deep_Parametric_Continuous_CVPR_2018_paper.pdf
@@ -8,20 +178,36 @@ class ContinuousConvolution(nn.Module):
     + x: B x N x C (points features)
     + points: B x N x 3 (points coordinates)
     + indices: B x N x K (knn indices)
+    + geometry: optional, output of neighbor_geometry(points, indices)
 
     outputs:
     + y: points features
+
+    fused: reduce the neighbors with NeighborWeightedSum instead of
+    materializing the gathered B x N x K x C features
+    ragged: the number of points N may change between batches and samples
+    (padded, see neighbor_geometry point_mask), the MLP is then normalized
+    over its features with MaskedBatchNorm1d and n_number is not needed
     """
 
-    def __init__(self, n_feat, k_number, n_number=None):
+    def __init__(self, n_feat, k_number, n_number=None, fused=True, ragged=False):
         super().__init__()
 
+        self.fused = fused
+        self.ragged = ragged
+
         self.linear1=nn.Linear(3 * k_number, (n_feat // 2) * k_number)  # B x N x 3*(n_feat//2)
-        self.batch_norm1=nn.BatchNorm1d(n_number, track_running_stats=False)  # B x N(normalize this dim) x 3*(n_feat//2)
+        if ragged:
+            self.batch_norm1=MaskedBatchNorm1d((n_feat // 2) * k_number)  # B x N x 3*(n_feat//2)(normalize this dim)
+        else:
+            self.batch_norm1=nn.BatchNorm1d(n_number, track_running_stats=False)  # B x N(normalize this dim) x 3*(n_feat//2)
         self.relu1=nn.ReLU()
 
         self.linear2=nn.Linear((n_feat // 2) * k_number, n_feat * k_number)  # B x N x n_feat*k_number
-        self.batch_norm2=nn.BatchNorm1d(n_number, track_running_stats=False)  # B x N(again, norm this dim) x n_feat*k_number
+        if ragged:
+            self.batch_norm2=MaskedBatchNorm1d(n_feat * k_number)  # B x N x n_feat*k_number(normalize this dim)
+        else:
+            self.batch_norm2=nn.BatchNorm1d(n_number, track_running_stats=False)  # B x N(again, norm this dim) x n_feat*k_number
         self.relu2=nn.ReLU()
 
 
@@ -32,26 +218,27 @@ class ContinuousConvolution(nn.Module):
         x: B x N x C (points features)
         points: B x N x 3 (points coordinates)
         indices: B x N x K (knn indices)
+        geometry (optional): (offsets, flat_indices, point_mask) from neighbor_geometry
         """
-        x, points, indices = inputs[0]
+        x, points, indices = inputs[0][:3]
+        geometry = inputs[0][3] if len(inputs[0]) > 3 else None
         B, N, C = x.size()
         K = indices.size(2)
 
-        y1 = torch.cat([points[i, indices[i]] for i in range(B)], dim=0)
-        y1 = y1.view(B,N,K,3)  # B x N x K x 3
-        y1 = points[:, :, None, :] - y1  # B x N x K x 3
-        y1 = y1.view(B, N, K * 3)   # B x N x K*3 
+        if geometry is None:
+            geometry = neighbor_geometry(points, indices)
+        y1, flat_indices, point_mask = geometry  # B x N x K*3, B*N*K, B x N
         
         if self.training:
             # y1 = self.mlp(y1).view(B, N, K, C)  # reshape after mlp B x N x K x C
 
             # ----
             y1 = self.linear1(y1)
-            y1 = self.batch_norm1(y1)
+            y1 = self.batch_norm1(y1, point_mask) if self.ragged else self.batch_norm1(y1)
             y1 = self.relu1(y1)
 
             y1 = self.linear2(y1)
-            y1 = self.batch_norm2(y1)
+            y1 = self.batch_norm2(y1, point_mask) if self.ragged else self.batch_norm2(y1)
             y1 = self.relu2(y1).view(B, N, K, C)  # reshape after mlp B x N x K x C
 
         if not self.training:
@@ -63,6 +250,10 @@ class ContinuousConvolution(nn.Module):
             y1 = self.linear2(y1)
             y1 = self.relu2(y1).view(B, N, K, C)  # reshape after mlp B x N x K x C
 
-        y2 = torch.cat([x[i, indices[i]] for i in range(B)], dim=0).view(B, N, K, C)  # B x N x K x C
+        if self.fused:
+            return NeighborWeightedSum.apply(y1, x, flat_indices), points, indices, geometry
+
+        y2 = batched_gather(x, flat_indices, K)  # B x N x K x C
         # print("y2 ,,", y2.shape)
-        return torch.sum(y1 * y2, dim=2), points, indices
\ No newline at end of file
+        return torch.sum(y1 * y2, dim=2), points, indices, geometry
+
@@ -0,0 +1,49 @@
+import os
+import importlib.util
+import torch
+from torch import nn
+
+# pandepth/utils/checkpoint.py alone, the pandepth package imports the models
+spec = importlib.util.spec_from_file_location(
+    "checkpoint_blocks", os.path.join(os.path.dirname(__file__), "..", "pandepth", "utils", "checkpoint.py"))
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+checkpoint_blocks = module.checkpoint_blocks
+
+
+class Block(nn.Module):
+    # tuple in, tuple out, as the FuseBlocks
+    def __init__(self, channels):
+        super().__init__()
+        self.conv = nn.Conv2d(channels, channels, 3, padding=1)
+        self.norm = nn.BatchNorm2d(channels)
+
+    def forward(self, inputs):
+        feats, mask = inputs
+        return torch.relu(self.norm(self.conv(feats))) * mask, mask
+
+
+def run(segments):
+    torch.manual_seed(0)
+    blocks = nn.ModuleList([Block(4) for _ in range(4)]).train()
+    feats = torch.randn(2, 4, 8, 8, requires_grad=True)
+    mask = (torch.rand(2, 1, 8, 8) > 0.5).float()
+    if segments:
+        out = checkpoint_blocks(list(blocks), (feats, mask), segments)
+    else:
+        out = (feats, mask)
+        for block in blocks:
+            out = block(out)
+        out = out[0]
+    out.sum().backward()
+    return blocks, out, feats.grad
+
+
+def test_running_stats_match_without_checkpointing():
+    reference, out, grad = run(0)
+    for segments in [1, 2, 4]:
+        blocks, out_checkpointed, grad_checkpointed = run(segments)
+        assert torch.allclose(out, out_checkpointed)
+        assert torch.allclose(grad, grad_checkpointed)
+        for buffer, expected in zip(blocks.buffers(), reference.buffers()):
+            assert torch.equal(buffer, expected)
@@ -0,0 +1,81 @@
+import pytest
+import torch
+
+from utils.collate import Collate, Refill
+
+
+def samples(value, batch_size=2):
+    return [{"image": torch.full((3, 4, 5), value + i, dtype=torch.float32),
+             "image_id": value + i,
+             "n_instances": 1} for i in range(batch_size)]
+
+
+def test_ring_keeps_the_previous_batch():
+    collate = Collate(ring=2)
+    first = collate(samples(0))
+    expected = first["image"].clone()
+    second = collate(samples(10))
+    assert torch.equal(first["image"], expected)
+    assert torch.equal(second["image"][1], torch.full((3, 4, 5), 11.0))
+    assert "n_instances" not in first
+
+
+def test_stack_takes_a_slot_per_batch():
+    # as stack_decoded, stacking outside __call__
+    collate = Collate(ring=2)
+    collate.begin_batch()
+    first = collate.stack("image", [sample["image"] for sample in samples(0)])
+    expected = first.clone()
+    collate.begin_batch()
+    collate.stack("image", [sample["image"] for sample in samples(10)])
+    assert torch.equal(first, expected)
+
+
+def test_ring_shorter_than_prefetch():
+    with pytest.raises(ValueError):
+        Collate(ring=1)
+
+
+def test_unknown_output():
+    batch = samples(0)
+    batch[0]["labels"] = [1]
+    with pytest.raises(KeyError):
+        Collate()(batch)
+
+
+def present(sample):
+    return sample["n_instances"] > 0
+
+
+def test_refill_from_the_dataset():
+    dataset = samples(0, batch_size=4)
+    batch = samples(10)
+    batch[1]["n_instances"] = 0
+    refill = Refill(dataset, present)
+    refilled = refill(batch)
+    assert len(refilled) == 2 and all(map(present, refilled))
+    assert refill.misses == 1
+
+
+class Stream(torch.utils.data.IterableDataset):
+    def __iter__(self):
+        return iter([])
+
+
+def test_refill_from_the_stream():
+    refill = Refill(Stream(), present)
+    first = samples(0)
+    assert refill(first) == first
+    batch = samples(10)
+    for sample in batch:
+        sample["n_instances"] = 0
+    refilled = refill(batch)
+    assert [sample["image_id"] for sample in refilled] == [0, 1]
+
+
+def test_refill_nothing_present():
+    batch = samples(0)
+    for sample in batch:
+        sample["n_instances"] = 0
+    with pytest.raises(RuntimeError):
+        Refill(Stream(), present)(batch)
@@ -0,0 +1,57 @@
+import os
+import importlib.util
+import pytest
+import torch
+
+# pandepth/utils/continous_conv.py alone, the pandepth package imports the models
+spec = importlib.util.spec_from_file_location(
+    "continous_conv", os.path.join(os.path.dirname(__file__), "..", "pandepth", "utils", "continous_conv.py"))
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+
+B, N, K, C = 2, 6, 3, 4
+
+
+def knn_inputs(ragged, dtype=torch.float32):
+    torch.manual_seed(0)
+    points = torch.rand(B, N, 3, dtype=dtype)
+    indices = torch.randint(0, N, (B, N, K))
+    point_mask = None
+    if ragged:
+        # second sample with 4 points, its padding points to the first point
+        point_mask = torch.ones(B, N, dtype=torch.bool)
+        point_mask[1, 4:] = False
+        indices[1] = torch.randint(0, 4, (N, K))
+        indices[1, 4:] = 0
+    return points, indices, point_mask
+
+
+@pytest.mark.parametrize("ragged", [False, True])
+def test_neighbor_weighted_sum_gradcheck(ragged):
+    points, indices, _ = knn_inputs(ragged, torch.float64)
+    weights = torch.rand(B, N, K, C, dtype=torch.float64, requires_grad=True)
+    x = torch.rand(B, N, C, dtype=torch.float64, requires_grad=True)
+    flat_indices = module.flatten_knn_indices(indices, N)
+    assert torch.autograd.gradcheck(lambda w, f: module.NeighborWeightedSum.apply(w, f, flat_indices), (weights, x))
+
+
+@pytest.mark.parametrize("ragged", [False, True])
+def test_fused_gradients(ragged):
+    points, indices, point_mask = knn_inputs(ragged)
+    x = torch.rand(B, N, C)
+    outputs, grads = [], []
+    for fused in [False, True]:
+        torch.manual_seed(1)
+        conv = module.ContinuousConvolution(C, K, n_number=N, fused=fused, ragged=ragged)
+        x_fused = x.clone().requires_grad_()
+        geometry = module.neighbor_geometry(points, indices, point_mask)
+        out = conv((x_fused, points, indices, geometry))[0]
+        out.pow(2).sum().backward()
+        outputs.append(out)
+        grads.append([x_fused.grad] + [p.grad for p in conv.parameters()])
+
+    assert torch.allclose(outputs[0], outputs[1], atol=1e-6)
+    # input, linear weights and biases, batch norm weights and biases
+    assert len(grads[1]) == 9
+    for unfused, fused in zip(*grads):
+        assert torch.allclose(unfused, fused, atol=1e-5)
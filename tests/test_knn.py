@@ -0,0 +1,72 @@
+import os
+import importlib.util
+import pytest
+import torch
+
+from utils.knn import k_nearest
+
+# pandepth/utils/continous_conv.py alone, the pandepth package imports the models
+spec = importlib.util.spec_from_file_location(
+    "continous_conv", os.path.join(os.path.dirname(__file__), "..", "pandepth", "utils", "continous_conv.py"))
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+
+K = 8
+
+
+def lattice_points(n, size=32, seed=0):
+    # distinct pixels, integer depths: many equidistant neighbors
+    generator = torch.Generator().manual_seed(seed)
+    pixels = torch.randperm(size * size, generator=generator)[:n]
+    depth = torch.randint(1, 4, (n,), generator=generator).float()
+    return torch.stack([pixels // size, pixels % size, depth], dim=1).float()
+
+
+def exact_distances(points):
+    distances = torch.cdist(points, points, compute_mode="donot_use_mm_for_euclid_dist")
+    distances.fill_diagonal_(float("inf"))
+    return distances
+
+
+def check_neighbors(points, indices, k_number):
+    """
+    The distances of the neighbors are the k smallest ones (any of the
+    equidistant points), the missing neighbors of a small cloud are the
+    point itself.
+    """
+    n = points.size(0)
+    distances = exact_distances(points)
+    n_others = min(k_number, n - 1)
+    reference = torch.topk(distances, n_others, dim=1, largest=False).values
+    found = torch.gather(distances, 1, indices[:, :n_others])
+    assert torch.allclose(found, reference)
+    assert all(len(set(row.tolist())) == n_others for row in indices[:, :n_others])
+    own = torch.arange(n)[:, None].expand(n, k_number - n_others)
+    assert torch.equal(indices[:, n_others:], own)
+
+
+@pytest.mark.parametrize("backend", ["grid", "kdtree", "chunked"])
+@pytest.mark.parametrize("n", [300, 5])
+def test_backends(backend, n):
+    if backend == "kdtree":
+        pytest.importorskip("scipy")
+    points = lattice_points(n)
+    check_neighbors(points, k_nearest(points, K, backend, chunk_size=64), K)
+
+
+def test_grid_off_lattice():
+    # falls back to the exact search
+    points = torch.rand(200, 3) * 10
+    check_neighbors(points, k_nearest(points, K, "grid"), K)
+
+
+def test_batched_knn_padding():
+    counts = [300, 120, 5]
+    points = torch.zeros(len(counts), max(counts), 3)
+    point_mask = torch.zeros(len(counts), max(counts), dtype=torch.bool)
+    for b, n in enumerate(counts):
+        points[b, :n] = lattice_points(n, seed=b)
+        point_mask[b, :n] = True
+    indices = module.batched_knn(points, K, point_mask, chunk_size=64)
+    for b, n in enumerate(counts):
+        check_neighbors(points[b, :n], indices[b, :n], K)
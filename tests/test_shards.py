@@ -0,0 +1,38 @@
+import collections
+from unittest import mock
+import pytest
+import torch
+
+from utils import shards
+from utils.shards import ShardWriter, ShardDataset
+
+
+class Records:
+    def get_sample(self, record):
+        return record["i"]
+
+
+@pytest.fixture
+def root(tmp_path):
+    # 23 records in shards of 4, the kept ones bunched in the first shard
+    writer = ShardWriter(str(tmp_path), "train", samples_per_shard=4)
+    for i in range(23):
+        writer.write({"i": i, "present": {"instances": i < 4 or i % 3 == 0}})
+    writer.close()
+    return str(tmp_path)
+
+
+@pytest.mark.parametrize("world_size", [1, 2, 3])
+@pytest.mark.parametrize("num_workers", [0, 2])
+def test_ranks_split_the_kept_records(root, world_size, num_workers):
+    counts = collections.Counter()
+    for rank in range(world_size):
+        with mock.patch.object(shards, "distributed_info", return_value=(rank, world_size)):
+            dataset = ShardDataset(Records(), root, "train", shuffle=True, buffer_size=3, keep="instances")
+            samples = [int(i) for i in torch.utils.data.DataLoader(dataset, batch_size=None, num_workers=num_workers)]
+            assert len(samples) == len(dataset) == -(-10 // world_size)
+            counts.update(samples)
+
+    assert sorted(counts) == [0, 1, 2, 3, 6, 9, 12, 15, 18, 21]
+    # only the remainder is repeated
+    assert sum(counts.values()) - len(counts) == -(-10 // world_size) * world_size - 10
@@ -50,14 +50,14 @@ def train(args):
 
     #Get dataloaders
     if cfg.DATASET_TYPE == "vkitti2":
-        datamodule = VkittiDataModule(cfg)
+        datamodule = VkittiDataModule(cfg, modalities=EffificientPS.MODALITIES)
         obj_categories = vkitti_cats
         print("Converting dataloader to coco_panoptic json")
         #TODO: Generalize for other datasets
         dataloader_2_coco_panoptic(cfg, datamodule.val_dataloader())
     
     if cfg.DATASET_TYPE == "forest":
-        datamodule = ForestDataModule(cfg)
+        datamodule = ForestDataModule(cfg, modalities=EffificientPS.MODALITIES)
         obj_categories = forest_cats
 
     
@@ -43,10 +43,10 @@ def train(args):
 
     #Get dataloaders
     if cfg.DATASET_TYPE == "vkitti2":
-        datamodule = VkittiDataModule(cfg)
+        datamodule = VkittiDataModule(cfg, modalities=Depth.MODALITIES)
     
     if cfg.DATASET_TYPE == "forest":
-        datamodule = ForestDataModule(cfg)
+        datamodule = ForestDataModule(cfg, modalities=Depth.MODALITIES)
 
     checkpoint_path = cfg.CHECKPOINT_PATH_INFERENCE if (args.predict or args.eval) else cfg.CHECKPOINT_PATH_TRAINING
     
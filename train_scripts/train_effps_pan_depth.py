@@ -45,7 +45,7 @@ def train(args):
 
     #Get dataloaders
     if cfg.DATASET_TYPE == "vkitti2":
-        datamodule = VkittiDataModule(cfg)
+        datamodule = VkittiDataModule(cfg, modalities=Pan_Depth.MODALITIES)
         obj_categories = vkitti_cats
 
     print("Converting dataloader to coco_panoptic json")
@@ -41,7 +41,7 @@ def train(args):
 
     #Get dataloaders
     if cfg.DATASET_TYPE == "vkitti2":
-        datamodule = VkittiDataModule(cfg)
+        datamodule = VkittiDataModule(cfg, modalities=Semantic_Depth.MODALITIES)
 
     checkpoint_path = cfg.CHECKPOINT_PATH_INFERENCE if (args.predict or args.eval) else cfg.CHECKPOINT_PATH_TRAINING
 
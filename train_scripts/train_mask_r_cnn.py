@@ -51,7 +51,7 @@ def train(args):
     _CURRENT_STORAGE_STACK.append(EventStorage())
 
     if cfg.DATASET_TYPE == "vkitti2":
-        datamodule = VkittiDataModule(cfg)
+        datamodule = VkittiDataModule(cfg, modalities=Instance.MODALITIES)
         obj_categories = vkitti_cats
 
     
@@ -73,7 +73,7 @@ def train(args):
         obj_categories = yt_cats
 
     elif cfg.DATASET_TYPE == "forest":
-        datamodule = ForestDataModule(cfg)
+        datamodule = ForestDataModule(cfg, modalities=Instance.MODALITIES)
         obj_categories = forest_cats
 
     checkpoint_path = cfg.CHECKPOINT_PATH_INFERENCE if (args.predict or args.eval) else cfg.CHECKPOINT_PATH_TRAINING
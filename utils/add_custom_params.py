@@ -10,7 +10,21 @@ def add_custom_params(cfg):
     cfg.MODEL_CUSTOM.BACKBONE = CfgNode()
     cfg.MODEL_CUSTOM.BACKBONE.EFFICIENTNET_ID = 5
     cfg.MODEL_CUSTOM.BACKBONE.LOAD_PRETRAIN = False
+    cfg.MODEL_CUSTOM.DEPTH_HEAD = CfgNode()
+    # Keep the continuous convolution features in point layout between the 2D and 3D branches
+    cfg.MODEL_CUSTOM.DEPTH_HEAD.POINT_LAYOUT = False
+    # Variable number of points per sample (padded batches), implies POINT_LAYOUT
+    cfg.MODEL_CUSTOM.DEPTH_HEAD.RAGGED = False
+    # Search the k_nn_indices in the depth head for the whole batch instead of in the dataset workers
+    cfg.MODEL_CUSTOM.DEPTH_HEAD.KNN_IN_MODEL = False
+    cfg.MODEL_CUSTOM.DEPTH_HEAD.KNN_CHUNK_SIZE = 1024
+    # Resolution divisor of the FuseBlock stack (1, 2 or 4), > 1 implies POINT_LAYOUT
+    cfg.MODEL_CUSTOM.DEPTH_HEAD.WORKING_SCALE = 1
+    # Activation checkpointing of the FuseBlock stack in that many segments, 0 to disable
+    cfg.MODEL_CUSTOM.DEPTH_HEAD.CHECKPOINT_SEGMENTS = 0
     # DATASET
+    # Outputs of the datasets (utils/modalities.py) when the model does not set them, empty for all
+    cfg.MODALITIES = []
     cfg.NUM_CLASS = 15
     cfg.MAX_EPOCHS= 40
     # cfg.DATASET_PATH = "/home/ubuntu/Elix/cityscapes"
@@ -49,6 +63,30 @@ def add_custom_params(cfg):
     cfg.VKITTI_DATASET.DEPTH.SPARSITY_TRAINING = 0.05
     cfg.VKITTI_DATASET.DEPTH.SPARSITY_EVAL = 0.2
     cfg.VKITTI_DATASET.DEPTH.MAX_DEPTH_POINTS = 20000
+    # grid, kdtree, chunked or cdist (see utils/knn.py)
+    cfg.VKITTI_DATASET.DEPTH.KNN_BACKEND = "grid"
+    # Directory of the eval/predict points cache (utils/points_cache.py), empty to disable
+    cfg.VKITTI_DATASET.DEPTH.POINTS_CACHE = ""
+    # Sparse depth files: "png" dense maps or "npz" point lists (utils/sparse_depth.py)
+    cfg.VKITTI_DATASET.DEPTH.SPARSE_FORMAT = "png"
+    # Sparse depth points transformed as the "raster" of a nearest neighbor mask or
+    # "project"ed to the transformed image, nearest point per pixel (utils/sparse_depth.py)
+    cfg.VKITTI_DATASET.DEPTH.POINT_TRANSFORM = "raster"
+
+    # Read the semantic masks as uint8 class ids (utils/convert_semantic.py), not color coded
+    cfg.VKITTI_DATASET.SEMANTIC_CLASS_IDS = False
+
+    # Workers only decode, resize/crop/flip/normalize run on the collated batch
+    # on the device of the model (utils/batch_augment.py)
+    cfg.VKITTI_DATASET.BATCH_AUGMENT = False
+
+    # Packed shards of the samples (utils/pack_shards.py), read instead of the dataset files
+    cfg.VKITTI_DATASET.SHARDS = CfgNode()
+    # Directory of the shards, empty to read the dataset files
+    cfg.VKITTI_DATASET.SHARDS.ROOT = ""
+    cfg.VKITTI_DATASET.SHARDS.SAMPLES_PER_SHARD = 256
+    # Records per worker shuffle buffer of the train split
+    cfg.VKITTI_DATASET.SHARDS.SHUFFLE_BUFFER = 64
 
     cfg.VKITTI_DATASET.DATASET_PATH = CfgNode()
     cfg.VKITTI_DATASET.STUFF_CLASSES = 12
@@ -115,6 +153,26 @@ def add_custom_params(cfg):
     cfg.FOREST_DATASET.DEPTH.SPARSITY_TRAINING = 0.05
     cfg.FOREST_DATASET.DEPTH.SPARSITY_EVAL = 0.2
     cfg.FOREST_DATASET.DEPTH.MAX_DEPTH_POINTS = 20000
+    # grid, kdtree, chunked or cdist (see utils/knn.py)
+    cfg.FOREST_DATASET.DEPTH.KNN_BACKEND = "grid"
+    # Directory of the eval/predict points cache (utils/points_cache.py), empty to disable
+    cfg.FOREST_DATASET.DEPTH.POINTS_CACHE = ""
+    # Sparse depth files: "png" dense maps or "npz" point lists (utils/sparse_depth.py)
+    cfg.FOREST_DATASET.DEPTH.SPARSE_FORMAT = "png"
+    # Sparse depth points transformed as the "raster" of a nearest neighbor mask or
+    # "project"ed to the transformed image, nearest point per pixel (utils/sparse_depth.py)
+    cfg.FOREST_DATASET.DEPTH.POINT_TRANSFORM = "raster"
+
+    # Read the semantic masks as uint8 class ids (utils/convert_semantic.py), not color coded
+    cfg.FOREST_DATASET.SEMANTIC_CLASS_IDS = False
+
+    # Packed shards of the samples (utils/pack_shards.py), read instead of the dataset files
+    cfg.FOREST_DATASET.SHARDS = CfgNode()
+    # Directory of the shards, empty to read the dataset files
+    cfg.FOREST_DATASET.SHARDS.ROOT = ""
+    cfg.FOREST_DATASET.SHARDS.SAMPLES_PER_SHARD = 256
+    # Records per worker shuffle buffer of the train split
+    cfg.FOREST_DATASET.SHARDS.SHUFFLE_BUFFER = 64
 
     cfg.FOREST_DATASET.DATASET_PATH = CfgNode()
     cfg.FOREST_DATASET.STUFF_CLASSES = 3
@@ -206,6 +264,10 @@ def add_custom_params(cfg):
     cfg.SOLVER.BASE_LR_PAN = 0.0001
     # Runner
     cfg.BATCH_SIZE = 2
+    # Dataloader worker processes of the datamodules
+    cfg.NUM_WORKERS = 4
+    # Batches of the main process loaders (NUM_WORKERS 0) reused in a ring of at least 2, 0 to allocate every batch (utils/collate.py)
+    cfg.COLLATE_RING = 0
     cfg.CHECKPOINT_PATH_TRAINING = ""
     cfg.CHECKPOINT_PATH_INFERENCE = ""
     cfg.PRECISION = 32
@@ -0,0 +1,150 @@
+"""
+Augmentation of a collated batch with torch ops, on the device of the batch.
+
+With <DATASET>.BATCH_AUGMENT the dataset workers only decode (dataset
+transforms None) and the datamodule applies the transforms of
+get_train_transforms/get_val_transforms to the whole batch in
+on_after_batch_transfer, once per batch instead of once per sample and
+mask:
++ Resize then CenterCrop: the image is resized bilinearly (cv2.INTER_LINEAR,
+  rounded as the uint8 images of albumentations) then cropped. The label
+  and depth maps are gathered at the source pixel of every output pixel,
+  the nearest neighbor of cv2.INTER_NEAREST, resize and crop in one gather.
++ Point lists (sparse depth) have their coordinates mapped as
+  utils/sparse_depth.transform_points (raster or project) and are scattered
+  into dense maps, the nearest point of a pixel with project.
++ HorizontalFlip: one draw per sample, applied to the image and its maps.
++ Normalize: (image - mean * 255) / (std * 255), as A.Normalize.
+The samples of a batch share the size of their source images.
+"""
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+try:
+    from utils.sparse_depth import POINT_TRANSFORMS, nearest_source, nearest_index, project_index
+except ImportError:
+    from sparse_depth import POINT_TRANSFORMS, nearest_source, nearest_index, project_index
+
+
+class BatchAugment:
+    """
+    inputs:
+    + resize, crop: (height, width) of A.Resize then A.CenterCrop
+    + hflip: probability of A.HorizontalFlip, 0 without
+    + mean, std: A.Normalize of the image
+    + point_transform: raster or project, see utils/sparse_depth.py
+    """
+
+    def __init__(self, resize, crop, hflip, mean, std, point_transform="raster", max_pixel_value=255.0):
+        if point_transform not in POINT_TRANSFORMS:
+            raise ValueError("Unknown point transform {}, expected one of {}".format(point_transform, POINT_TRANSFORMS))
+        self.point_transform = point_transform
+        self.resize = tuple(resize)
+        self.crop = tuple(crop)
+        self.hflip = hflip
+        self.mean = torch.as_tensor(mean, dtype=torch.float32).view(1, -1, 1, 1) * max_pixel_value
+        self.std = torch.as_tensor(std, dtype=torch.float32).view(1, -1, 1, 1) * max_pixel_value
+        # index tables by (source size, device)
+        self.tables = {}
+
+    def offsets(self):
+        # (top, left) of the center crop in the resized image
+        return (self.resize[0] - self.crop[0]) // 2, (self.resize[1] - self.crop[1]) // 2
+
+    def index_tables(self, size, device):
+        """
+        Per source size (height, width):
+        + gather: source row/col of every output row/col (maps)
+        + scatter: output row/col of every source row/col, -1 if dropped (points)
+        """
+        key = (size, str(device))
+        if key not in self.tables:
+            gather, scatter = [], []
+            for src, dst, crop, offset in zip(size, self.resize, self.crop, self.offsets()):
+                gather.append(torch.as_tensor(nearest_source(src, dst)[offset:offset + crop], device=device))
+                if self.point_transform == "project":
+                    index = project_index(np.arange(src), src, dst) - offset
+                else:
+                    index = nearest_index(src, dst) - offset
+                index[(index < 0) | (index >= crop)] = -1
+                scatter.append(torch.as_tensor(index, device=device))
+            self.tables[key] = gather, scatter
+        return self.tables[key]
+
+    def keeps_instances(self, instance_ids):
+        # An instance of the H x W id map is left by the resize and crop, exact (the flip keeps every pixel)
+        (rows, cols), _ = self.index_tables(tuple(instance_ids.shape), instance_ids.device)
+        return bool((instance_ids[rows][:, cols] > 0).any())
+
+    def flips(self, batch_size, device):
+        if not self.hflip:
+            return torch.zeros(batch_size, dtype=torch.bool, device=device)
+        return torch.rand(batch_size, device=device) < self.hflip
+
+    def image(self, image):
+        # B x C x H x W, uint8 or float
+        top, left = self.offsets()
+        resized = F.interpolate(image.float(), size=self.resize, mode="bilinear", align_corners=False)
+        if image.dtype == torch.uint8:
+            resized = resized.round_().clamp_(0, 255)
+        return resized[:, :, top:top + self.crop[0], left:left + self.crop[1]]
+
+    def points(self, points, batch_size, size, device):
+        """
+        inputs:
+        + points: (batch_index N, coordinates N x 2 (row, col), values N) of the batch
+        + size: (height, width) of the source maps
+        output: B x h x w dense map of the transformed points, 0 elsewhere
+        """
+        batch_index, coordinates, values = points
+        _, (rows, cols) = self.index_tables(size, device)
+        rows = rows[coordinates[:, 0].long()]
+        cols = cols[coordinates[:, 1].long()]
+        keep = (rows >= 0) & (cols >= 0)
+        dense = torch.zeros((batch_size,) + self.crop, dtype=values.dtype, device=device)
+        if self.point_transform == "project":
+            # nearest point of every pixel
+            pixels = (batch_index[keep] * self.crop[0] + rows[keep]) * self.crop[1] + cols[keep]
+            dense.view(-1).scatter_reduce_(0, pixels, values[keep], reduce="amin", include_self=False)
+        else:
+            dense[batch_index[keep], rows[keep], cols[keep]] = values[keep]
+        return dense
+
+    def __call__(self, image, maps, points=None, flip=None):
+        """
+        inputs:
+        + image: B x C x H x W
+        + maps: {name: B x H x W} label/depth maps, any dtype
+        + points: {name: (batch_index, coordinates, values)}, see points
+        + flip: B bool, drawn with hflip if None
+        outputs:
+        + image: B x C x h x w float32, normalized
+        + maps: {name: B x h x w} of maps and points
+        """
+        batch_size, _, height, width = image.shape
+        device = image.device
+        (rows, cols), _ = self.index_tables((height, width), device)
+
+        out = {name: value[:, rows][:, :, cols] for name, value in maps.items()}
+        for name, value in (points or {}).items():
+            out[name] = self.points(value, batch_size, (height, width), device)
+        image = self.image(image)
+
+        if flip is None:
+            flip = self.flips(batch_size, device)
+        if flip.any():
+            image = torch.where(flip.view(-1, 1, 1, 1), image.flip(-1), image)
+            out = {name: torch.where(flip.view(-1, 1, 1), value.flip(-1), value) for name, value in out.items()}
+
+        image = (image - self.mean.to(device)) / self.std.to(device)
+        return image, out
+
+
+def batch_augment(dataset_cfg, train):
+    # BatchAugment of get_train_transforms (train) or get_val_transforms
+    return BatchAugment((dataset_cfg.RESIZE.HEIGHT, dataset_cfg.RESIZE.WIDTH),
+                        (dataset_cfg.CENTER_CROP.HEIGHT, dataset_cfg.CENTER_CROP.WIDTH),
+                        dataset_cfg.HFLIP if train else 0,
+                        dataset_cfg.NORMALIZE.MEAN, dataset_cfg.NORMALIZE.STD,
+                        point_transform=dataset_cfg.DEPTH.POINT_TRANSFORM)
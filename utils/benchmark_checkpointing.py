@@ -0,0 +1,106 @@
+"""
+Memory report of the activation checkpointing of DepthHead.fuse_conv
+(MODEL_CUSTOM.DEPTH_HEAD.CHECKPOINT_SEGMENTS).
+
+For every number of segments: peak memory and time of a training step
+(forward + backward) at --batch_size, and the largest batch size that fits
+on the GPU, found by doubling then bisecting the batch size.
+
+Run from the repository root:
+python -m utils.benchmark_checkpointing --height 200 --width 1000 --n_points 8000 --segments 0 1 2 3 4 6
+"""
+import time
+import argparse
+import torch
+from pandepth.depth_head import DepthHead
+
+
+def make_batch(batch_size, height, width, n_points, k_number, device):
+    img = torch.rand((batch_size, 3, height, width), device=device)
+    mask = torch.zeros((batch_size, height * width), dtype=torch.bool, device=device)
+    coors = torch.zeros((batch_size, n_points, 3), device=device)
+    for b in range(batch_size):
+        pixels = torch.randperm(height * width, device=device)[:n_points].sort().values
+        mask[b, pixels] = True
+        coors[b, :, 0] = (pixels // width).float()
+        coors[b, :, 1] = (pixels % width).float()
+        coors[b, :, 2] = torch.rand(n_points, device=device) * 50
+    sparse_depth = torch.zeros((batch_size, 1, height * width), device=device)
+    sparse_depth[:, 0][mask] = coors[:, :, 2].reshape(-1)
+    k_nn_indices = torch.randint(0, n_points, (batch_size, n_points, k_number), device=device)
+    return img, sparse_depth.view(batch_size, 1, height, width), mask.view(batch_size, height, width), coors, k_nn_indices
+
+
+def train_step(model, batch):
+    model.zero_grad(set_to_none=True)
+    out, _ = model(*batch)
+    out.mean().backward()
+
+
+def fits(model, args, batch_size, device):
+    try:
+        batch = make_batch(batch_size, args.height, args.width, args.n_points, args.k_number, device)
+        train_step(model, batch)
+        return True
+    except RuntimeError as e:
+        if "out of memory" not in str(e):
+            raise
+        return False
+    finally:
+        model.zero_grad(set_to_none=True)
+        torch.cuda.empty_cache()
+
+
+def max_batch_size(model, args, device):
+    low, high = 0, 1
+    while high <= args.max_batch_size and fits(model, args, high, device):
+        low, high = high, high * 2
+    high = min(high, args.max_batch_size + 1)
+    while high - low > 1:
+        mid = (low + high) // 2
+        if fits(model, args, mid, device):
+            low = mid
+        else:
+            high = mid
+    return low
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Memory report of the DepthHead activation checkpointing")
+    parser.add_argument('--height', type=int, default=200)
+    parser.add_argument('--width', type=int, default=1000)
+    parser.add_argument('--n_points', type=int, default=8000)
+    parser.add_argument('--k_number', type=int, default=3)
+    parser.add_argument('--batch_size', type=int, default=2)
+    parser.add_argument('--max_batch_size', type=int, default=64)
+    parser.add_argument('--segments', type=int, nargs="+", default=[0, 1, 2, 3, 4, 6])
+    parser.add_argument('--point_layout', action='store_true')
+
+    args = parser.parse_args()
+    device = torch.device("cuda")
+    torch.manual_seed(0)
+
+    print("H x W: {} x {}, N: {}, K: {}, batch size: {}".format(
+        args.height, args.width, args.n_points, args.k_number, args.batch_size))
+    print("{:>9} | {:>14} | {:>12} | {:>14}".format("segments", "peak mem (MB)", "step (ms)", "max batch size"))
+
+    for segments in args.segments:
+        model = DepthHead(args.k_number, n_points=args.n_points, point_layout=args.point_layout,
+                          checkpoint_segments=segments).to(device).train()
+
+        batch = make_batch(args.batch_size, args.height, args.width, args.n_points, args.k_number, device)
+        train_step(model, batch)  # warm up
+        torch.cuda.reset_peak_memory_stats(device)
+        torch.cuda.synchronize(device)
+        start = time.perf_counter()
+        train_step(model, batch)
+        torch.cuda.synchronize(device)
+        ms = (time.perf_counter() - start) * 1000
+        peak_mb = torch.cuda.max_memory_allocated(device) / 1024**2
+        del batch
+
+        print("{:>9} | {:>14.1f} | {:>12.1f} | {:>14}".format(
+            "off" if segments == 0 else segments, peak_mb, ms, max_batch_size(model, args, device)))
+
+        del model
+        torch.cuda.empty_cache()
@@ -0,0 +1,157 @@
+"""
+Benchmarks of ContinuousConvolution.
+
+--mode gather: compares the former per sample python loop against the batched
+flat-index gather, for the points (3 channels) and the features (C channels)
+gathers done by every continuous convolution layer.
+
+--mode fused: memory/throughput report of the fused NeighborWeightedSum
+against the unfused gather + torch.sum(y1 * y2) reduction, forward and
+backward. Memory is the size of the tensors saved for backward.
+
+Run from the repository root:
+python -m utils.benchmark_continuous_conv --mode gather --n_points 8000 --k_number 3
+python -m utils.benchmark_continuous_conv --mode fused --device cpu
+"""
+import time
+import argparse
+import torch
+from pandepth.utils.continous_conv import flatten_knn_indices, batched_gather, NeighborWeightedSum
+
+
+def loop_gather(x, indices):
+    # Former implementation, one indexing call per sample
+    B, N, C = x.size()
+    K = indices.size(2)
+    return torch.cat([x[i, indices[i]] for i in range(B)], dim=0).view(B, N, K, C)
+
+
+def flat_gather(x, indices):
+    B, N, C = x.size()
+    K = indices.size(2)
+    return batched_gather(x, flatten_knn_indices(indices, N), K)
+
+
+def time_fn(fn, inputs, device, n_iter, n_warmup=3):
+    for _ in range(n_warmup):
+        fn(*inputs)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(n_iter):
+        fn(*inputs)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / n_iter * 1000
+
+
+def saved_tensors_mb(fn, inputs):
+    # Size of the activations kept alive for backward by fn
+    storages = {}
+
+    def pack(tensor):
+        storage = tensor.untyped_storage() if hasattr(tensor, "untyped_storage") else tensor.storage()
+        storages[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        out = fn(*inputs)
+    return out, sum(storages.values()) / 1024**2
+
+
+def unfused_reduce(weights, x, flat_indices):
+    K = weights.size(2)
+    return torch.sum(weights * batched_gather(x, flat_indices, K), dim=2)
+
+
+def fused_reduce(weights, x, flat_indices):
+    return NeighborWeightedSum.apply(weights, x, flat_indices)
+
+
+def fused_report(args):
+
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    K, C = args.k_number, args.n_feat
+
+    print("device: {}, N: {}, K: {}, C: {}, per layer forward + backward".format(device, args.n_points, K, C))
+    print("{:>4} | {:>14} | {:>14} | {:>12} | {:>12}".format(
+        "B", "unfused (MB)", "fused (MB)", "unfused (ms)", "fused (ms)"))
+
+    for B in args.batch_sizes:
+        indices = torch.randint(0, args.n_points, (B, args.n_points, K), device=device)
+        flat_indices = flatten_knn_indices(indices, args.n_points)
+        # the weights come out of the MLP and the features out of the previous layer
+        weights_init = torch.rand((B, args.n_points, K, C), device=device)
+        x_init = torch.rand((B, args.n_points, C), device=device)
+
+        results = []
+        for reduce_fn in [unfused_reduce, fused_reduce]:
+            weights = weights_init.clone().requires_grad_(True)
+            x = x_init.clone().requires_grad_(True)
+
+            out, saved_mb = saved_tensors_mb(reduce_fn, (weights, x, flat_indices))
+            grad = torch.ones_like(out)
+
+            def step(weights, x, flat_indices):
+                reduce_fn(weights, x, flat_indices).backward(grad)
+
+            results.append((out.detach(), saved_mb, time_fn(step, (weights, x, flat_indices), device, args.n_iter)))
+
+        if not torch.allclose(results[0][0], results[1][0], atol=1e-5):
+            raise AssertionError("fused reduction differs from the unfused one")
+
+        print("{:>4} | {:>14.1f} | {:>14.1f} | {:>12.3f} | {:>12.3f}".format(
+            B, results[0][1], results[1][1], results[0][2], results[1][2]))
+
+
+def benchmark(args):
+
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+
+    print("device: {}, N: {}, K: {}, C: {}".format(device, args.n_points, args.k_number, args.n_feat))
+    print("{:>4} | {:>10} | {:>10} | {:>8}".format("B", "loop (ms)", "flat (ms)", "speedup"))
+
+    for B in args.batch_sizes:
+        points = torch.rand((B, args.n_points, 3), device=device)
+        feats = torch.rand((B, args.n_points, args.n_feat), device=device)
+        indices = torch.randint(0, args.n_points, (B, args.n_points, args.k_number), device=device)
+
+        if not torch.equal(loop_gather(feats, indices), flat_gather(feats, indices)):
+            raise AssertionError("batched gather differs from the loop gather")
+
+        # Each layer gathers the points and the features
+        def run_loop(points, feats, indices):
+            return loop_gather(points, indices), loop_gather(feats, indices)
+
+        def run_flat(points, feats, indices):
+            N = points.size(1)
+            K = indices.size(2)
+            flat_indices = flatten_knn_indices(indices, N)
+            return batched_gather(points, flat_indices, K), batched_gather(feats, flat_indices, K)
+
+        t_loop = time_fn(run_loop, (points, feats, indices), device, args.n_iter)
+        t_flat = time_fn(run_flat, (points, feats, indices), device, args.n_iter)
+
+        print("{:>4} | {:>10.3f} | {:>10.3f} | {:>7.2f}x".format(B, t_loop, t_flat, t_loop / t_flat))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the neighbor gather and reduction of ContinuousConvolution"
+    )
+    parser.add_argument('--mode', type=str, default="gather", choices=["gather", "fused"])
+    parser.add_argument('--batch_sizes', type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    parser.add_argument('--n_points', type=int, default=8000)
+    parser.add_argument('--k_number', type=int, default=3)
+    parser.add_argument('--n_feat', type=int, default=64)
+    parser.add_argument('--n_iter', type=int, default=20)
+    parser.add_argument('--device', type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+
+    args = parser.parse_args()
+
+    if args.mode == "fused":
+        fused_report(args)
+    else:
+        benchmark(args)
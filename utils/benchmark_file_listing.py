@@ -0,0 +1,35 @@
+"""
+Time of the file listings of the dataset constructors: walk of the tree
+(cold, --workers threads) and cached listing (see utils/manifest.py).
+
+Run from the repository root:
+python -m utils.benchmark_file_listing --folders datasets/vkitti2/vkitti_2.0.3_depth datasets/vkitti2/depth_proj --workers 1 8 16
+"""
+import time
+import argparse
+
+from utils.manifest import walk, load_listing
+
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    out = fn(*args, **kwargs)
+    return out, (time.perf_counter() - start) * 1000
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the dataset file listings")
+    parser.add_argument('--folders', type=str, nargs="+", required=True, help="Modality folders")
+    parser.add_argument('--ext', type=str, default="png")
+    parser.add_argument('--workers', type=int, nargs="+", default=[1, 8, 16])
+
+    args = parser.parse_args()
+
+    print("{:>40} | {:>8} | {:>8} | {:>10}".format("folder", "files", "workers", "ms"))
+    for root in args.folders:
+        for workers in args.workers:
+            (files, _), ms = timed(walk, root, args.ext, workers=workers)
+            print("{:>40} | {:>8} | {:>8} | {:>10.1f}".format(root[-40:], len(files), workers, ms))
+        load_listing(root, args.ext)
+        files, ms = timed(load_listing, root, args.ext)
+        print("{:>40} | {:>8} | {:>8} | {:>10.1f}".format(root[-40:], len(files), "cached", ms))
@@ -0,0 +1,85 @@
+"""
+Correctness and speed check of the knn backends (utils/knn.py) against the
+former cdist + topk search, on virtual lidar like points: a random subset of
+the pixels of an H x W image with a depth in [0, MAX_DEPTH).
+
+Neighbors are compared by distance to an exact float64 search. The cdist
+backend computes the distances with a matrix product, which is only
+accurate to about 1e-3 on these coordinates, hence the tolerance, and ranks
+some neighbors wrongly on large point clouds.
+
+Run from the repository root:
+python -m utils.benchmark_knn --height 200 --width 1000 --n_points 8000 --k_number 3
+"""
+import time
+import argparse
+import torch
+from utils.knn import k_nearest, KNN_BACKENDS
+
+
+def virtual_lidar(height, width, n_points, max_depth, smooth):
+    imPts = torch.randperm(height * width)[:n_points].sort().values
+    points = torch.zeros((n_points, 3))
+    points[:, 0] = (imPts // width).float()
+    points[:, 1] = (imPts % width).float()
+    if smooth:
+        # depth varying with the image row like a road scene
+        points[:, 2] = max_depth * (1 - points[:, 0] / height) + torch.rand(n_points)
+    else:
+        points[:, 2] = torch.rand(n_points) * max_depth
+    return points
+
+
+def neighbor_distances(points, indices):
+    # sorted, equidistant neighbors may come in any order
+    return torch.norm(points[indices] - points[:, None, :], dim=2).sort(dim=1).values
+
+
+def exact_distances(points, k_number, chunk_size=1024):
+    points = points.double()
+    distances = []
+    for start in range(0, points.size(0), chunk_size):
+        d = torch.cdist(points[start:start + chunk_size], points, compute_mode="donot_use_mm_for_euclid_dist")
+        distances.append(torch.topk(d, k_number + 1, dim=1, largest=False).values[:, 1:])
+    return torch.cat(distances).float()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check and benchmark the knn backends")
+    parser.add_argument('--height', type=int, default=200)
+    parser.add_argument('--width', type=int, default=1000)
+    parser.add_argument('--n_points', type=int, default=8000)
+    parser.add_argument('--k_number', type=int, default=3)
+    parser.add_argument('--max_depth', type=float, default=50)
+    parser.add_argument('--n_iter', type=int, default=5)
+    parser.add_argument('--backends', type=str, nargs="+", default=KNN_BACKENDS)
+
+    args = parser.parse_args()
+    torch.manual_seed(0)
+
+    print("H x W: {} x {}, N: {}, K: {}, cdist matrix: {:.1f} MB".format(
+        args.height, args.width, args.n_points, args.k_number, args.n_points ** 2 * 4 / 1024 ** 2))
+
+    for smooth in [True, False]:
+        points = virtual_lidar(args.height, args.width, args.n_points, args.max_depth, smooth)
+        reference = exact_distances(points, args.k_number)
+
+        print("depth: {}".format("smooth" if smooth else "uniform"))
+        for backend in args.backends:
+            try:
+                indices = k_nearest(points, args.k_number, backend)
+            except ImportError as e:
+                print("{:>8} | skipped, {}".format(backend, e))
+                continue
+
+            exact = torch.allclose(neighbor_distances(points, indices), reference, atol=1e-2)
+            # the former cdist search is reported, not checked
+            if not exact and backend != "cdist":
+                raise AssertionError("{} knn differs from the exact knn".format(backend))
+
+            start = time.perf_counter()
+            for _ in range(args.n_iter):
+                k_nearest(points, args.k_number, backend)
+            elapsed = (time.perf_counter() - start) / args.n_iter * 1000
+
+            print("{:>8} | {:>10.2f} ms | {}".format(backend, elapsed, "exact" if exact else "inexact"))
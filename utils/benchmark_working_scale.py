@@ -0,0 +1,120 @@
+"""
+Throughput/memory vs RMSE of the depth head at each working scale
+(MODEL_CUSTOM.DEPTH_HEAD.WORKING_SCALE).
+
+Speed and peak memory are measured on training steps (forward + backward)
+over the first val batches. The RMSE, computed as in Depth.validation_step,
+needs a checkpoint trained at that scale. Without checkpoints only speed and
+memory are reported.
+
+Run from the repository root:
+python -m utils.benchmark_working_scale --config configs/pandepth.yml --scales 1 2 4
+python -m utils.benchmark_working_scale --config configs/pandepth.yml --scales 1 2 4 --checkpoints s1.ckpt s2.ckpt s4.ckpt
+"""
+import time
+import argparse
+import torch
+from torchmetrics import MeanSquaredError
+from detectron2.config import get_cfg
+
+from pandepth import Depth
+from utils.add_custom_params import add_custom_params
+from datasets.vkitti_depth_datamodule import VkittiDataModule
+from datasets.forest_depth_datamodule import ForestDataModule
+
+
+def to_device(batch, device, datamodule):
+    # as the trainer: transfer, then on_after_batch_transfer (BATCH_AUGMENT)
+    batch = {k: v.to(device) if torch.is_tensor(v) else v for k, v in batch.items()}
+    return datamodule.on_after_batch_transfer(batch, 0)
+
+
+def get_model(cfg, checkpoint, device):
+    if checkpoint:
+        model = Depth.load_from_checkpoint(cfg=cfg, checkpoint_path=checkpoint)
+    else:
+        model = Depth(cfg)
+    return model.to(device)
+
+
+def measure_speed(model, batches, device):
+    model.train()
+    torch.cuda.reset_peak_memory_stats(device)
+    # warm up
+    _, loss = model.shared_step(batches[0])
+    sum(loss.values()).backward()
+
+    torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    for batch in batches:
+        model.zero_grad(set_to_none=True)
+        _, loss = model.shared_step(batch)
+        sum(loss.values()).backward()
+    torch.cuda.synchronize(device)
+
+    ms = (time.perf_counter() - start) / len(batches) * 1000
+    return ms, torch.cuda.max_memory_allocated(device) / 1024**2
+
+
+def measure_rmse(model, loader, datamodule, device, n_batches):
+    model.eval()
+    rmse = MeanSquaredError(squared=False).to(device)
+    with torch.no_grad():
+        for i, batch in enumerate(loader):
+            if n_batches and i >= n_batches:
+                break
+            batch = to_device(batch, device, datamodule)
+            sparse_depth_gt = batch['sparse_depth_gt'].squeeze(1)
+            mask_gt = (sparse_depth_gt > 0).float()
+            predictions, _ = model.shared_step(batch)
+            out_depth = torch.squeeze(predictions["depth"], 1)
+            rmse(out_depth * mask_gt, sparse_depth_gt * mask_gt)
+    return rmse.compute().item()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the depth head working scales")
+    parser.add_argument('--config', type=str, required=True, help="Config file from configs/")
+    parser.add_argument('--scales', type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument('--checkpoints', type=str, nargs="+", default=None,
+                        help="One Depth checkpoint per scale, trained at that scale")
+    parser.add_argument('--n_batches', type=int, default=20, help="Batches timed per scale")
+    parser.add_argument('--n_batches_rmse', type=int, default=0, help="Val batches for the RMSE, 0 for all")
+
+    args = parser.parse_args()
+
+    if args.checkpoints is not None and len(args.checkpoints) != len(args.scales):
+        raise ValueError("--checkpoints needs one checkpoint per scale")
+
+    device = torch.device("cuda")
+    print("{:>6} | {:>14} | {:>16} | {:>8}".format("scale", "fwd+bwd (ms)", "peak mem (MB)", "RMSE"))
+
+    for i, scale in enumerate(args.scales):
+        cfg = get_cfg()
+        add_custom_params(cfg)
+        cfg.merge_from_file(args.config)
+        cfg.NUM_GPUS = torch.cuda.device_count()
+        cfg.MODEL_CUSTOM.DEPTH_HEAD.WORKING_SCALE = scale
+
+        if cfg.DATASET_TYPE == "vkitti2":
+            datamodule = VkittiDataModule(cfg, modalities=Depth.MODALITIES)
+        if cfg.DATASET_TYPE == "forest":
+            datamodule = ForestDataModule(cfg, modalities=Depth.MODALITIES)
+        loader = datamodule.val_dataloader()
+
+        batches = []
+        for batch in loader:
+            batches.append(to_device(batch, device, datamodule))
+            if len(batches) == args.n_batches:
+                break
+
+        checkpoint = args.checkpoints[i] if args.checkpoints is not None else None
+        model = get_model(cfg, checkpoint, device)
+
+        ms, peak_mb = measure_speed(model, batches, device)
+        rmse = "{:>8.3f}".format(measure_rmse(model, loader, datamodule, device, args.n_batches_rmse)) if checkpoint else "{:>8}".format("-")
+
+        print("{:>6} | {:>14.1f} | {:>16.1f} | {}".format(scale, ms, peak_mb, rmse))
+
+        del model, batches
+        torch.cuda.empty_cache()
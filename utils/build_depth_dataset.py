@@ -12,6 +12,8 @@ from detectron2.config import get_cfg
 from panopticapi.utils import get_traceback
 from add_custom_params import add_custom_params
 from get_vkitti_files import get_vkitti_files
+from shards import sparse_points
+from sparse_depth import points_file, save_points
 import shutil
 from tqdm import tqdm
 from multiprocessing import  RLock
@@ -20,8 +22,15 @@ def ignore_files(dir, files):
     return [f for f in files if os.path.isfile(os.path.join(dir, f))]
 
 
+def save_depth(path, depth, fmt):
+    if fmt == "npz":
+        save_points(path, sparse_points(depth))
+    else:
+        Image.fromarray(depth).save(path)
+
+
 @get_traceback
-def build_single_core(cfg, proc_id, image_set, virtual_gt_folder, depth_proj_folder):
+def build_single_core(cfg, proc_id, image_set, virtual_gt_folder, depth_proj_folder, fmt):
 
     tqdm_text = "#" + "{}".format(proc_id).zfill(3)
     with tqdm(total=len(image_set), desc=tqdm_text, position=proc_id+1) as pbar:
@@ -34,6 +43,10 @@ def build_single_core(cfg, proc_id, image_set, virtual_gt_folder, depth_proj_fol
             dst_file_name = "/".join(file_name.split("/")[-6:])
             file_path_gt = os.path.join(virtual_gt_folder, dst_file_name)
             file_path_proj = os.path.join(depth_proj_folder, dst_file_name)
+            if fmt == "npz":
+                # point lists, see utils/sparse_depth.py
+                file_path_gt = points_file(file_path_gt)
+                file_path_proj = points_file(file_path_proj)
             
             if os.path.isfile(file_path_gt) and os.path.isfile(file_path_proj):
                 
@@ -72,8 +85,7 @@ def build_single_core(cfg, proc_id, image_set, virtual_gt_folder, depth_proj_fol
                 sparse_depth_gt = torch.zeros_like(depth)
                 sparse_depth_gt[coors_gt[:, 0], coors_gt[:, 1]] = depth_gt
 
-                im = Image.fromarray(sparse_depth_gt.numpy())
-                im.save(file_path_gt)
+                save_depth(file_path_gt, sparse_depth_gt.numpy(), fmt)
             
             # Synthetic lidar
             if not os.path.isfile(file_path_proj):
@@ -86,8 +98,7 @@ def build_single_core(cfg, proc_id, image_set, virtual_gt_folder, depth_proj_fol
                 sparse_depth[coors_lidar[:, 0], coors_lidar[:, 1]] = depth_lidar
 
             
-                im = Image.fromarray(sparse_depth.numpy())
-                im.save(file_path_proj)
+                save_depth(file_path_proj, sparse_depth.numpy(), fmt)
 
             # depth_img_ = np.asarray(Image.open(file_path_proj))
             # print("res", np.unique(depth_img_/255), np.count_nonzero(depth_img_))
@@ -112,6 +123,7 @@ def build_depth_dataset(args):
     depth_proj_folder = os.path.join("..", root, cfg.VKITTI_DATASET.DATASET_PATH.DEPTH_PROJ)
 
     depth_imgs = get_vkitti_files(depth_path, cfg.VKITTI_DATASET.EXCLUDE, "png")
+    fmt = args.format or cfg.VKITTI_DATASET.DEPTH.SPARSE_FORMAT
 
     if not os.path.isdir(virtual_gt_folder):
         src_folder = os.path.join("..", cfg.VKITTI_DATASET.DATASET_PATH.ROOT, cfg.VKITTI_DATASET.DATASET_PATH.DEPTH)
@@ -134,7 +146,7 @@ def build_depth_dataset(args):
     processes = []
     
     for proc_id, image_set in enumerate(images_split):
-        p = workers.apply_async(build_single_core, (cfg, proc_id, image_set, virtual_gt_folder, depth_proj_folder))
+        p = workers.apply_async(build_single_core, (cfg, proc_id, image_set, virtual_gt_folder, depth_proj_folder, fmt))
         processes.append(p)
     
     # for p in tqdm(processes):
@@ -152,6 +164,8 @@ if __name__ == "__main__":
     )
     parser.add_argument('--config', type=str,
                         help="config yml location")
+    parser.add_argument('--format', type=str, choices=["png", "npz"], default=None,
+                        help="sparse depth files, default VKITTI_DATASET.DEPTH.SPARSE_FORMAT")
     
     args = parser.parse_args()
 
@@ -0,0 +1,233 @@
+"""
+COCO annotations as numpy arrays, built once from the annotation file and
+memory mapped read-only by every dataset and dataloader worker.
+
+pycocotools.COCO parses the whole json into dicts of Python objects for every
+dataset (train, val, predict), and the forked workers copy them page by page
+as they touch the refcounts. The store keeps:
++ images: ids (sorted), heights, widths, file names (utf-8 blob + offsets)
++ annotations grouped by image (offsets into them per image): boxes,
+  category ids, areas, iscrowd and the compressed RLE of the masks (blob +
+  offsets)
++ categories (small, in meta.json)
+in <annotation file>.store/, rebuilt when the annotation file changes by the
+first process to take <annotation file>.store.lock. When the directory of the
+annotation file is read-only the store goes to the user cache instead
+(~/.cache/pandepth/coco_store/, or $XDG_CACHE_HOME).
+"""
+import os
+import json
+import fcntl
+import shutil
+import hashlib
+import numpy as np
+from pycocotools import mask as coco_mask
+
+try:
+    from utils.string_table import pack_strings
+except ImportError:
+    from string_table import pack_strings
+
+STORE_VERSION = 1
+
+ARRAYS = ["image_ids", "heights", "widths", "file_names", "file_name_offsets", "ann_offsets",
+          "ann_image", "bbox", "category_id", "area", "iscrowd", "rles", "rle_offsets"]
+
+
+def store_path(annotation_file):
+    return annotation_file + ".store"
+
+
+def cache_store_path(annotation_file):
+    # the store in the user cache, one per annotation file
+    cache = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    key = hashlib.sha1(os.path.abspath(annotation_file).encode()).hexdigest()[:12]
+    name = "{}.{}.store".format(os.path.basename(annotation_file), key)
+    return os.path.join(cache, "pandepth", "coco_store", name)
+
+
+def source_info(annotation_file):
+    stat = os.stat(annotation_file)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def ann_to_rle(segmentation, height, width):
+    # compressed RLE of a segmentation, as COCO.annToRLE
+    if isinstance(segmentation, list):
+        return coco_mask.merge(coco_mask.frPyObjects(segmentation, height, width))
+    if isinstance(segmentation["counts"], list):
+        return coco_mask.frPyObjects(segmentation, height, width)
+    return segmentation
+
+
+def is_current(meta, annotation_file):
+    return meta is not None and meta["version"] == STORE_VERSION and meta["source"] == source_info(annotation_file)
+
+
+def build_store(annotation_file, path):
+    with open(annotation_file, 'r') as f:
+        dataset = json.load(f)
+
+    images = sorted(dataset["images"], key=lambda img: img["id"])
+    image_ids = np.array([img["id"] for img in images], dtype=np.int64)
+    sizes = {img["id"]: (img["height"], img["width"]) for img in images}
+
+    # grouped by image, in the order of the file within an image (as COCO.getAnnIds)
+    annotations = dataset.get("annotations", [])
+    ann_image = np.searchsorted(image_ids, [ann["image_id"] for ann in annotations]).astype(np.int64)
+    order = np.argsort(ann_image, kind="stable")
+    annotations = [annotations[i] for i in order]
+    ann_image = ann_image[order]
+
+    rles = []
+    for ann in annotations:
+        counts = ann_to_rle(ann["segmentation"], *sizes[ann["image_id"]])["counts"]
+        rles.append(counts)
+
+    arrays = {
+        "image_ids": image_ids,
+        "heights": np.array([img["height"] for img in images], dtype=np.int32),
+        "widths": np.array([img["width"] for img in images], dtype=np.int32),
+        "ann_offsets": np.searchsorted(ann_image, np.arange(len(images) + 1)).astype(np.int64),
+        "ann_image": ann_image,
+        "bbox": np.array([ann["bbox"] for ann in annotations], dtype=np.float64).reshape(-1, 4),
+        "category_id": np.array([ann["category_id"] for ann in annotations], dtype=np.int64),
+        "area": np.array([ann.get("area", 0) for ann in annotations], dtype=np.float64),
+        "iscrowd": np.array([ann.get("iscrowd", 0) for ann in annotations], dtype=np.uint8)
+    }
+    arrays["file_names"], arrays["file_name_offsets"] = pack_strings([img["file_name"] for img in images])
+    arrays["rles"], arrays["rle_offsets"] = pack_strings(rles)
+
+    meta = {
+        "version": STORE_VERSION,
+        "source": source_info(annotation_file),
+        "categories": [{k: cat[k] for k in ["id", "name", "supercategory"] if k in cat} for cat in dataset["categories"]]
+    }
+
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    os.makedirs(tmp_path, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp_path, name + ".npy"), array)
+    with open(os.path.join(tmp_path, "meta.json"), 'w') as f:
+        json.dump(meta, f)
+    # the stale store is moved aside, not deleted in place, the processes
+    # that mapped it keep reading it
+    stale_path = "{}.{}.stale".format(path, os.getpid())
+    if os.path.isdir(path):
+        os.rename(path, stale_path)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+        # a peer won
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    shutil.rmtree(stale_path, ignore_errors=True)
+
+
+def ensure_store(annotation_file, path):
+    """
+    Store of annotation_file at path, built if missing or stale.
+    Several datasets, dataloader workers or DDP ranks may get here at the
+    same time: the first to take the lock builds it, the others find it
+    current once they take the lock.
+    output: meta of the store
+    """
+    meta = load_meta(path)
+    if is_current(meta, annotation_file):
+        return meta
+    with open(path + ".lock", 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        meta = load_meta(path)
+        if not is_current(meta, annotation_file):
+            print("Building the annotation store of {}".format(annotation_file))
+            build_store(annotation_file, path)
+            meta = load_meta(path)
+    return meta
+
+
+def open_store(annotation_file):
+    """
+    ensure_store next to annotation_file, in the user cache if that fails
+    (read-only directory)
+    output: path, meta of the store
+    """
+    path = store_path(annotation_file)
+    try:
+        return path, ensure_store(annotation_file, path)
+    except OSError as e:
+        print("Annotation store of {} not written next to it: {}".format(annotation_file, e))
+    path = cache_store_path(annotation_file)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path, ensure_store(annotation_file, path)
+
+
+def load_meta(path):
+    try:
+        with open(os.path.join(path, "meta.json"), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+class CocoStore:
+    """
+    Read-only COCO annotations of annotation_file, see the module docstring.
+    Images are looked up by image id, annotations by row.
+    """
+
+    def __init__(self, annotation_file):
+        self.annotation_file = annotation_file
+        self.open(*open_store(annotation_file))
+
+    def open(self, path, meta):
+        self.path = path
+        for name in ARRAYS:
+            setattr(self, name, np.load(os.path.join(path, name + ".npy"), mmap_mode="r"))
+        self.categories = meta["categories"]
+        self.cat_names = {cat["id"]: cat["name"] for cat in self.categories}
+
+    # Pickled by path, the arrays are mapped again instead of copied (spawned
+    # workers), checked against the annotation file as in __init__
+    def __getstate__(self):
+        return {"annotation_file": self.annotation_file}
+
+    def __setstate__(self, state):
+        self.annotation_file = state["annotation_file"]
+        self.open(*open_store(self.annotation_file))
+
+    def __len__(self):
+        return len(self.image_ids)
+
+    def image_index(self, img_id):
+        i = int(np.searchsorted(self.image_ids, img_id))
+        if i == len(self.image_ids) or self.image_ids[i] != img_id:
+            raise KeyError("No image {} in {}".format(img_id, self.annotation_file))
+        return i
+
+    def file_name(self, img_id):
+        i = self.image_index(img_id)
+        return self.file_names[self.file_name_offsets[i]:self.file_name_offsets[i + 1]].tobytes().decode("utf-8")
+
+    def image_size(self, img_id):
+        # (height, width)
+        i = self.image_index(img_id)
+        return int(self.heights[i]), int(self.widths[i])
+
+    def ann_rows(self, img_id, cat_ids=None):
+        # Annotation rows of an image, of cat_ids only if given
+        i = self.image_index(img_id)
+        rows = np.arange(self.ann_offsets[i], self.ann_offsets[i + 1])
+        if cat_ids is not None:
+            rows = rows[np.isin(self.category_id[rows], cat_ids)]
+        return rows
+
+    def rle(self, row):
+        # compressed RLE, for pycocotools.mask.decode
+        i = self.ann_image[row]
+        counts = self.rles[self.rle_offsets[row]:self.rle_offsets[row + 1]].tobytes()
+        return {"size": [int(self.heights[i]), int(self.widths[i])], "counts": counts}
+
+    def cat_ids(self, supercategory=None):
+        # in the order of the file, as COCO.getCatIds
+        return [cat["id"] for cat in self.categories if supercategory is None or cat.get("supercategory") == supercategory]
@@ -0,0 +1,182 @@
+"""
+Collate of the dataset samples into batches, shared by the datamodules.
+
+Every batch tensor is allocated once and the samples are written straight
+into it, without the list of tensors of torch.stack nor the extra numpy copy
+of torch.as_tensor(np.asarray([...])) for the numpy outputs (semantic):
++ in a dataloader worker the batch tensors are allocated in shared memory
+  (as default_collate does), sending them to the main process does not copy
+  them again. They are owned by the main process once sent, so they are not
+  reused.
++ in the main process (num_workers 0) they come from a ring of `ring`
+  preallocated batches, pinned with pin, reused every `ring` batches. A
+  batch must not be held longer than that (COLLATE_RING, 0 to allocate every
+  batch): the ring holds at least the batch being used and the `prefetch`
+  batches fetched ahead of it (one, the trainer's prefetch).
+Every collated batch takes the next slot with begin_batch, collate_fn
+callers that stack by themselves (stack/pad) call it first.
+"""
+import collections
+import warnings
+import numpy as np
+import torch
+
+STACK, LIST, PAD, DROP = "stack", "list", "pad", "drop"
+
+# How the sample outputs are batched, an output not listed is an error
+BATCH_KEYS = {
+    'image': STACK,
+    'image_id': LIST,
+    'basename': LIST,
+    'semantic': STACK,
+    'instance': LIST,
+    'mask': STACK,
+    'virtual_lidar': PAD,
+    'sparse_depth': STACK,
+    'k_nn_indices': PAD,
+    'depth_full': STACK,
+    'sparse_depth_gt': STACK,
+    # read by the collate_fn filters only
+    'n_instances': DROP,
+    'few_points_flag': DROP
+}
+
+
+def as_tensor(value):
+    # no copy of numpy arrays
+    return torch.from_numpy(np.ascontiguousarray(value)) if isinstance(value, np.ndarray) else value
+
+
+def shared_empty(elem, shape):
+    # tensor like elem in shared memory, see torch.utils.data default_collate
+    numel = int(np.prod(shape))
+    storage = elem._typed_storage()._new_shared(numel, device=elem.device)
+    return elem.new(storage).resize_(*shape)
+
+
+def check_ring(ring, num_workers):
+    # COLLATE_RING only applies to the main process, it needs NUM_WORKERS 0
+    if ring and num_workers:
+        warnings.warn("COLLATE_RING {} is ignored with NUM_WORKERS {}, the worker batches are allocated "
+                      "in shared memory, set NUM_WORKERS: 0 to reuse them".format(ring, num_workers))
+
+
+class Collate:
+    """
+    collate_fn of a DataLoader, see the module docstring.
+    keys: {output: STACK, LIST, PAD or DROP}, outputs None in the samples stay None
+    prefetch: batches fetched ahead of the one in use, ring must exceed it
+    """
+
+    def __init__(self, keys=BATCH_KEYS, ring=0, pin=False, prefetch=1):
+        if ring and ring < prefetch + 1:
+            raise ValueError("A ring of {} batches is reused while held, use at least {} (or 0)".format(ring, prefetch + 1))
+        self.keys = keys
+        self.ring = ring
+        self.pin = pin and torch.cuda.is_available()
+        # ring slots of {output: tensor}
+        self.slots = [{} for _ in range(ring)]
+        self.slot = None
+        self.step = 0
+
+    def begin_batch(self):
+        # next ring slot, once per batch
+        if self.ring:
+            self.slot = self.slots[self.step % self.ring]
+        self.step += 1
+
+    def empty(self, name, elem, shape):
+        if torch.utils.data.get_worker_info() is not None:
+            return shared_empty(elem, shape)
+        if not self.ring:
+            return torch.empty(shape, dtype=elem.dtype, pin_memory=self.pin)
+        if self.slot is None:
+            raise RuntimeError("begin_batch before stacking a batch")
+        slot = self.slot
+        buffer = slot.get(name)
+        if buffer is None or buffer.shape != shape or buffer.dtype != elem.dtype:
+            buffer = torch.empty(shape, dtype=elem.dtype, pin_memory=self.pin)
+            slot[name] = buffer
+        return buffer
+
+    def stack(self, name, values):
+        values = [as_tensor(value) for value in values]
+        elem = values[0]
+        out = self.empty(name, elem, (len(values),) + tuple(elem.shape))
+        for i, value in enumerate(values):
+            out[i].copy_(value)
+        return out
+
+    def pad(self, name, values):
+        # as pad_sequence(values, batch_first=True)
+        values = [as_tensor(value) for value in values]
+        elem = values[0]
+        length = max(len(value) for value in values)
+        out = self.empty(name, elem, (len(values), length) + tuple(elem.shape[1:]))
+        for i, value in enumerate(values):
+            out[i, :len(value)].copy_(value)
+            out[i, len(value):].zero_()
+        return out
+
+    def __call__(self, batch):
+        sample = batch[0]
+        unknown = [name for name in sample if name not in self.keys]
+        if unknown:
+            raise KeyError("No batching mode for the sample outputs {}, add them to the collate keys".format(unknown))
+        self.begin_batch()
+        out = {}
+        for name, mode in self.keys.items():
+            if name not in sample or mode == DROP:
+                continue
+            values = [i[name] for i in batch]
+            if mode == LIST:
+                out[name] = values
+            elif sample[name] is None:
+                out[name] = None
+            elif mode == PAD:
+                out[name] = self.pad(name, values)
+            else:
+                out[name] = self.stack(name, values)
+        return out
+
+
+class Refill:
+    """
+    Misses of the presence index (utils/presence.py): the samples of a batch
+    failing present are replaced, the batch keeps its size.
+    + map-style dataset (Subset of the present samples): by samples drawn at
+      random from it, as the former collate_fn
+    + streamed shards (IterableDataset, no random access): by the last
+      present samples of the stream. Before the first one the batch is only
+      shortened, an error if no sample of it is present.
+    misses: samples replaced so far (in this process, every worker has its own)
+    """
+
+    def __init__(self, dataset, present):
+        self.dataset = dataset
+        self.present = present
+        # last present samples of a stream
+        self.spares = collections.deque(maxlen=16) if isinstance(dataset, torch.utils.data.IterableDataset) else None
+        self.misses = 0
+
+    def __call__(self, batch):
+        kept = [sample for sample in batch if self.present(sample)]
+        if self.spares is not None:
+            self.spares.extend(kept)
+        missing = len(batch) - len(kept)
+        if not missing:
+            return batch
+        self.misses += missing
+        print("Presence index misses: {} samples replaced".format(self.misses))
+        while len(kept) < len(batch):
+            if self.spares is None:
+                sample = self.dataset[np.random.randint(0, len(self.dataset))]
+                if self.present(sample):
+                    kept.append(sample)
+            elif self.spares:
+                kept.extend(list(self.spares)[:len(batch) - len(kept)])
+            elif kept:
+                break
+            else:
+                raise RuntimeError("No present sample in the batch nor before it in the stream")
+        return kept
@@ -0,0 +1,69 @@
+"""
+Converts the color coded semantic segmentation folders into uint8 class id
+PNGs (see utils/rgb_to_class.py), written to <folder>_class_ids with the same
+tree and file names. Set <DATASET>.SEMANTIC_CLASS_IDS to read them.
+Up to date files are skipped.
+
+Run from the repository root:
+python -m utils.convert_semantic --config configs/pandepth.yml
+"""
+import os
+import argparse
+import multiprocessing
+import numpy as np
+from PIL import Image
+from detectron2.config import get_cfg
+
+from utils.add_custom_params import add_custom_params
+from utils.manifest import walk
+from utils.rgb_to_class import rgb_to_class, class_ids_folder
+
+mapping = None
+
+
+def init_worker(dataset_mapping):
+    global mapping
+    mapping = dataset_mapping
+
+
+def convert(paths):
+    src, dst = paths
+    if os.path.exists(dst) and os.path.getmtime(dst) >= os.path.getmtime(src):
+        return False
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    class_ids = rgb_to_class(np.asarray(Image.open(src)), mapping)
+    tmp = "{}.{}.tmp.png".format(dst[:-4], os.getpid())
+    Image.fromarray(class_ids).save(tmp)
+    os.replace(tmp, dst)
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert the semantic masks to class id PNGs")
+    parser.add_argument('--config', type=str, required=True, help="Config file from configs/")
+    parser.add_argument('--workers', type=int, default=8)
+
+    args = parser.parse_args()
+    cfg = get_cfg()
+    add_custom_params(cfg)
+    cfg.merge_from_file(args.config)
+
+    if cfg.DATASET_TYPE == "vkitti2":
+        from datasets.vkitti_cats import mapping as dataset_mapping
+        paths = cfg.VKITTI_DATASET.DATASET_PATH
+        folders = [os.path.join(paths.ROOT, paths.SEMANTIC)]
+    elif cfg.DATASET_TYPE == "forest":
+        from datasets.forest_cats import mapping as dataset_mapping
+        paths = cfg.FOREST_DATASET.DATASET_PATH
+        folders = [os.path.join(paths.ROOT, paths.SEMANTIC_TRAIN), os.path.join(paths.ROOT, paths.SEMANTIC_VAL)]
+    else:
+        raise ValueError("No semantic masks for dataset {}".format(cfg.DATASET_TYPE))
+
+    for folder in folders:
+        out_folder = class_ids_folder(folder)
+        files, _ = walk(folder, "png")
+        jobs = [(os.path.join(folder, f), os.path.join(out_folder, f)) for f in files]
+
+        with multiprocessing.Pool(args.workers, initializer=init_worker, initargs=(dataset_mapping,)) as pool:
+            converted = sum(pool.imap_unordered(convert, jobs, chunksize=16))
+        print("{}: {} converted, {} up to date -> {}".format(folder, converted, len(jobs) - converted, out_folder))
@@ -0,0 +1,55 @@
+"""
+Converts the sparse depth PNGs into point lists (see utils/sparse_depth.py),
+written next to them as .npz. Set <DATASET>.DEPTH.SPARSE_FORMAT "npz" to read
+them. Up to date files are skipped.
+
+Run from the repository root:
+python -m utils.convert_sparse_depth --config configs/pandepth.yml
+"""
+import os
+import argparse
+import multiprocessing
+import numpy as np
+from PIL import Image
+from detectron2.config import get_cfg
+
+from utils.add_custom_params import add_custom_params
+from utils.manifest import walk
+from utils.shards import sparse_points
+from utils.sparse_depth import points_file, save_points
+
+
+def convert(src):
+    dst = points_file(src)
+    if os.path.exists(dst) and os.path.getmtime(dst) >= os.path.getmtime(src):
+        return False
+    save_points(dst, sparse_points(np.asarray(Image.open(src))))
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert the sparse depth PNGs to point lists")
+    parser.add_argument('--config', type=str, required=True, help="Config file from configs/")
+    parser.add_argument('--workers', type=int, default=8)
+
+    args = parser.parse_args()
+    cfg = get_cfg()
+    add_custom_params(cfg)
+    cfg.merge_from_file(args.config)
+
+    if cfg.DATASET_TYPE == "vkitti2":
+        paths = cfg.VKITTI_DATASET.DATASET_PATH
+        folders = [os.path.join(paths.ROOT, paths.DEPTH_VIRTUAL_GT), os.path.join(paths.ROOT, paths.DEPTH_PROJ)]
+    elif cfg.DATASET_TYPE == "forest":
+        paths = cfg.FOREST_DATASET.DATASET_PATH
+        folders = [os.path.join(paths.ROOT, paths.DEPTH_TRAIN), os.path.join(paths.ROOT, paths.DEPTH_VAL)]
+    else:
+        raise ValueError("No sparse depth for dataset {}".format(cfg.DATASET_TYPE))
+
+    for folder in folders:
+        files, _ = walk(folder, "png")
+        jobs = [os.path.join(folder, f) for f in files]
+
+        with multiprocessing.Pool(args.workers) as pool:
+            converted = sum(pool.imap_unordered(convert, jobs, chunksize=16))
+        print("{}: {} converted, {} up to date".format(folder, converted, len(jobs) - converted))
@@ -0,0 +1,39 @@
+"""
+Depth maps of the datasets are kept in the native type of their PNGs
+(uint8, uint16) through decoding, augmentation and collate, and scaled to
+float32 on the device of the batch (scale_batch, on_after_batch_transfer of
+the datamodules), instead of float64 from the decoding on.
+"""
+import numpy as np
+
+
+def native_depth(depth):
+    # uint16 stays uint16, torch takes it for the copies of collate and the transfer (torch >= 2.3)
+    return np.asarray(depth)
+
+
+def scale_depth(depth, scale):
+    """
+    inputs:
+    + depth: transformed native depth tensor
+    + scale: png value to depth (1 / 255)
+    outputs:
+    + depth: float32
+    """
+    return depth.float() * scale
+
+
+def scale_batch(batch, scale, max_depth=None):
+    """
+    Native depth maps (B x 1 x H x W) of a collated batch scaled on its
+    device: depth_full zeroed from max_depth on, sparse_depth kept at the
+    sampled points of mask only.
+    """
+    if "depth_full" in batch:
+        depth_full = scale_depth(batch["depth_full"], scale)
+        batch["depth_full"] = depth_full.masked_fill(depth_full >= max_depth, 0)
+    if "sparse_depth_gt" in batch:
+        batch["sparse_depth_gt"] = scale_depth(batch["sparse_depth_gt"], scale)
+    if "sparse_depth" in batch:
+        batch["sparse_depth"] = scale_depth(batch["sparse_depth"], scale) * batch["mask"].unsqueeze(1)
+    return batch
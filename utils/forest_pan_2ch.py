@@ -24,6 +24,7 @@ import os
 import PIL.Image as Image
 
 from panopticapi.utils import rgb2id
+from rgb_to_class import rgb_to_class
 from get_forest_files import get_forest_files
 
 def ignore_files(dir, files):
@@ -44,17 +45,8 @@ mapping = {
 
 
 def mask_to_class(mask):
-        target = torch.from_numpy(mask)
-        h,w = target.shape[0],target.shape[1]
-        masks = torch.empty(h, w, dtype=torch.long)
-        target = target.permute(2, 0, 1).contiguous()
-        for k in mapping:
-            idx = (target==torch.tensor(k, dtype=torch.uint8).unsqueeze(1).unsqueeze(2))
-            validx = (idx.sum(0) == 3) 
-            masks[validx] = torch.tensor(mapping[k], dtype=torch.long)
-        I8 = (((masks.cpu().numpy()))).astype(np.uint8)
-        im = Image.fromarray(I8)
-        return im
+    # H x W uint8 class ids, see rgb_to_class.py
+    return rgb_to_class(mask, mapping)
 
 def generate_pan_2ch(args):
     
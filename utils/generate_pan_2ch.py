@@ -24,7 +24,8 @@ import os
 import PIL.Image as Image
 
 from panopticapi.utils import rgb2id
-from get_vkitti_files import get_vkitti_files
+from rgb_to_class import rgb_to_class
+from manifest import Manifest, vkitti_key, vkitti_filter
 
 def ignore_files(dir, files):
     return [f for f in files if os.path.isfile(os.path.join(dir, f))]
@@ -49,17 +50,8 @@ mapping = {
 
 
 def mask_to_class(mask):
-        target = torch.from_numpy(mask)
-        h,w = target.shape[0],target.shape[1]
-        masks = torch.empty(h, w, dtype=torch.long)
-        target = target.permute(2, 0, 1).contiguous()
-        for k in mapping:
-            idx = (target==torch.tensor(k, dtype=torch.uint8).unsqueeze(1).unsqueeze(2))
-            validx = (idx.sum(0) == 3) 
-            masks[validx] = torch.tensor(mapping[k], dtype=torch.long)
-        I8 = (((masks.cpu().numpy()))).astype(np.uint8)
-        im = Image.fromarray(I8)
-        return im
+    # H x W uint8 class ids, see rgb_to_class.py
+    return rgb_to_class(mask, mapping)
 
 def generate_pan_2ch(args):
     
@@ -81,8 +73,8 @@ def generate_pan_2ch(args):
                     two_ch_folder,
                     ignore=ignore_files)
 
-    semantic_imgs = get_vkitti_files(semantic_folder, exclude, "png")
-    instance_imgs = get_vkitti_files(instance_folder, exclude, "png")
+    manifest = Manifest({"semantic": semantic_folder, "instance": instance_folder},
+                        "png", vkitti_key, vkitti_filter(exclude))
 
     with open(image_json, 'r') as f:
         data = json.load(f)
@@ -96,14 +88,10 @@ def generate_pan_2ch(args):
         
         file_name = image["file_name"]
         file_name = ".".join([*image['file_name'].rsplit('.')[:-1], "png"])
-        scene = file_name.split("/")[-6]
-        weather = file_name.split("/")[-5]
-        basename = file_name.split(".")[-2].split("_")[-1]
-
-        semantic_img_filename = [s for s in semantic_imgs if (
-            scene in s and basename in s and weather in s)][0]
-        instance_img_filename = [s for s in instance_imgs if (
-            scene in s and basename in s and weather in s)][0]
+        key = vkitti_key(file_name)
+
+        semantic_img_filename = manifest.get(key, "semantic")
+        instance_img_filename = manifest.get(key, "instance")
         
         semantic_mask = Image.open(semantic_img_filename)
         instance_mask = Image.open(instance_img_filename).convert('RGB')
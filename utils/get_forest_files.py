@@ -1,20 +1,21 @@
 import os.path
+try:
+    from utils.manifest import walk, load_listing
+except ImportError:  # run from utils/
+    from manifest import walk, load_listing
 
-def get_forest_files(dirName, ext):
-    # create a list of file and sub directories
-    # names in the given directory
-    listOfFile = os.listdir(dirName)
+def get_forest_files(dirName, ext, cache=True, prune=None, workers=8):
+    """
+    Files of dirName and its sub directories ending with ext.
 
-    allFiles = list()
-    # Iterate over all the entries
-    for entry in listOfFile:
-        # Create full path
-        fullPath = os.path.join(dirName, entry)
+    cache: use the listing saved next to the folder (see utils/manifest.py),
+    rebuilt when the tree changed.
+    prune: sub directories skipped by the walk, see utils/manifest.py walk
+    and load_listing (optional)
+    """
+    if cache:
+        rel_paths = load_listing(dirName, ext, prune=prune, workers=workers)
+    else:
+        rel_paths, _ = walk(dirName, ext, prune=prune, workers=workers)
 
-        # If entry is a directory then get the list of files in this directory
-        if os.path.isdir(fullPath):
-            allFiles = allFiles + get_forest_files(fullPath, ext)
-        elif fullPath.find(ext) != -1:
-            allFiles.append(fullPath)
-
-    return allFiles
\ No newline at end of file
+    return [os.path.join(dirName, rel_path) for rel_path in rel_paths]
@@ -1,26 +1,25 @@
 import os.path
+try:
+    from utils.manifest import walk, load_listing, vkitti_filter, vkitti_prune
+except ImportError:  # run from utils/
+    from manifest import walk, load_listing, vkitti_filter, vkitti_prune
 
-def get_vkitti_files(dirName, exclude, ext, scenes, aug=None):
-    # create a list of file and sub directories
-    # names in the given directory
-    listOfFile = os.listdir(dirName)
+def get_vkitti_files(dirName, exclude, ext, scenes=None, aug=None, cache=True, workers=8):
+    """
+    Files of a vkitti modality folder (<dirName>/<scene>/<weather>/frames/<type>/<camera>/)
+    ending with ext, of Camera_0, of the given scenes (all if None), not in
+    an excluded weather and containing aug if given.
 
-    allFiles = list()
-    # Iterate over all the entries
-    for entry in listOfFile:
-        # Create full path
-        fullPath = os.path.join(dirName, entry)
+    The walk skips the excluded scenes and weathers.
+    cache: filter the listing saved next to the folder (see utils/manifest.py),
+    rebuilt when the tree changed.
+    """
+    keep = vkitti_filter(exclude, scenes, aug)
+    prune = vkitti_prune(exclude, scenes, aug)
+    if cache:
+        rel_paths = load_listing(dirName, ext, prune=prune, workers=workers)
+    else:
+        rel_paths, _ = walk(dirName, ext, prune=prune, workers=workers)
 
-        # If entry is a directory then get the list of files in this directory
-        if os.path.isdir(fullPath):
-            allFiles = allFiles + get_vkitti_files(fullPath, exclude, ext, scenes, aug=aug)
-        elif aug != None:
-            scene = fullPath.split("/")[-6]
-            if fullPath.split("/")[-5] not in exclude and fullPath.find("Camera_0") != -1 and fullPath.find(aug) != -1 and fullPath.find(ext) != -1 and scene in scenes:
-                allFiles.append(fullPath)
-        else:
-            scene = fullPath.split("/")[-6]
-            if fullPath.split("/")[-5] not in exclude and fullPath.find("Camera_0") != -1 and fullPath.find(ext) != -1 and scene in scenes:
-                allFiles.append(fullPath)
-
-    return allFiles
\ No newline at end of file
+    allFiles = [os.path.join(dirName, rel_path) for rel_path in rel_paths]
+    return [path for path in allFiles if keep(path)]
@@ -0,0 +1,74 @@
+"""
+Instance id map of a sample: H x W int32, 0 for the background and i + 1
+for the pixels of annotation i.
+
+The augmentations transform this single map (nearest neighbor, like the
+other masks) instead of one full resolution mask per instance, then the
+per instance masks and boxes are derived from the transformed map.
+Instances of VKITTI/forest come from instance segmentations and do not
+overlap, on an overlap the later annotation wins.
+"""
+import numpy as np
+import torch
+import cv2
+from pycocotools import mask as coco_mask
+
+
+def rasterize_instance_ids(rles, shape):
+    instance_ids = np.zeros(shape, dtype=np.int32)
+    for i, rle in enumerate(rles):
+        instance_ids[coco_mask.decode(rle) > 0] = i + 1
+    return instance_ids
+
+
+def encode_instance_ids(instance_ids):
+    # 16-bit PNG bytes, for the packed shards
+    return cv2.imencode(".png", instance_ids.astype(np.uint16))[1].tobytes()
+
+
+def decode_instance_ids(data):
+    return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_UNCHANGED).astype(np.int32)
+
+
+def instances_from_ids(instance_ids, labels):
+    """
+    inputs:
+    + instance_ids: H x W (transformed instance id map)
+    + labels: label of every annotation
+    outputs:
+    + masks: K x H x W bool, instances still in the map
+    + boxes: K x 4 (xmin, ymin, xmax, ymax) of the masks
+    + classes: K
+    """
+    ids = np.unique(instance_ids)
+    ids = ids[ids > 0]
+    masks = instance_ids[None] == ids[:, None, None]
+
+    rows = masks.any(axis=2)  # K x H
+    cols = masks.any(axis=1)  # K x W
+    ymin = rows.argmax(axis=1)
+    ymax = rows.shape[1] - rows[:, ::-1].argmax(axis=1)
+    xmin = cols.argmax(axis=1)
+    xmax = cols.shape[1] - cols[:, ::-1].argmax(axis=1)
+    boxes = np.stack([xmin, ymin, xmax, ymax], axis=1).astype(np.float32)
+
+    classes = np.asarray(labels, dtype=np.int64)[ids - 1]
+    return masks, boxes, classes
+
+
+def instances_from_ids_tensor(instance_ids, labels):
+    # instances_from_ids of a tensor id map, on its device (utils/batch_augment.py)
+    ids = torch.unique(instance_ids)
+    ids = ids[ids > 0]
+    masks = instance_ids[None] == ids[:, None, None]
+
+    rows = masks.any(dim=2).int()  # K x H
+    cols = masks.any(dim=1).int()  # K x W
+    ymin = rows.argmax(dim=1)
+    ymax = rows.shape[1] - rows.flip(1).argmax(dim=1)
+    xmin = cols.argmax(dim=1)
+    xmax = cols.shape[1] - cols.flip(1).argmax(dim=1)
+    boxes = torch.stack([xmin, ymin, xmax, ymax], dim=1).float()
+
+    classes = torch.as_tensor(labels, dtype=torch.int64, device=instance_ids.device)[ids.long() - 1]
+    return masks, boxes, classes
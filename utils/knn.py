@@ -0,0 +1,153 @@
+"""
+K nearest neighbors of the virtual lidar points.
+
+The points are (row, col, depth) with row/col on the pixel lattice, so the
+pixel distance is a lower bound of the 3D distance. The grid backend only
+compares every point with the points of a window of pixels around it and
+falls back to the exact chunked search for the few points whose neighbors
+may lie outside the window. The output is the same as the former
+cdist + topk search (up to the order of equidistant neighbors) without the
+N x N distance matrix.
+
+backends:
++ grid: pixel lattice window search, exact (default)
++ kdtree: scipy cKDTree, exact (requires scipy)
++ chunked: brute force in chunks of rows, exact
++ cdist: full N x N distance matrix, former implementation
+"""
+import math
+import torch
+
+KNN_BACKENDS = ["grid", "kdtree", "chunked", "cdist"]
+
+
+def knn_cdist(points, k_number):
+    distances = torch.cdist(points.unsqueeze(0), points.unsqueeze(0), p=2)
+    _, indices = torch.topk(distances, k_number + 1, dim=2, largest=False)
+    return indices[0, :, 1:]
+
+
+def knn_chunked(points, k_number, chunk_size=1024, queries=None):
+    """
+    Exact search, only chunk_size x N distances are held at once. The
+    distances are not computed with the matrix product of cdist, which is
+    not accurate enough to rank the neighbors of large point clouds.
+    queries: indices of the points to search the neighbors of (default all)
+    """
+    if queries is None:
+        queries = torch.arange(points.size(0), device=points.device)
+
+    # with fewer than K points the missing neighbors are the point itself
+    indices = queries[:, None].repeat(1, k_number)
+    k_found = min(k_number, points.size(0))
+    for start in range(0, queries.size(0), chunk_size):
+        chunk = queries[start:start + chunk_size]
+        distances = torch.cdist(points[chunk], points, compute_mode="donot_use_mm_for_euclid_dist")
+        # exclude the point itself
+        distances[torch.arange(chunk.size(0), device=points.device), chunk] = float("inf")
+        indices[start:start + chunk_size, :k_found] = torch.topk(distances, k_found, dim=1, largest=False).indices
+    return indices
+
+
+def knn_kdtree(points, k_number):
+    try:
+        from scipy.spatial import cKDTree
+    except ImportError:
+        raise ImportError("The kdtree knn backend requires scipy, use the grid backend instead")
+
+    points_np = points.detach().cpu().double().numpy()
+    _, indices = cKDTree(points_np).query(points_np, k=k_number + 1)
+    indices = torch.as_tensor(indices[:, 1:], dtype=torch.long, device=points.device).view(-1, k_number)
+    # fewer than k other points, the missing neighbors are the point itself
+    own = torch.arange(indices.size(0), device=points.device)[:, None].expand_as(indices)
+    return torch.where(indices == points.size(0), own, indices)
+
+
+def knn_grid(points, k_number, radius=None, max_radius=16, chunk_size=4096):
+    """
+    Window search on the pixel lattice, points with integer pixel coordinates
+    and at most one point per pixel (imPts of the datasets).
+    The planar part of the distances only depends on the window offset, so
+    only the depth of the window pixels is looked up. A point whose k-th
+    neighbor in the window of radius r is at most r + 1 away is resolved:
+    any point outside the window is at least r + 1 pixels away. The window
+    grows up to max_radius, the points left are searched with knn_chunked.
+    """
+    N = points.size(0)
+    device = points.device
+    if N == 0:
+        return torch.empty((0, k_number), dtype=torch.long, device=device)
+
+    pixels = points[:, :2].long()
+    if not torch.equal(pixels.to(points.dtype), points[:, :2]) or torch.unique(pixels, dim=0).size(0) < N:
+        return knn_chunked(points, k_number, chunk_size)
+    pixels = pixels - pixels.min(dim=0).values
+    H, W = (pixels.max(dim=0).values + 1).tolist()
+
+    if radius is None:
+        # expected planar distance of the k-th neighbor
+        radius = max(1, math.ceil(math.sqrt(k_number * H * W / (math.pi * N))))
+    radius = min(radius, max_radius)
+
+    # depth and point index of every pixel, padded by max_radius so that no
+    # window goes out of the image. Empty pixels are at an infinite depth
+    pad = max_radius
+    Wp = W + 2 * pad
+    flat_pixels = (pixels[:, 0] + pad) * Wp + pixels[:, 1] + pad
+    depth_map = torch.full(((H + 2 * pad) * Wp,), float("inf"), dtype=points.dtype, device=device)
+    depth_map[flat_pixels] = points[:, 2]
+    index_map = torch.full(((H + 2 * pad) * Wp,), -1, dtype=torch.long, device=device)
+    index_map[flat_pixels] = torch.arange(N, device=device)
+
+    indices = torch.empty((N, k_number), dtype=torch.long, device=device)
+    pending = torch.arange(N, device=device)
+
+    while pending.numel() > 0:
+        d = torch.arange(-radius, radius + 1, device=device)
+        offsets = torch.stack(torch.meshgrid(d, d, indexing="ij"), dim=-1).view(-1, 2)
+        offsets = offsets[(offsets != 0).any(dim=1)]  # the point itself
+        planar = (offsets ** 2).sum(dim=1).to(points.dtype)  # w
+        flat_offsets = offsets[:, 0] * Wp + offsets[:, 1]  # w
+
+        unresolved = []
+        for start in range(0, pending.size(0), chunk_size):
+            chunk = pending[start:start + chunk_size]
+            window = flat_pixels[chunk, None] + flat_offsets[None, :]  # n x w
+            distances = planar[None, :] + (depth_map[window] - points[chunk, 2, None]) ** 2
+
+            k_dist, k_idx = torch.topk(distances, k_number, dim=1, largest=False)
+            resolved = k_dist[:, -1] <= (radius + 1) ** 2
+            indices[chunk[resolved]] = index_map[torch.gather(window, 1, k_idx)[resolved]]
+            unresolved.append(chunk[~resolved])
+
+        pending = torch.cat(unresolved)
+        if radius == max_radius:
+            break
+        radius = min(2 * radius, max_radius)
+
+    # points not resolved within max_radius
+    if pending.numel() > 0:
+        indices[pending] = knn_chunked(points, k_number, queries=pending)
+
+    return indices
+
+
+def k_nearest(points, k_number, backend="grid", chunk_size=1024):
+    """
+    inputs:
+    + points: N x 3 (row, col, depth)
+    + k_number: K
+    + backend: one of KNN_BACKENDS
+    output:
+    + indices: N x K, nearest first, the point itself excluded. With fewer
+      than K other points the missing neighbors are the point itself.
+    """
+    if backend == "grid":
+        return knn_grid(points, k_number)
+    if backend == "kdtree":
+        return knn_kdtree(points, k_number)
+    if backend == "chunked":
+        return knn_chunked(points, k_number, chunk_size)
+    if backend == "cdist":
+        return knn_cdist(points, k_number)
+    raise ValueError("Unknown knn backend {}, options: {}".format(backend, KNN_BACKENDS))
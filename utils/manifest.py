@@ -0,0 +1,233 @@
+"""
+Sample manifest: every modality path of a sample from its key, in O(1).
+
+The files of each modality folder are listed once and the listing is saved
+next to the folder (<folder>.<ext>.manifest.json, <folder>.<prune key>.<ext>.manifest.json
+for a pruned walk) with the mtime of every directory of the tree. Adding, removing or renaming a file or a directory
+changes the mtime of its parent directory, so the listing is rebuilt only
+when one of the recorded mtimes changed.
+
+keys:
++ vkitti: (scene, weather, camera, frame), from
+  <modality>/<scene>/<weather>/frames/<type>/<camera>/<prefix>_<frame>.<ext>
++ forest: file name without extension
+"""
+import os
+import json
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from utils.string_table import StringTable
+except ImportError:
+    from string_table import StringTable
+
+MANIFEST_VERSION = 1
+
+
+def vkitti_key(path):
+    parts = path.split("/")
+    frame = os.path.splitext(parts[-1])[0].split("_")[-1]
+    return (parts[-6], parts[-5], parts[-2], frame)
+
+
+def forest_key(path):
+    return (os.path.splitext(os.path.basename(path))[0],)
+
+
+def vkitti_filter(exclude, scenes=None, aug=None):
+    # Selection of get_vkitti_files
+    def keep(path):
+        parts = path.split("/")
+        if parts[-5] in exclude or path.find("Camera_0") == -1:
+            return False
+        if aug is not None and path.find(aug) == -1:
+            return False
+        return scenes is None or parts[-6] in scenes
+    return keep
+
+
+def vkitti_prune(exclude, scenes=None, aug=None):
+    """
+    Directories of a modality folder (<scene>/<weather>/...) that
+    vkitti_filter would reject all the files of.
+    prune.key: its parameters, names the listing of the pruned tree
+    """
+    def prune(rel_dir):
+        parts = rel_dir.split(os.sep)
+        if len(parts) == 1:
+            return scenes is not None and parts[0] not in scenes
+        if len(parts) != 2:
+            return False
+        return parts[1] in exclude or (aug is not None and parts[1].find(aug) == -1)
+    params = [sorted(exclude), None if scenes is None else sorted(scenes), aug]
+    prune.key = hashlib.sha1(json.dumps(params).encode()).hexdigest()[:12]
+    return prune
+
+
+def manifest_path(root, ext, prune=None):
+    if prune is None:
+        return "{}.{}.manifest.json".format(os.path.normpath(root), ext)
+    return "{}.{}.{}.manifest.json".format(os.path.normpath(root), prune.key, ext)
+
+
+def scan_dir(root, rel_dir, ext, prune=None):
+    """
+    One directory of the tree.
+    output: files, sub directories (relative paths), mtime_ns of the directory
+    """
+    path = os.path.join(root, rel_dir)
+    # stat before listing, a change during the scan invalidates the listing
+    mtime = os.stat(path).st_mtime_ns
+    files = []
+    sub_dirs = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            rel_path = os.path.normpath(os.path.join(rel_dir, entry.name))
+            if entry.is_dir():
+                if prune is None or not prune(rel_path):
+                    sub_dirs.append(rel_path)
+            elif entry.name.endswith(ext):
+                files.append(rel_path)
+    return files, sub_dirs, mtime
+
+
+def walk(root, ext, prune=None, workers=8):
+    """
+    scandir walk of root, the directories of each level of the tree are
+    scanned in parallel by a thread pool.
+    prune: skip a directory (relative path) and its subtree if prune(path)
+    output: files (sorted relative paths ending with ext), dirs ({relative path: mtime_ns})
+    """
+    files = []
+    dirs = {}
+    level = ["."]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while level:
+            next_level = []
+            for rel_dir, (dir_files, sub_dirs, mtime) in zip(
+                    level, pool.map(lambda d: scan_dir(root, d, ext, prune), level)):
+                dirs[rel_dir] = mtime
+                files.extend(dir_files)
+                next_level.extend(sub_dirs)
+            level = next_level
+    files.sort()
+    return files, dirs
+
+
+def is_valid(listing, root):
+    if listing.get("version") != MANIFEST_VERSION:
+        return False
+    for rel_dir, mtime in listing["dirs"].items():
+        try:
+            if os.stat(os.path.join(root, rel_dir)).st_mtime_ns != mtime:
+                return False
+        except FileNotFoundError:
+            return False
+    return True
+
+
+def load_listing(root, ext, prune=None, workers=8):
+    """
+    Relative paths of the files of root ending with ext, from the saved
+    listing when it is still valid.
+    prune: as walk, with a key (see vkitti_prune), the pruned listing is
+    saved apart from the full one
+    """
+    path = manifest_path(root, ext, prune)
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            listing = json.load(f)
+        if is_valid(listing, root):
+            return listing["files"]
+
+    files, dirs = walk(root, ext, prune=prune, workers=workers)
+    listing = {"version": MANIFEST_VERSION, "dirs": dirs, "files": files}
+    # atomic, several workers or scripts may build it at the same time
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(listing, f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print("Manifest of {} not saved: {}".format(root, e))
+    return files
+
+
+def alias_modalities(roots):
+    """
+    roots: {modality: folder}
+    output: {modality: first modality of the same folder}, the modalities
+    read from the same files. The datasets decode and transform these files
+    once per sample.
+    """
+    aliases, first = {}, {}
+    for modality, root in roots.items():
+        aliases[modality] = first.setdefault(os.path.realpath(root), modality)
+    return aliases
+
+
+class Manifest:
+    """
+    roots: {modality: folder}
+    ext: file extension
+    key_fn: vkitti_key or forest_key
+    path_filter: keep a path if path_filter(path) (optional)
+    prune: directories not listed, see load_listing (optional)
+
+    A folder shared by several modalities is listed once.
+    """
+
+    def __init__(self, roots, ext, key_fn, path_filter=None, prune=None):
+        self.index = {}
+        self.aliases = alias_modalities(roots)
+        for modality, root in roots.items():
+            if self.aliases[modality] != modality:
+                continue
+            names = [name for name, alias in self.aliases.items() if alias == modality]
+            for rel_path in load_listing(root, ext, prune=prune):
+                path = os.path.join(root, rel_path)
+                if path_filter is not None and not path_filter(path):
+                    continue
+                # the first path of a key is kept, like the former [... ][0] scans
+                paths = self.index.setdefault(key_fn(path), {})
+                for name in names:
+                    paths.setdefault(name, path)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def get(self, key, modality):
+        return self.index[key][modality]
+
+    def find(self, key, modality, pattern):
+        """
+        get, falling back to the first path of the modality containing
+        pattern (former substring match) when the key is not indexed
+        """
+        paths = self.index.get(key)
+        if paths is not None and modality in paths:
+            return paths[modality]
+        for paths in self.index.values():
+            path = paths.get(modality)
+            if path is not None and pattern in path:
+                self.index.setdefault(key, {})[modality] = path
+                return path
+        raise KeyError("No {} file for {}".format(modality, pattern))
+
+    def table(self, keys, modality, patterns=None):
+        """
+        StringTable of the paths of modality for keys (find with patterns if
+        given), "" for a missing file. The datasets keep these per sample
+        tables instead of the index (see utils/string_table.py).
+        """
+        paths = []
+        for i, key in enumerate(keys):
+            try:
+                paths.append(self.get(key, modality) if patterns is None else self.find(key, modality, patterns[i]))
+            except KeyError:
+                paths.append("")
+        return StringTable(paths)
@@ -0,0 +1,89 @@
+"""
+Memory of the dataloader workers over an epoch: RSS, PSS and private dirty
+pages of every worker (/proc/<pid>/smaps_rollup), at the first batch and
+every --every batches after it.
+
+With the dataset tables as lists/dicts of Python objects the private dirty
+pages of the workers grow over the epoch (copy on read of the refcounts),
+with the array tables (utils/string_table.py, utils/coco_store.py) they stay
+flat. Run it on both revisions to compare.
+
+Run from the repository root:
+python -m utils.measure_worker_rss --config configs/pandepth.yml --split train
+python -m utils.measure_worker_rss --config configs/pandepth.yml --dataset yt --max_batches 500
+"""
+import argparse
+from detectron2.config import get_cfg
+
+from utils.add_custom_params import add_custom_params
+
+FIELDS = ["Rss", "Pss", "Private_Dirty"]
+
+
+def worker_memory(pid):
+    # MB of FIELDS of a process
+    memory = {}
+    with open("/proc/{}/smaps_rollup".format(pid), 'r') as f:
+        for line in f:
+            name = line.split(":")[0]
+            if name in FIELDS:
+                memory[name] = int(line.split()[1]) / 1024
+    return memory
+
+
+def get_datamodule(cfg, dataset, modalities):
+    if dataset == "vkitti2":
+        from datasets.vkitti_depth_datamodule import VkittiDataModule
+        return VkittiDataModule(cfg, modalities=modalities)
+    if dataset == "forest":
+        from datasets.forest_datamodule import ForestDataModule
+        return ForestDataModule(cfg, modalities=modalities)
+    if dataset == "yt":
+        from datasets.yt_2019_datamodule import YoutubeDataModule
+        return YoutubeDataModule(cfg)
+    raise ValueError("Unknown dataset {}".format(dataset))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the memory of the dataloader workers over an epoch")
+    parser.add_argument('--config', type=str, required=True, help="Config file from configs/")
+    parser.add_argument('--dataset', type=str, default=None, choices=["vkitti2", "forest", "yt"],
+                        help="Defaults to DATASET_TYPE")
+    parser.add_argument('--split', type=str, default="train", choices=["train", "val", "predict"])
+    parser.add_argument('--modalities', type=str, nargs="+", default=None, help="Defaults to MODALITIES")
+    parser.add_argument('--every', type=int, default=100, help="Batches between measurements")
+    parser.add_argument('--max_batches', type=int, default=0, help="0 for the whole epoch")
+
+    args = parser.parse_args()
+    cfg = get_cfg()
+    add_custom_params(cfg)
+    cfg.merge_from_file(args.config)
+
+    datamodule = get_datamodule(cfg, args.dataset or cfg.DATASET_TYPE, args.modalities)
+    loader = getattr(datamodule, "{}_dataloader".format(args.split))()
+    if loader.num_workers == 0:
+        raise ValueError("The {} loader has no workers".format(args.split))
+
+    iterator = iter(loader)
+    # multiprocessing.Process of every worker
+    workers = iterator._workers
+
+    first = None
+    last = None
+    print("{:>8} | {:>6} | {:>10} | {:>10} | {:>14}".format("batch", "worker", "RSS (MB)", "PSS (MB)", "private (MB)"))
+    for i, batch in enumerate(iterator):
+        if args.max_batches and i >= args.max_batches:
+            break
+        # the batches of a training run (BATCH_AUGMENT), the ring slots are reused as in training
+        datamodule.on_after_batch_transfer(batch, 0)
+        if i % args.every:
+            continue
+        last = [worker_memory(w.pid) for w in workers]
+        if first is None:
+            first = last
+        for w, memory in enumerate(last):
+            print("{:>8} | {:>6} | {:>10.1f} | {:>10.1f} | {:>14.1f}".format(i, w, *[memory[name] for name in FIELDS]))
+
+    print("Growth since the first batch (MB):")
+    for w, (start, end) in enumerate(zip(first, last)):
+        print("worker {}: ".format(w) + ", ".join("{} {:+.1f}".format(name, end[name] - start[name]) for name in FIELDS))
@@ -0,0 +1,30 @@
+"""
+Outputs of the datasets required by a model, the datasets skip reading,
+decoding, transforming and collating the others.
++ image: always loaded
++ semantic: semantic class ids
++ instance: instances (and n_instances), the samples without instances are
+  dropped only with it, models without it train on every frame
++ sparse_depth: sparse depth, its virtual lidar points and mask
++ depth_gt: sparse_depth_gt
++ depth_full: dense depth (vkitti)
++ knn: knn indices of the points, searched by the depth head if not required
+"""
+
+ALL_MODALITIES = frozenset(["image", "semantic", "instance", "sparse_depth", "depth_gt", "depth_full", "knn"])
+
+
+def get_modalities(cfg, modalities=None):
+    """
+    modalities: MODALITIES of the model, else cfg.MODALITIES, else all
+    """
+    if modalities is None:
+        modalities = cfg.MODALITIES or ALL_MODALITIES
+    modalities = frozenset(modalities) | {"image"}
+
+    unknown = modalities - ALL_MODALITIES
+    if unknown:
+        raise ValueError("Unknown modalities {}, expected {}".format(sorted(unknown), sorted(ALL_MODALITIES)))
+    if "knn" in modalities and "sparse_depth" not in modalities:
+        raise ValueError("The knn modality needs sparse_depth")
+    return modalities
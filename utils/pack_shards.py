@@ -0,0 +1,108 @@
+"""
+Packs the samples of the dataset splits into shards (see utils/shards.py).
+The shards are written to <DATASET>.SHARDS.ROOT and read instead of the
+dataset files once the config points to them.
+
+Run from the repository root:
+python -m utils.pack_shards --config configs/pandepth.yml --root shards/vkitti2
+
+Every record holds the presence of its sample in the presence indices of
+utils/presence.py, computed with the RESIZE/CENTER_CROP of the config, the
+datamodules stream the present records only (ShardDataset keep).
+"""
+import argparse
+import multiprocessing
+import numpy as np
+from detectron2.config import get_cfg
+
+from utils.add_custom_params import add_custom_params
+from utils.shards import ShardWriter, sparse_points
+from utils.presence import instance_presence
+from utils.instance_ids import encode_instance_ids
+from utils.modalities import ALL_MODALITIES
+from datasets.vkitti_depth_datamodule import VkittiDataModule
+from datasets.forest_depth_datamodule import ForestDataModule
+
+dataset = None
+
+
+def init_worker(split_dataset):
+    global dataset
+    dataset = split_dataset
+
+
+def get_record(index):
+    # before any transform, the same with or without BATCH_AUGMENT
+    record = dataset.get_record(index)
+    record["instance_ids"] = encode_instance_ids(record["instance_ids"])
+    # dense png depth of the raster transforms packed as points, aliases stay shared
+    points = {}
+    for name in ["depth_gt", "depth_proj"]:
+        depth = record.get(name)
+        if isinstance(depth, np.ndarray):
+            if id(depth) not in points:
+                points[id(depth)] = sparse_points(depth)
+            record[name] = points[id(depth)]
+    return record
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pack the dataset splits into shards")
+    parser.add_argument('--config', type=str, required=True, help="Config file from configs/")
+    parser.add_argument('--splits', type=str, nargs="+", default=None,
+                        help="Defaults to the splits the datamodule reads: train val predict (vkitti2), train val (forest)")
+    parser.add_argument('--root', type=str, default=None, help="Shards directory, default <DATASET>.SHARDS.ROOT")
+    parser.add_argument('--workers', type=int, default=8, help="Processes reading the dataset files")
+
+    args = parser.parse_args()
+    cfg = get_cfg()
+    add_custom_params(cfg)
+    cfg.merge_from_file(args.config)
+
+    if cfg.DATASET_TYPE == "vkitti2":
+        dataset_cfg = cfg.VKITTI_DATASET
+        datamodule_cls = VkittiDataModule
+        splits = ["train", "val", "predict"]
+    elif cfg.DATASET_TYPE == "forest":
+        dataset_cfg = cfg.FOREST_DATASET
+        datamodule_cls = ForestDataModule
+        # predict reads the val shards
+        splits = ["train", "val"]
+    else:
+        raise ValueError("No shards for dataset {}".format(cfg.DATASET_TYPE))
+
+    root = args.root or dataset_cfg.SHARDS.ROOT
+    if not root:
+        raise ValueError("Set --root or {}.SHARDS.ROOT".format("VKITTI_DATASET" if cfg.DATASET_TYPE == "vkitti2" else "FOREST_DATASET"))
+
+    # Datasets read from the files, every modality so the shards serve any model
+    dataset_cfg.SHARDS.ROOT = ""
+    datamodule = datamodule_cls(cfg, modalities=ALL_MODALITIES)
+    # every sample, with its presence (present_dataset would compute and apply one)
+    datamodule.present_dataset = lambda split_dataset: split_dataset
+    split_datasets = {
+        "train": datamodule.train_dataset,
+        "val": datamodule.val_dataset,
+        "predict": datamodule.predict_dataset
+    }
+
+    resize = (dataset_cfg.RESIZE.HEIGHT, dataset_cfg.RESIZE.WIDTH)
+    crop = (dataset_cfg.CENTER_CROP.HEIGHT, dataset_cfg.CENTER_CROP.WIDTH)
+    for split in args.splits or splits:
+        split_dataset = split_datasets[split]()
+        present = {"instances": instance_presence(split_dataset.coco, split_dataset.ids,
+                                                  split_dataset.obj_categories_ids, resize, crop)}
+        if hasattr(split_dataset, "points_presence"):
+            present["points"] = split_dataset.points_presence()
+        params = {"dataset": cfg.DATASET_TYPE, "split": split, "max_samples": dataset_cfg.MAX_SAMPLES,
+                  "resize": resize, "center_crop": crop, "max_depth_points": dataset_cfg.DEPTH.MAX_DEPTH_POINTS}
+        writer = ShardWriter(root, split, dataset_cfg.SHARDS.SAMPLES_PER_SHARD, params=params)
+
+        with multiprocessing.Pool(args.workers, initializer=init_worker, initargs=(split_dataset,)) as pool:
+            for i, record in enumerate(pool.imap(get_record, range(len(split_dataset)), chunksize=4)):
+                record["present"] = {name: bool(flags[i]) for name, flags in present.items()}
+                writer.write(record)
+                if (i + 1) % 100 == 0:
+                    print("{}: {}/{}".format(split, i + 1, len(split_dataset)))
+        writer.close()
+        print("{}: {} samples in {} shards, present: {}".format(split, writer.count, len(writer.shards), writer.kept))
@@ -0,0 +1,174 @@
+"""
+On-disk cache of the sampled virtual lidar points and their knn indices.
+
+For the eval/predict datasets, whose transforms are deterministic, the
+points of a frame only depend on the frame and on the depth config. They
+are sampled once per image id with a seed derived from the image id,
+searched for their neighbors and saved as .npy files, then memory mapped
+on the next epochs so __getitem__ skips torch.nonzero, the sampling and the
+knn search.
+
+The cache directory is keyed by a hash of every config value the points
+depend on, changing any of them starts a new cache.
+"""
+import os
+import json
+import hashlib
+import numpy as np
+import torch
+
+try:
+    from utils.knn import k_nearest
+except ImportError:
+    from knn import k_nearest
+
+
+def points_cache_key(cfg, dataset_cfg, name, modalities):
+    """
+    Every input the cached arrays depend on.
+    dataset_cfg: cfg.VKITTI_DATASET or cfg.FOREST_DATASET
+    name: dataset name, datasets decoding depth differently must differ
+    modalities: outputs of the dataset, the knn indices only with knn
+    """
+    params = {
+        "name": name,
+        "k": dataset_cfg.DEPTH.K,
+        "max_depth_points": dataset_cfg.DEPTH.MAX_DEPTH_POINTS,
+        "max_depth": dataset_cfg.DEPTH.MAX_DEPTH,
+        "resize": [dataset_cfg.RESIZE.HEIGHT, dataset_cfg.RESIZE.WIDTH],
+        "center_crop": [dataset_cfg.CENTER_CROP.HEIGHT, dataset_cfg.CENTER_CROP.WIDTH],
+        "point_transform": dataset_cfg.DEPTH.POINT_TRANSFORM,
+        "sparse_format": dataset_cfg.DEPTH.SPARSE_FORMAT,
+        "knn_backend": dataset_cfg.DEPTH.KNN_BACKEND,
+        "paths": dict(dataset_cfg.DATASET_PATH),
+        "knn": "knn" in modalities and not cfg.MODEL_CUSTOM.DEPTH_HEAD.KNN_IN_MODEL
+    }
+    return hashlib.md5(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def sample_generator(image_id):
+    # Same points for a frame in every epoch and every worker
+    return torch.Generator().manual_seed(int(image_id))
+
+
+def sample_points(cfg, dataset_cfg, depth_proj, image_id, modalities, points_cache=None):
+    """
+    Points of depth_proj sampled down to MAX_DEPTH_POINTS, in row-major
+    order, their virtual lidar coordinates and knn indices. With a points
+    cache the sampling is seeded by the image id and the result is saved
+    once then read back. On the device of depth_proj.
+    dataset_cfg: cfg.VKITTI_DATASET or cfg.FOREST_DATASET
+    output: imPts (N x 2), virtual_lidar (N x 3), k_nn_indices (N x K or None)
+    """
+    device = depth_proj.device
+    if points_cache is not None:
+        cached = points_cache.load(image_id)
+        if cached is not None:
+            virtual_lidar, k_nn_indices = cached
+            virtual_lidar = virtual_lidar.to(device)
+            k_nn_indices = k_nn_indices.to(device) if k_nn_indices is not None else None
+            return virtual_lidar[:, 0:2].long(), virtual_lidar, k_nn_indices
+
+    imPts = torch.nonzero(depth_proj)
+    generator = sample_generator(image_id) if points_cache is not None else None
+    inds = torch.randperm(imPts.shape[0], generator=generator).to(device)
+    # Keep the sampled points in row-major order, the order of the points in mask
+    imPts = imPts[torch.sort(inds[:dataset_cfg.DEPTH.MAX_DEPTH_POINTS]).values]
+
+    virtual_lidar = torch.zeros((imPts.shape[0], 3), device=device)
+    virtual_lidar[:, 0:2] = imPts
+    virtual_lidar[:, 2] = depth_proj[imPts[:, 0], imPts[:, 1]]
+
+    # Left to the depth head with KNN_IN_MODEL or without the knn modality
+    k_nn_indices = None
+    if "knn" in modalities and not cfg.MODEL_CUSTOM.DEPTH_HEAD.KNN_IN_MODEL:
+        k_nn_indices = k_nearest(virtual_lidar, dataset_cfg.DEPTH.K, dataset_cfg.DEPTH.KNN_BACKEND).long()  # N x K
+
+    if points_cache is not None:
+        points_cache.save(image_id, virtual_lidar.cpu(), k_nn_indices.cpu() if k_nn_indices is not None else None)
+
+    return imPts, virtual_lidar, k_nn_indices
+
+
+def sample_batch_points(cfg, dataset_cfg, depth_proj, modalities):
+    """
+    sample_points of the B x H x W depth maps of a batch at once, without a
+    points cache (not seeded). On the device of depth_proj.
+    output: mask (B x H x W, the sampled points), virtual_lidar (B x N x 3),
+    k_nn_indices (B x N x K or None), zero padded to the largest sample
+    """
+    batch_size = depth_proj.shape[0]
+    device = depth_proj.device
+    # batch-major then row-major
+    batch_index, rows, cols = torch.nonzero(depth_proj, as_tuple=True)
+
+    max_points = dataset_cfg.DEPTH.MAX_DEPTH_POINTS
+    if max_points is not None:
+        # random rank of every point among the points of its sample
+        counts = torch.bincount(batch_index, minlength=batch_size)
+        starts = torch.cumsum(counts, 0) - counts
+        order = torch.argsort(batch_index.double() + torch.rand(batch_index.shape[0], dtype=torch.float64, device=device))
+        rank = torch.empty_like(order)
+        rank[order] = torch.arange(order.shape[0], device=device) - starts[batch_index[order]]
+        kept = rank < max_points
+        batch_index, rows, cols = batch_index[kept], rows[kept], cols[kept]
+
+    counts = torch.bincount(batch_index, minlength=batch_size)
+    starts = torch.cumsum(counts, 0) - counts
+    position = torch.arange(batch_index.shape[0], device=device) - starts[batch_index]
+    counts = counts.tolist()
+
+    virtual_lidar = torch.zeros((batch_size, max(counts, default=0), 3), device=device)
+    virtual_lidar[batch_index, position, 0] = rows.float()
+    virtual_lidar[batch_index, position, 1] = cols.float()
+    virtual_lidar[batch_index, position, 2] = depth_proj[batch_index, rows, cols].float()
+    mask = torch.zeros(depth_proj.shape, dtype=torch.bool, device=device)
+    mask[batch_index, rows, cols] = True
+
+    # Left to the depth head with KNN_IN_MODEL or without the knn modality
+    k_nn_indices = None
+    if "knn" in modalities and not cfg.MODEL_CUSTOM.DEPTH_HEAD.KNN_IN_MODEL:
+        # the backends search one point cloud
+        k_nn_indices = torch.zeros(virtual_lidar.shape[:2] + (dataset_cfg.DEPTH.K,), dtype=torch.long, device=device)
+        for i, count in enumerate(counts):
+            k_nn_indices[i, :count] = k_nearest(virtual_lidar[i, :count], dataset_cfg.DEPTH.K, dataset_cfg.DEPTH.KNN_BACKEND)
+    return mask, virtual_lidar, k_nn_indices
+
+
+class PointsCache:
+    def __init__(self, root, key):
+        self.root = os.path.join(root, key)
+        os.makedirs(self.root, exist_ok=True)
+
+    def paths(self, image_id):
+        image_id = int(image_id)
+        return (os.path.join(self.root, "{}_points.npy".format(image_id)),
+                os.path.join(self.root, "{}_knn.npy".format(image_id)))
+
+    def load(self, image_id):
+        """
+        output: virtual_lidar (N x 3), k_nn_indices (N x K or None), None if not cached
+        """
+        points_path, knn_path = self.paths(image_id)
+        if not os.path.exists(points_path):
+            return None
+
+        virtual_lidar = torch.from_numpy(np.array(np.load(points_path, mmap_mode="r")))
+        k_nn_indices = None
+        if os.path.exists(knn_path):
+            k_nn_indices = torch.from_numpy(np.array(np.load(knn_path, mmap_mode="r"), dtype=np.int64))
+        return virtual_lidar, k_nn_indices
+
+    def save(self, image_id, virtual_lidar, k_nn_indices=None):
+        points_path, knn_path = self.paths(image_id)
+        # knn first and atomic renames, the points file marks a complete entry
+        # for the other workers
+        if k_nn_indices is not None:
+            self._save(knn_path, k_nn_indices.numpy().astype(np.int32))
+        self._save(points_path, virtual_lidar.numpy().astype(np.float32))
+
+    @staticmethod
+    def _save(path, array):
+        tmp_path = "{}.{}.tmp.npy".format(path[:-4], os.getpid())
+        np.save(tmp_path, array)
+        os.replace(tmp_path, path)
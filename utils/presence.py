@@ -0,0 +1,136 @@
+"""
+Presence index: for every sample of a dataset, whether an instance (or
+enough sparse depth points) is left after the transforms. Built once from the annotations, the
+datamodules sample only these indices (torch.utils.data.Subset) instead of
+dropping the samples without instances in collate_fn and fetching others.
+The estimate may still miss a sample whose instances vanish in the
+transforms, collate_fn replaces it (utils/collate.py Refill).
+
+The sparse depth point counts are saved next to their folder
+(<folder>.<key>.counts.json, key of the resize, crop and mode) with the
+mtime of every file, a file is decoded again only when its mtime changed.
+"""
+import os
+import json
+import hashlib
+import numpy as np
+
+try:
+    from utils.sparse_depth import nearest_source, nearest_index, project_index
+except ImportError:
+    from sparse_depth import nearest_source, nearest_index, project_index
+
+COUNTS_VERSION = 1
+
+
+def instance_presence(store, image_ids, cat_ids, resize, crop):
+    """
+    inputs:
+    + store: CocoStore of the dataset (utils/coco_store.py)
+    + image_ids: image id of every sample
+    + cat_ids: instance categories
+    + resize, crop: (height, width) of A.Resize then A.CenterCrop
+    output: N bool, a box of cat_ids overlaps the crop window by at least one
+    resized pixel in both directions. An estimate, the masks are not decoded
+    and a thin instance may still vanish in the nearest neighbor resize.
+    """
+    (h_resize, w_resize), (h_crop, w_crop) = resize, crop
+    # crop window in resized pixels
+    x1 = (w_resize - w_crop) // 2
+    y1 = (h_resize - h_crop) // 2
+    x2, y2 = x1 + w_crop, y1 + h_crop
+
+    # every annotation of the store at once
+    images = np.asarray(store.ann_image)
+    sx = w_resize / np.asarray(store.widths)[images]
+    sy = h_resize / np.asarray(store.heights)[images]
+    x, y, w, h = np.asarray(store.bbox).T
+    overlap_x = np.minimum((x + w) * sx, x2) - np.maximum(x * sx, x1)
+    overlap_y = np.minimum((y + h) * sy, y2) - np.maximum(y * sy, y1)
+    kept = np.isin(store.category_id, cat_ids) & (overlap_x >= 1) & (overlap_y >= 1)
+
+    present = np.zeros(len(store), dtype=bool)
+    present[images[kept]] = True
+    return present[np.searchsorted(store.image_ids, image_ids)]
+
+
+def point_count(points, resize, crop, mode=None):
+    """
+    inputs:
+    + points: (coordinates, values, shape) of a sparse depth map, or the
+      dense map itself (mode None)
+    + resize, crop: (height, width) of A.Resize then A.CenterCrop
+    + mode: raster or project for the point lists (utils/sparse_depth.py),
+      None for a dense map resized as a mask (nearest neighbor)
+    output: number of the pixels of the crop holding a point. Exact, the
+    horizontal flip keeps every point.
+    """
+    offsets = [(r - c) // 2 for r, c in zip(resize, crop)]
+    if mode is None:
+        if isinstance(points, np.ndarray):
+            present = points != 0
+        else:
+            coordinates, _, shape = points
+            present = np.zeros(shape, dtype=bool)
+            present[coordinates[:, 0], coordinates[:, 1]] = True
+        shape = present.shape
+        rows, cols = [nearest_source(src, dst)[offset:offset + size]
+                      for src, dst, offset, size in zip(shape, resize, offsets, crop)]
+        return int(present[rows][:, cols].sum())
+
+    coordinates, _, shape = points
+    index = []
+    for axis, (src, dst, offset) in enumerate(zip(shape, resize, offsets)):
+        if mode == "project":
+            table = project_index(np.arange(src), src, dst) - offset
+        else:
+            # -1 (not sampled) stays negative
+            table = nearest_index(src, dst) - offset
+        index.append(table[coordinates[:, axis]])
+    rows, cols = index
+    kept = (rows >= 0) & (rows < crop[0]) & (cols >= 0) & (cols < crop[1])
+    return len(np.unique(rows[kept] * crop[1] + cols[kept]))
+
+
+def counts_path(root, resize, crop, mode):
+    key = hashlib.sha1(json.dumps([list(resize), list(crop), mode]).encode()).hexdigest()[:12]
+    return "{}.{}.counts.json".format(os.path.normpath(root), key)
+
+
+def point_counts(paths, root, read, resize, crop, mode=None):
+    """
+    point_count of the sparse depth files paths of the folder root, from the
+    saved counts (see the module docstring) for the files not modified since.
+    read: path to the points (or dense map) of point_count
+    output: N int
+    """
+    path = counts_path(root, resize, crop, mode)
+    saved = {}
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            listing = json.load(f)
+        if listing.get("version") == COUNTS_VERSION:
+            saved = listing["counts"]
+
+    counts = []
+    changed = False
+    for file_path in paths:
+        rel_path = os.path.relpath(file_path, root)
+        mtime = os.stat(file_path).st_mtime_ns
+        entry = saved.get(rel_path)
+        if entry is None or entry[0] != mtime:
+            entry = [mtime, point_count(read(file_path), resize, crop, mode)]
+            saved[rel_path] = entry
+            changed = True
+        counts.append(entry[1])
+
+    if changed:
+        # atomic, as utils/manifest.py load_listing, the other splits of the folder stay
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump({"version": COUNTS_VERSION, "counts": saved}, f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print("Point counts of {} not saved: {}".format(root, e))
+    return np.asarray(counts, dtype=np.int64)
@@ -0,0 +1,50 @@
+"""
+Color coded segmentation to class ids in one pass.
+
+The RGB of every pixel is packed into a 24-bit key r << 16 | g << 8 | b and
+mapped to its class id through a 2^24 entries lookup table, built once per
+mapping ({(r, g, b): class id}, see datasets/vkitti_cats.py). Colors not in
+the mapping get class 0.
+
+utils/convert_semantic.py converts the segmentation folders offline into
+uint8 class id PNGs (class_ids_folder), read by the datasets with
+<DATASET>.SEMANTIC_CLASS_IDS instead of converting in every worker.
+"""
+import os
+import numpy as np
+
+_luts = {}
+
+
+def build_lut(mapping):
+    lut = np.zeros(1 << 24, dtype=np.uint8)
+    for (r, g, b), class_id in mapping.items():
+        lut[(r << 16) | (g << 8) | b] = class_id
+    return lut
+
+
+def get_lut(mapping):
+    key = tuple(sorted(mapping.items()))
+    if key not in _luts:
+        _luts[key] = build_lut(mapping)
+    return _luts[key]
+
+
+def rgb_to_class(mask, mapping):
+    """
+    inputs:
+    + mask: H x W x 3 (or 4, alpha ignored) uint8 color coded segmentation
+    + mapping: {(r, g, b): class id}
+    outputs:
+    + class ids: H x W uint8
+    """
+    mask = np.asarray(mask)
+    keys = mask[..., 0].astype(np.int32) << 16
+    keys |= mask[..., 1].astype(np.int32) << 8
+    keys |= mask[..., 2]
+    return get_lut(mapping)[keys]
+
+
+def class_ids_folder(folder):
+    # Class id PNGs of a segmentation folder, same tree and file names
+    return os.path.normpath(folder) + "_class_ids"
@@ -0,0 +1,236 @@
+"""
+Packed shards of dataset samples.
+
+Reading a sample from the dataset files opens ~6 files (RGB, class
+segmentation, depths, COCO masks). utils/pack_shards.py reads every sample
+of a split once and writes it as a record into large shard files, then
+ShardDataset streams the records sequentially, one shard at a time.
+
+A shard is a pickle stream of records, one per sample (see get_record of
+the datasets):
++ image_id, file_name (metadata)
++ rgb: bytes of the source image file, decoded by the reader
++ semantic: H x W uint8 class ids
++ depth_proj, depth_gt: sparse_points of the depth maps
++ depth_full: bytes of the depth file (vkitti only)
++ instance_ids: 16-bit PNG bytes of the instance id map (utils/instance_ids.py)
++ annotations: boxes, labels, areas, iscrowd, category ids
++ present: {name: bool} of the presence indices (utils/presence.py), the
+  instances and, for forest, the sparse depth points
+The shards hold every modality, the datasets decode only theirs
+(see utils/modalities.py).
+
+<root>/<name>.json lists the shards of a split, their number of samples
+and the number of present samples of every presence index (kept), of the
+split and of every shard.
+"""
+import os
+import json
+import random
+import pickle
+import numpy as np
+import torch
+import torch.distributed as dist
+
+
+def read_bytes(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def sparse_points(depth):
+    """
+    Non zero pixels of a depth map
+    output: (coordinates N x 2 int32, values N, shape)
+    """
+    coordinates = np.argwhere(depth != 0).astype(np.int32)
+    return coordinates, depth[coordinates[:, 0], coordinates[:, 1]], depth.shape
+
+
+def dense_points(points):
+    coordinates, values, shape = points
+    depth = np.zeros(shape, dtype=values.dtype)
+    depth[coordinates[:, 0], coordinates[:, 1]] = values
+    return depth
+
+
+def index_path(root, name):
+    return os.path.join(root, "{}.json".format(name))
+
+
+def load_index(root, name):
+    with open(index_path(root, name), 'r') as f:
+        return json.load(f)
+
+
+def read_shard(path):
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+
+class ShardWriter:
+    """
+    Writes records into <root>/<name>-<shard>.pkl, samples_per_shard records
+    per shard, and the index of the shards on close.
+    """
+
+    def __init__(self, root, name, samples_per_shard=256, params=None):
+        os.makedirs(root, exist_ok=True)
+        self.root = root
+        self.name = name
+        self.samples_per_shard = samples_per_shard
+        self.params = params
+        self.shards = []
+        self.file = None
+        self.count = 0
+        self.kept = {}
+
+    def write(self, record):
+        if self.file is None:
+            file_name = "{}-{:05d}.pkl".format(self.name, len(self.shards))
+            self.shards.append({"file": file_name, "samples": 0})
+            self.file = open(os.path.join(self.root, file_name + ".tmp"), 'wb')
+        pickle.dump(record, self.file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.shards[-1]["samples"] += 1
+        self.count += 1
+        shard_kept = self.shards[-1].setdefault("kept", {})
+        for name, present in record.get("present", {}).items():
+            self.kept[name] = self.kept.get(name, 0) + bool(present)
+            shard_kept[name] = shard_kept.get(name, 0) + bool(present)
+        if self.shards[-1]["samples"] == self.samples_per_shard:
+            self._close_shard()
+
+    def _close_shard(self):
+        self.file.close()
+        path = os.path.join(self.root, self.shards[-1]["file"])
+        os.replace(path + ".tmp", path)
+        self.file = None
+
+    def close(self):
+        if self.file is not None:
+            self._close_shard()
+        index = {"name": self.name, "samples": self.count, "kept": self.kept, "shards": self.shards, "params": self.params}
+        with open(index_path(self.root, self.name), 'w') as f:
+            json.dump(index, f, indent=1)
+
+
+def distributed_info():
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_rank(), dist.get_world_size()
+    return 0, 1
+
+
+class ShardDataset(torch.utils.data.IterableDataset):
+    """
+    Samples of a split streamed from its shards.
+    inputs:
+    + dataset: builds a sample from a record with dataset.get_sample(record)
+    + root, name: shards of utils/pack_shards.py
+    + shuffle: shuffle the shards every epoch, and the records in a buffer of
+      buffer_size records per worker
+    + keep: presence index of the records (see the module docstring), the
+      records not present are skipped before decoding (optional)
+
+    The kept records, numbered in the shard order of the epoch (the same on
+    every rank), are split between the DDP ranks by record: rank r takes the
+    records r, r + world_size, ... so every rank reads every shard. A rank
+    short of one record of len(self) = ceil(kept / world_size) repeats its
+    first one, so no rank waits on the others and no record is dropped.
+    Within a rank the shards are split between the dataloader workers (the
+    records, when there are fewer shards than workers).
+    The shard order changes every epoch when the workers are persistent.
+    """
+
+    def __init__(self, dataset, root, name, shuffle=False, buffer_size=0, keep=None, seed=0):
+        super().__init__()
+        index = load_index(root, name)
+        self.dataset = dataset
+        self.shards = [os.path.join(root, shard["file"]) for shard in index["shards"]]
+        # kept records of every shard, numbering them does not read the shards
+        self.shard_samples = [shard["samples"] for shard in index["shards"]]
+        self.samples = index["samples"]
+        if keep is not None:
+            if keep not in index.get("kept", {}) or any(keep not in shard.get("kept", {}) for shard in index["shards"]):
+                raise ValueError("No {} presence in the shards of {}, pack them again with utils/pack_shards.py".format(keep, index_path(root, name)))
+            self.shard_samples = [shard["kept"][keep] for shard in index["shards"]]
+            self.samples = index["kept"][keep]
+        self.shuffle = shuffle
+        self.buffer_size = buffer_size
+        self.keep = keep
+        self.seed = seed
+        self.epoch = 0
+
+    def __len__(self):
+        _, world_size = distributed_info()
+        return -(-self.samples // world_size)
+
+    def worker_shards(self, order):
+        """
+        output: shards of this worker with the number of kept records before
+        them in the order, (offset, stride) of its records among the records
+        of the rank, repeats padding the rank to len(self), slot
+        """
+        rank, world_size = distributed_info()
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+
+        starts = np.cumsum([0] + [self.shard_samples[i] for i in order[:-1]]).tolist()
+        if len(order) >= num_workers:
+            shards, records = list(range(worker_id, len(order), num_workers)), (0, 1)
+        else:
+            # fewer shards than workers, every worker reads every shard
+            shards, records = list(range(len(order))), (worker_id, num_workers)
+
+        rank_samples = self.samples // world_size + (rank < self.samples % world_size)
+        repeats = len(self) - rank_samples if worker_id == 0 else 0
+        return [(self.shards[order[i]], starts[i]) for i in shards], records, repeats, rank * num_workers + worker_id
+
+    def records(self, shards, offset, stride):
+        rank, world_size = distributed_info()
+        for shard, start in shards:
+            # number of the record among the kept records of the epoch
+            number = start
+            for record in read_shard(shard):
+                if self.keep is not None and not record["present"][self.keep]:
+                    continue
+                number += 1
+                if (number - 1) % world_size == rank and (number - 1) // world_size % stride == offset:
+                    yield record
+
+    def shuffled(self, records, rng):
+        # Buffer of records, not decoded samples, to keep the buffer small
+        if not self.shuffle or self.buffer_size <= 1:
+            yield from records
+            return
+        buffer = []
+        for record in records:
+            if len(buffer) < self.buffer_size:
+                buffer.append(record)
+                continue
+            i = rng.randrange(self.buffer_size)
+            yield buffer[i]
+            buffer[i] = record
+        rng.shuffle(buffer)
+        yield from buffer
+
+    def __iter__(self):
+        order = list(range(len(self.shards)))
+        if self.shuffle:
+            random.Random(self.seed + self.epoch).shuffle(order)
+        shards, (offset, stride), repeats, slot = self.worker_shards(order)
+        rng = random.Random((self.seed + self.epoch) * 1000003 + slot)
+        self.epoch += 1
+
+        first = None
+        for record in self.shuffled(self.records(shards, offset, stride), rng):
+            if first is None:
+                first = record
+            yield self.dataset.get_sample(record)
+        # pads the rank to len(self)
+        if first is not None:
+            for _ in range(repeats):
+                yield self.dataset.get_sample(first)
@@ -0,0 +1,139 @@
+"""
+Sparse depth maps stored as point lists instead of mostly zero PNGs.
+
+<file>.npz next to (or instead of) <file>.png holds the non zero pixels:
++ coordinates: N x 2 (row, col) int32
++ values: N, png depth values (uint16)
++ shape: (height, width) of the depth map
+the (coordinates, values, shape) of sparse_points in utils/shards.py.
+utils/build_depth_dataset.py --format npz writes them, utils/convert_sparse_depth.py
+converts existing PNGs.
+
+With <DATASET>.DEPTH.SPARSE_FORMAT "npz" the datasets read these files and
+transform_points applies the geometric transforms of the albumentations
+pipeline (replayed from ReplayCompose) to the coordinates, so a sample costs
+in its number of points instead of the image size.
+
+<DATASET>.DEPTH.POINT_TRANSFORM chooses how the points are transformed:
++ raster: the pixels of the dense map transformed as a nearest neighbor
+  mask, a resize down drops the points of the rows/cols it skips
++ project: every point is projected with the transform of the image, to
+  the pixel containing its center, and the nearest point of a pixel is kept
+  (z-buffer), as a lidar projected at the transformed resolution. Points
+  are only lost when they share a pixel or leave the crop. The PNG sparse
+  depth is transformed as points too in this mode.
+"""
+import os
+import numpy as np
+
+
+def points_file(path):
+    return os.path.splitext(path)[0] + ".npz"
+
+
+def save_points(path, points):
+    coordinates, values, shape = points
+    # atomic, the scripts skip existing files
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, coordinates=coordinates.astype(np.int32), values=values, shape=np.asarray(shape))
+    os.replace(tmp_path, path)
+
+
+def load_points(path):
+    with np.load(path) as data:
+        return data["coordinates"], data["values"], tuple(int(s) for s in data["shape"])
+
+
+# <DATASET>.DEPTH.POINT_TRANSFORM
+POINT_TRANSFORMS = ["raster", "project"]
+
+
+def nearest_source(src, dst):
+    # Source index of every destination index of a nearest neighbor resize
+    # from src to dst, same arithmetic as cv2: floor(d * (1 / (dst / src)))
+    scale = 1.0 / (dst / src)
+    return np.minimum(np.floor(np.arange(dst) * scale).astype(np.int64), src - 1)
+
+
+def nearest_index(src, dst):
+    """
+    Destination index of every source index for a nearest neighbor resize
+    from src to dst (cv2.INTER_NEAREST, how albumentations resizes masks),
+    -1 for the source indices no destination pixel samples.
+    When upsampling a source pixel is sampled several times, the point goes
+    to the first of them.
+    """
+    index = np.full(src, -1, dtype=np.int64)
+    d = np.arange(dst)
+    s = nearest_source(src, dst)
+    # reversed, the first destination index of a source index is written last
+    index[s[::-1]] = d[::-1]
+    return index
+
+
+def project_index(index, src, dst):
+    # Pixel of dst containing the center of pixel index of src, the pixel
+    # centers of a resize are aligned (cv2, align_corners=False)
+    return np.minimum(np.floor((index + 0.5) * (dst / src)).astype(np.int64), dst - 1)
+
+
+def zbuffer(rows, cols, values, width):
+    # Nearest point (smallest depth value) of every pixel
+    order = np.lexsort((values, rows * width + cols))
+    pixels = (rows * width + cols)[order]
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = pixels[1:] != pixels[:-1]
+    kept = np.sort(order[first])
+    return rows[kept], cols[kept], values[kept]
+
+
+# Transforms that do not move pixels
+PIXEL_TRANSFORMS = ("Normalize", "ToTensorV2", "ColorJitter", "RandomBrightnessContrast")
+
+
+def transform_points(points, replay, mode="raster"):
+    """
+    inputs:
+    + points: (coordinates, values, shape)
+    + replay: transformed["replay"] of an A.ReplayCompose
+    + mode: raster or project, see the module docstring
+    output: (coordinates, values, shape) of the transformed depth map, with
+    raster the same pixels as transforming the dense map with nearest
+    neighbor masks
+    """
+    if mode not in POINT_TRANSFORMS:
+        raise ValueError("Unknown point transform {}, expected one of {}".format(mode, POINT_TRANSFORMS))
+    coordinates, values, (height, width) = points
+    rows = coordinates[:, 0].astype(np.int64)
+    cols = coordinates[:, 1].astype(np.int64)
+
+    for t in replay["transforms"]:
+        name = t["__class_fullname__"]
+        if name in PIXEL_TRANSFORMS or not t["applied"]:
+            continue
+        if name == "Resize" and mode == "project":
+            rows = project_index(rows, height, t["height"])
+            cols = project_index(cols, width, t["width"])
+            height, width = t["height"], t["width"]
+            continue
+        elif name == "Resize":
+            rows = nearest_index(height, t["height"])[rows]
+            cols = nearest_index(width, t["width"])[cols]
+            height, width = t["height"], t["width"]
+            keep = (rows >= 0) & (cols >= 0)
+        elif name == "CenterCrop":
+            rows = rows - (height - t["height"]) // 2
+            cols = cols - (width - t["width"]) // 2
+            height, width = t["height"], t["width"]
+            keep = (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+        elif name == "HorizontalFlip":
+            cols = width - 1 - cols
+            continue
+        else:
+            raise ValueError("No point transform for {}".format(name))
+        rows, cols, values = rows[keep], cols[keep], values[keep]
+
+    if mode == "project":
+        rows, cols, values = zbuffer(rows, cols, values, width)
+    return np.stack([rows, cols], axis=1).astype(np.int32), values, (height, width)
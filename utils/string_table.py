@@ -0,0 +1,62 @@
+"""
+Tables of the datasets (paths, frame annotations) as a few numpy arrays
+instead of lists and dicts of Python objects.
+
+The dataloader workers are forked from the dataset: reading a Python object
+writes its refcount, and the pages of the lists/dicts get copied into every
+worker over an epoch. Numpy buffers are read without writes and stay shared.
+"""
+import numpy as np
+
+
+def pack_strings(strings):
+    # utf-8 blob and offsets (N + 1) of the strings (or bytes)
+    data = [s.encode("utf-8") if isinstance(s, str) else s for s in strings]
+    offsets = np.zeros(len(data) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(d) for d in data])
+    return np.frombuffer(b"".join(data), dtype=np.uint8), offsets
+
+
+class StringTable:
+    """
+    Strings in one utf-8 buffer with their offsets, indexed like a list
+    """
+
+    def __init__(self, strings=()):
+        self.data, self.offsets = pack_strings(strings)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("StringTable index out of range")
+        return self.data[self.offsets[i]:self.offsets[i + 1]].tobytes().decode("utf-8")
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def take(self, indices):
+        # StringTable of the strings at indices
+        return StringTable([self[int(i)] for i in indices])
+
+
+class RaggedTable:
+    """
+    Rows of different lengths of one array (values) with their offsets:
+    table[i] is the view values[offsets[i]:offsets[i + 1]]
+    """
+
+    def __init__(self, rows, dtype, shape=()):
+        rows = [np.asarray(row, dtype=dtype).reshape((-1,) + shape) for row in rows]
+        self.offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        self.offsets[1:] = np.cumsum([len(row) for row in rows])
+        self.values = np.concatenate(rows) if rows else np.zeros((0,) + shape, dtype=dtype)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.values[self.offsets[i]:self.offsets[i + 1]]
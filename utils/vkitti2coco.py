@@ -7,6 +7,7 @@ import json
 from detectron2.config import get_cfg
 from utils.add_custom_params import add_custom_params
 from utils.get_vkitti_files import get_vkitti_files
+from utils.manifest import Manifest, vkitti_key, vkitti_filter
 from datasets.vkitti_cats import rgb_2_class, categories
 # from pathlib import Path
 
@@ -79,22 +80,17 @@ def vkitti2coco():
     data["images"] = image_list
 
     # -----instance and semantic seg images----------
-    instance_seg_files = get_vkitti_files(instance_root, exclude, "png")
-    semantic_seg_files = get_vkitti_files(semantic_root, exclude, "png")
+    manifest = Manifest({"semantic": semantic_root, "instance": instance_root},
+                        "png", vkitti_key, vkitti_filter(exclude))
 
 
     for img in data["images"]:
         
         img_filename = img["file_name"]
-        # find scene and basename
-        scene = img_filename.split("/")[-6]
-        basename = img_filename.split(".")[-2].split("_")[-1]
-
         # Find corresponding semantic and instance images
-        instance_img_filename = [s for s in instance_seg_files if (
-            scene in s and basename in s)][0]
-        semantic_img_filename = [s for s in semantic_seg_files if (
-            scene in s and basename in s)][0]
+        key = vkitti_key(img_filename)
+        instance_img_filename = manifest.get(key, "instance")
+        semantic_img_filename = manifest.get(key, "semantic")
 
         if instance_img_filename is None or semantic_img_filename is None:
             print("Warning! Instance image: {} Semantic image: {}".format(